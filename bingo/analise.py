@@ -0,0 +1,16 @@
+import numpy as np
+
+
+def classificar_situacoes(responsavel, realizou_pagamento, comissao):
+    # versão vetorizada de Cartela.classificar_situacao; valores nulos (None) são tratados como NaN
+    responsavel = np.asarray(responsavel, dtype=float)
+    realizou_pagamento = np.asarray(realizou_pagamento, dtype=float)
+    comissao = np.asarray(comissao, dtype=float)
+    condicoes = [
+        np.isnan(responsavel),
+        np.isnan(realizou_pagamento),
+        (realizou_pagamento == 1) & (comissao > 0),
+        realizou_pagamento == 1,
+    ]
+    return np.select(condicoes, [0, 1, 2, 3], default=4).astype(np.int8)
+
@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_delete
+
+
+class BingoConfig(AppConfig):
+    name = 'bingo'
+
+    def ready(self):
+        from . import checks, models
+        for modelo in models.EXCLUSAO_CARTELAS:
+            pre_delete.connect(models.descontar_exclusao, sender=modelo)
+        if not getattr(settings, 'REGISTRAR_CONSULTAS', True):
+            connection_created.connect(checks.desativar_registro_consultas)
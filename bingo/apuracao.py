@@ -0,0 +1,106 @@
+from threading import Lock
+import numpy as np
+from .grades import NUMEROS_COLUNA, mascaras
+
+
+_lock = Lock()
+# apurações em memória por processo: {sorteio: Apuracao}
+APURACOES = {}
+# trava de cada sorteio, para que a carga das cartelas de um não bloqueie os demais: {sorteio: Lock}
+TRAVAS = {}
+# linha ocupada pelo número j de uma coluna com a máscara m: RANK[j, m] é a quantidade de bits marcados abaixo de j
+_BITS = (np.arange(1 << NUMEROS_COLUNA)[None, :] >> np.arange(NUMEROS_COLUNA)[:, None]) & 1
+RANK = (np.cumsum(_BITS, axis=0) - _BITS).astype(np.uint8)
+
+
+class Apuracao:
+    # estado da apuração de um sorteio: as máscaras das colunas de cada cartela e quantos números ainda faltam
+    # em cada linha, coluna e diagonal; a cada bola só as cartelas que têm o número são atualizadas
+
+    def __init__(self, ids, grades):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        quantidade = len(self.ids)
+        self.colunas = mascaras(grades)
+        # contadores em vetores planos (cartela * 5 + posição) para indexação rápida
+        self.faltam_linhas = np.full(quantidade * 5, 5, dtype=np.uint8)
+        self.faltam_colunas = np.full(quantidade * 5, 5, dtype=np.uint8)
+        # o centro é livre
+        self.faltam_linhas[2::5] = self.faltam_colunas[2::5] = 4
+        self.faltam_diagonais = np.full(quantidade * 2, 4, dtype=np.uint8)
+        self.faltam = np.full(quantidade, 24, dtype=np.uint8)
+        self.linha = np.zeros(quantidade, dtype=bool)
+        self.sorteados = []
+        self.versao = None
+
+    def sortear(self, numero):
+        # retorna os identificadores das cartelas que completaram a primeira linha e das que ficaram cheias
+        coluna, posicao = divmod(numero - 1, NUMEROS_COLUNA)
+        cartelas = np.flatnonzero((self.colunas[coluna] & np.uint16(1 << posicao)) != 0)
+        linhas = RANK[posicao][self.colunas[coluna][cartelas]]
+        if coluna == 2:
+            # a coluna N tem 4 números e o centro livre
+            linhas += linhas >= 2
+        self.sorteados.append(numero)
+        indices = cartelas * 5 + linhas
+        self.faltam_linhas[indices] -= 1
+        completas = self.faltam_linhas[indices] == 0
+        indices = cartelas * 5 + coluna
+        self.faltam_colunas[indices] -= 1
+        completas |= self.faltam_colunas[indices] == 0
+        # na coluna N as diagonais passam só pelo centro livre
+        for diagonal, linha in enumerate((coluna, 4 - coluna) if coluna != 2 else ()):
+            posicoes = np.flatnonzero(linhas == linha)
+            indices = cartelas[posicoes] * 2 + diagonal
+            self.faltam_diagonais[indices] -= 1
+            completas[posicoes] |= self.faltam_diagonais[indices] == 0
+        self.faltam[cartelas] -= 1
+        linha = cartelas[completas & ~self.linha[cartelas]]
+        self.linha[linha] = True
+        cheia = cartelas[self.faltam[cartelas] == 0]
+        return self.ids[linha].tolist(), self.ids[cheia].tolist()
+
+    def adicionar(self, ids, grades):
+        # cartelas que passaram a participar depois do início: os números já sorteados são aplicados sem gerar
+        # ganhadores, pois os prêmios dessas bolas já foram apurados
+        novas = Apuracao(ids, grades)
+        for numero in self.sorteados:
+            novas.sortear(numero)
+        for atributo in 'ids', 'faltam_linhas', 'faltam_colunas', 'faltam_diagonais', 'faltam', 'linha':
+            setattr(self, atributo, np.concatenate((getattr(self, atributo), getattr(novas, atributo))))
+        self.colunas = np.concatenate((self.colunas, novas.colunas), axis=1)
+
+    def remover(self, ids):
+        # sem números nas colunas, as cartelas que deixaram de participar não são mais atualizadas nem premiadas
+        self.colunas[:, np.isin(self.ids, ids)] = 0
+
+    def sincronizar(self, numeros):
+        # aplica os números sorteados por outro processo (ou antes de um reinício) que ainda não foram apurados aqui
+        return [self.sortear(numero) for numero in numeros[len(self.sorteados):]]
+
+
+def apurar(sorteio, carregar, numeros, versao=None):
+    # aplica à apuração do sorteio os números ainda não apurados neste processo e devolve os ganhadores de cada um;
+    # carregar(conhecidas) devolve (ids, grades, removidas) das cartelas que participam do sorteio e não estão entre
+    # as conhecidas; a versão muda quando o conjunto de cartelas pagas do evento muda
+    with _lock:
+        trava = TRAVAS.setdefault(sorteio, Lock())
+    with trava:
+        apuracao = APURACOES.get(sorteio)
+        # reconstrói a apuração que divergiu dos números gravados (por exemplo, numa transação desfeita)
+        if apuracao is None or apuracao.sorteados != numeros[:len(apuracao.sorteados)]:
+            ids, grades, removidas = carregar(None)
+            apuracao = Apuracao(ids, grades)
+        elif apuracao.versao != versao:
+            ids, grades, removidas = carregar(apuracao.ids)
+            apuracao.adicionar(ids, grades)
+            apuracao.remover(removidas)
+        apuracao.versao = versao
+        with _lock:
+            APURACOES[sorteio] = apuracao
+        return apuracao.sincronizar(numeros)
+
+
+def descartar(sorteio):
+    with _lock:
+        APURACOES.pop(sorteio, None)
+        TRAVAS.pop(sorteio, None)
@@ -12,5 +12,11 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bingo.settings')
+# as páginas servidas pelo ASGI recebem os painéis de monitoramento por SSE (ver bingo.monitoramento)
+os.environ.setdefault('MONITORAMENTO_SSE', '1')
 
 application = get_asgi_application()
+
+from .checks import relatar  # noqa: E402
+
+relatar()
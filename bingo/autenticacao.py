@@ -0,0 +1,13 @@
+from django.contrib.auth.backends import ModelBackend
+from .models import normalizar_cpf
+
+
+class CpfBackend(ModelBackend):
+    # o username dos papéis é o CPF só com dígitos; aceita o login com o CPF pontuado
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        user = super().authenticate(request, username=username, password=password, **kwargs)
+        cpf = normalizar_cpf(username)
+        if user is None and cpf and len(cpf) == 11 and cpf != username:
+            user = super().authenticate(request, username=cpf, password=password, **kwargs)
+        return user
@@ -0,0 +1,388 @@
+import os
+import time
+import json
+import asyncio
+import subprocess
+from uuid import uuid1
+from datetime import date
+from decimal import Decimal
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connection, transaction
+from django.test import Client
+from django.utils import timezone
+from .models import Pessoa, MeioPagamento, Evento, Cartela, CompraOnline
+from .services import CartelaBatchService
+from .mercadopago import MercadoPago
+from .stubs import MercadoPagoStub, WeasyprintStub
+from . import mercadopago, tasks
+
+
+class Benchmark:
+
+    def __init__(self, nome):
+        self.nome = nome
+        self.resultados = []
+
+    def medir(self, descricao, linhas, funcao, *args, **kwargs):
+        inicio = time.perf_counter()
+        funcao(*args, **kwargs)
+        return self.registrar(descricao, linhas, time.perf_counter() - inicio)
+
+    def registrar(self, descricao, linhas, segundos, **metricas):
+        # formato comum dos resultados; as métricas próprias de cada benchmark vão junto
+        resultado = dict(
+            benchmark=self.nome, descricao=descricao, linhas=linhas, segundos=round(segundos, 4),
+            linhas_segundo=int(linhas / segundos) if segundos else 0, **metricas
+        )
+        self.resultados.append(resultado)
+        return resultado
+
+
+def criar_evento(qtd_taloes, qtd_cartela_talao=50, nome='Benchmark'):
+    return Evento.objects.create(
+        nome=nome, data=date.today(), qtd_taloes=qtd_taloes, qtd_cartela_talao=qtd_cartela_talao,
+        valor_venda_cartela=Decimal('10'), valor_comissao_cartela=Decimal('2')
+    )
+
+
+def gerar_cpf(i):
+    # já normalizado, pois bulk_create não passa pelo save()
+    return '{:011d}'.format(i)
+
+
+def popular(qtd_taloes=200, qtd_cartela_talao=50, qtd_pessoas=100, qtd_compras=1000, distribuicao=0.8, pagamento=0.7, nome='Benchmark'):
+    # evento sintético: os talões distribuídos são divididos em blocos contíguos entre as pessoas,
+    # parte das cartelas distribuídas é paga e parte não paga; as compras online aprovadas recebem cartelas
+    evento = criar_evento(qtd_taloes, qtd_cartela_talao, nome)
+    tasks.GerarCartelas(evento).run()
+    meio_pagamento = MeioPagamento.objects.get_or_create(nome='Dinheiro')[0]
+    pessoas = Pessoa.objects.bulk_create([
+        Pessoa(nome='Pessoa {}'.format(i), cpf=gerar_cpf(i)) for i in range(1, qtd_pessoas + 1)
+    ])
+    distribuidas = int(qtd_taloes * distribuicao) * qtd_cartela_talao
+    bloco = max(distribuidas // len(pessoas), 1) if pessoas else 0
+    for i, pessoa in enumerate(pessoas):
+        inicio = i * bloco + 1
+        fim = distribuidas if i == len(pessoas) - 1 else min(inicio + bloco - 1, distribuidas)
+        if inicio > fim:
+            break
+        cartelas = Cartela.objects.filter(evento=evento, numero__range=(inicio, fim))
+        cartelas.atualizar(responsavel=pessoa)
+        pagas = int((fim - inicio + 1) * pagamento)
+        cartelas.filter(numero__lt=inicio + pagas).atualizar(realizou_pagamento=True, meio_pagamento=meio_pagamento)
+        cartelas.filter(numero=fim, realizou_pagamento__isnull=True).atualizar(realizou_pagamento=False)
+    compras = CompraOnline.objects.bulk_create([
+        CompraOnline(
+            nome='Pessoa {}'.format(i % qtd_pessoas + 1), cpf=gerar_cpf(i % qtd_pessoas + 1), email='pessoa@mail.com',
+            evento=evento, numero_cartelas=2, valor=2 * evento.valor_venda_cartela, uuid=uuid1().hex,
+            status='approved' if i < qtd_compras * pagamento else 'pending', url='https://mercadopago.com.br'
+        ) for i in range(qtd_compras)
+    ])
+    aprovadas = [compra for compra in compras if compra.is_confirmada()]
+    if aprovadas:
+        pessoa, meio_pagamento = CompraOnline.get_sentinelas()
+        cartelas = evento.gerar_cartelas_online(
+            2 * len(aprovadas), responsavel_id=pessoa, meio_pagamento_id=meio_pagamento, realizou_pagamento=True, comissao=0
+        )
+        CompraOnline.cartelas.through.objects.bulk_create([
+            CompraOnline.cartelas.through(compraonline_id=compra.pk, cartela_id=cartela.pk)
+            for compra, cartela in zip((compra for compra in aprovadas for _ in range(2)), cartelas)
+        ])
+    return evento
+
+
+def descartar(funcao):
+    # executa o benchmark numa transação que é sempre desfeita ao final
+    def wrapper(*args, **kwargs):
+        with transaction.atomic():
+            resultado = funcao(*args, **kwargs)
+            transaction.set_rollback(True)
+        return resultado
+    return wrapper
+
+
+@descartar
+def geracao_cartelas(tamanhos=(10000, 100000, 1000000)):
+    benchmark = Benchmark('geracao_cartelas')
+    for tamanho in tamanhos:
+        evento = criar_evento(tamanho // 50)
+        task = tasks.GerarCartelas(evento)
+        benchmark.medir('{} cartelas'.format(tamanho), tamanho, task.run)
+    return benchmark.resultados
+
+
+@descartar
+def intervalo_cartelas(tamanhos=(1000, 10000, 30000)):
+    # compara a seleção de um intervalo de cartelas por lista IN e por BETWEEN
+    benchmark = Benchmark('intervalo_cartelas')
+    evento = criar_evento(max(tamanhos) // 50)
+    tasks.GerarCartelas(evento).run()
+    for tamanho in tamanhos:
+        numeros = list(range(1, tamanho + 1))
+        lista = Cartela.objects.filter(evento=evento, numero__in=numeros)
+        intervalo = Cartela.objects.filter(evento=evento, numero__range=(1, tamanho))
+        for descricao, qs in (('lista IN', lista), ('BETWEEN', intervalo)):
+            resultado = benchmark.medir('{} com {} cartelas'.format(descricao, tamanho), tamanho, qs.count)
+            resultado['plano'] = qs.explain()
+    return benchmark.resultados
+
+
+@descartar
+def alocacao_online(tamanhos=(100, 1000)):
+    benchmark = Benchmark('alocacao_online')
+    evento = criar_evento(1)
+    for tamanho in tamanhos:
+        def alocar():
+            for i in range(tamanho):
+                evento.gerar_cartelas_online(2)
+        benchmark.medir('{} compras de 2 cartelas'.format(tamanho), tamanho * 2, alocar)
+    return benchmark.resultados
+
+
+@descartar
+def distribuicao_lote(tamanhos=(1000, 10000, 100000)):
+    benchmark = Benchmark('distribuicao_lote')
+    evento = criar_evento(max(tamanhos) // 50)
+    tasks.GerarCartelas(evento).run()
+    pessoa = Pessoa.objects.create(nome='Benchmark')
+    meio_pagamento = MeioPagamento.objects.get_or_create(nome='Dinheiro')[0]
+    for tamanho in tamanhos:
+        servico = CartelaBatchService(evento, 1, tamanho)
+        benchmark.medir('distribuição de {} cartelas'.format(tamanho), tamanho, servico.aplicar, 'distribuir', responsavel=pessoa)
+        benchmark.medir(
+            'prestação de contas de {} cartelas'.format(tamanho), tamanho, servico.aplicar, 'prestar_conta',
+            realizou_pagamento=True, meio_pagamento=meio_pagamento, comissao=0
+        )
+        servico.aplicar('devolver', responsavel=None, realizou_pagamento=None, meio_pagamento=None, posse=None)
+    return benchmark.resultados
+
+
+@descartar
+def resumo_financeiro(tamanhos=(10000, 100000)):
+    benchmark = Benchmark('resumo_financeiro')
+    for tamanho in tamanhos:
+        evento = popular(tamanho // 50, qtd_compras=0)
+        pessoa = Pessoa.objects.filter(cartela__evento=evento).first()
+        benchmark.medir('agregação completa de {} cartelas'.format(tamanho), tamanho, evento.calcular_resumo)
+        benchmark.medir('contadores de {} cartelas'.format(tamanho), tamanho, lambda: Evento.objects.get(pk=evento.pk).get_receita_final())
+        benchmark.medir('agregações da listagem de {} cartelas'.format(tamanho), tamanho, lambda: evento.get_cartelas().resumo())
+        benchmark.medir(
+            'agregações da listagem de uma pessoa', tamanho // Pessoa.objects.count(), lambda: pessoa.get_cartelas().resumo()
+        )
+    return benchmark.resultados
+
+
+@descartar
+def exportacao(tamanhos=(10000, 100000)):
+    benchmark = Benchmark('exportacao')
+    for tamanho in tamanhos:
+        evento = popular(tamanho // 50, qtd_compras=0)
+        for formato in ('csv', 'xlsx'):
+            task = tasks.ExportarCartelasTask(evento.get_cartelas(), formato)
+            benchmark.medir('{} cartelas em arquivo {}'.format(tamanho, formato.upper()), tamanho, lambda: os.unlink(task.run()))
+    return benchmark.resultados
+
+
+@descartar
+def impressao_cartelas(tamanhos=(10000, 50000), workers=(1, 8), latencia=0.05):
+    # PDFs por talão com o serviço weasyprint simulado por um stub com latência fixa por documento; mede a montagem
+    # do HTML e dos QrCodes, o pool de workers e a gravação do ZIP, não a renderização do weasyprint
+    benchmark = Benchmark('impressao_cartelas')
+    with WeasyprintStub(latencia=latencia) as stub, mock.patch.dict(os.environ, WEASYPRINT_URL=stub.url):
+        for tamanho in tamanhos:
+            evento = criar_evento(tamanho // 50)
+            tasks.GerarCartelas(evento).run()
+            for quantidade in workers:
+                task = tasks.ImprimirCartelasTask(evento.get_cartelas(), workers=quantidade)
+                benchmark.medir(
+                    '{} cartelas com {} workers'.format(tamanho, quantidade), tamanho, lambda: os.unlink(task.run())
+                )
+    return benchmark.resultados
+
+
+def carga_publica(tamanhos=(200, 1000), usuarios=10, compras=20):
+    # cenário HTTP das páginas públicas de compra com o Mercado Pago simulado; os dados criados são removidos ao final
+    benchmark = Benchmark('carga_publica')
+    evento = criar_evento(1, nome='Benchmark Carga')
+    cpfs = [gerar_cpf(90000000000 + i) for i in range(compras)]
+
+    def requisitar(metodo, url, dados=None):
+        inicio = time.perf_counter()
+        try:
+            resposta = getattr(Client(), metodo)(url, dados)
+            return time.perf_counter() - inicio, resposta.status_code < 400
+        finally:
+            connection.close()
+
+    def executar(requisicoes):
+        with ThreadPoolExecutor(max_workers=usuarios) as executor:
+            resultados = list(executor.map(lambda requisicao: requisitar(*requisicao), requisicoes))
+        tempos = sorted(segundos for segundos, _ in resultados)
+        return dict(
+            p50=round(tempos[len(tempos) // 2], 4), p95=round(tempos[int(len(tempos) * 0.95)], 4),
+            p99=round(tempos[int(len(tempos) * 0.99)], 4), erros=sum(1 for _, sucesso in resultados if not sucesso)
+        )
+
+    try:
+        with mock.patch.dict(os.environ, MERCADO_PAGO_MOCK='1'):
+            requisicoes = [
+                ('post', '/api/v1/realizar_compra_online/', dict(nome='Pessoa Carga', cpf=cpf, email='carga@mail.com', numero_cartelas=1))
+                for cpf in cpfs
+            ]
+            latencias = {}
+            resultado = benchmark.medir('{} compras'.format(compras), compras, lambda: latencias.update(executar(requisicoes)))
+            resultado.update(latencias)
+            uuids = list(CompraOnline.objects.filter(cpf__in=cpfs).values_list('uuid', flat=True))
+            for tamanho in tamanhos:
+                for descricao, url, valores in (
+                    ('visualização', '/api/v1/visualizar_compra_online/', [dict(uuid=uuid) for uuid in uuids]),
+                    ('consulta por CPF', '/api/v1/consultar_compra_online/', [dict(cpf=cpf) for cpf in cpfs]),
+                ):
+                    if not valores:
+                        continue
+                    requisicoes = [('get', url, valores[i % len(valores)]) for i in range(tamanho)]
+                    latencias = {}
+                    resultado = benchmark.medir(
+                        '{} requisições de {}'.format(tamanho, descricao), tamanho, lambda: latencias.update(executar(requisicoes))
+                    )
+                    resultado.update(latencias)
+    finally:
+        CompraOnline.objects.filter(cpf__in=cpfs).delete()
+        evento.delete()
+    return benchmark.resultados
+
+
+def gateway_assincrono(tamanhos=(50, 200), workers=8, latencia=0.2):
+    # consultas simultâneas a um gateway local com latência fixa: workers síncronos (uma thread bloqueada por
+    # requisição) contra um único event loop com o cliente assíncrono
+    benchmark = Benchmark('gateway_assincrono')
+    with MercadoPagoStub(latencia=latencia) as stub:
+        stub.pagar('referencia')
+        with mock.patch.dict(os.environ, TOKEN_MERCADO_PAGO='BENCHMARK', MERCADO_PAGO_URL=stub.url, MERCADO_PAGO_CONEXOES=str(max(tamanhos))):
+            mercadopago._cliente = None
+            mercadopago._sdks.clear()
+            data_hora = timezone.now()
+
+            def sincrono(tamanho):
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(lambda i: MercadoPago().consultar_pagamento('referencia', data_hora), range(tamanho)))
+
+            async def assincrono(tamanho):
+                await asyncio.gather(*(MercadoPago().aconsultar_pagamento('referencia', data_hora) for i in range(tamanho)))
+
+            for tamanho in tamanhos:
+                for descricao, funcao in (
+                    ('{} workers síncronos'.format(workers), sincrono),
+                    ('event loop assíncrono', lambda tamanho: asyncio.run(assincrono(tamanho)))
+                ):
+                    resultado = benchmark.medir('{} consultas com {}'.format(tamanho, descricao), tamanho, funcao, tamanho)
+                    # requisições em espera simultânea que o modo sustentou, estimadas pela latência do gateway
+                    resultado['concorrencia'] = round(tamanho * latencia / resultado['segundos'], 1)
+            mercadopago._cliente = None
+            mercadopago._sdks.clear()
+    return benchmark.resultados
+
+
+def salvar(resultados, caminho):
+    # resultados em JSON, identificados pelo commit, para comparar execuções
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(__file__)
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    with open(caminho, 'w') as arquivo:
+        json.dump(dict(commit=commit, data_hora=timezone.now().isoformat(), banco=connection.vendor, resultados=resultados), arquivo, indent=2)
+
+
+def classificacao_situacao(tamanhos=(10000, 100000, 1000000)):
+    import numpy as np
+    from .analise import classificar_situacoes
+    benchmark = Benchmark('classificacao_situacao')
+    rng = np.random.default_rng(0)
+    for tamanho in tamanhos:
+        responsavel = np.where(rng.random(tamanho) < 0.2, np.nan, 1)
+        realizou_pagamento = rng.choice([np.nan, 0, 1], tamanho)
+        comissao = rng.choice([0, 1, 2], tamanho)
+        benchmark.medir('{} cartelas'.format(tamanho), tamanho, classificar_situacoes, responsavel, realizou_pagamento, comissao)
+    return benchmark.resultados
+
+
+def geracao_grades(tamanhos=(10000, 100000, 1000000)):
+    # geração vetorizada das grades únicas e espaço ocupado por cartela, comparado a uma lista JSON dos 24 números
+    from . import grades
+    benchmark = Benchmark('geracao_grades')
+    semente = grades.gerar_semente()
+    amostra = grades.empacotar(grades.gerar(semente, range(1, 1001)))
+    tamanho_json = sum(
+        len(json.dumps([numero for linha in grades.desempacotar(grade) for numero in linha if numero])) for grade in amostra
+    ) / len(amostra)
+    for tamanho in tamanhos:
+        resultado = benchmark.medir('{} grades'.format(tamanho), tamanho, grades.gerar_unicas, semente, range(1, tamanho + 1))
+        resultado.update(bytes_cartela=grades.TAMANHO, bytes_cartela_json=tamanho_json)
+    if connection.vendor == 'postgresql':
+        # tamanho médio da coluna e do índice único (evento, grade) por cartela
+        with transaction.atomic():
+            evento = criar_evento(max(tamanhos) // 50)
+            tasks.GerarCartelas(evento).run()
+            with connection.cursor() as cursor:
+                resultado = benchmark.medir(
+                    'armazenamento', max(tamanhos), cursor.execute,
+                    'SELECT AVG(PG_COLUMN_SIZE(grade)), PG_RELATION_SIZE(%s::regclass) FROM bingo_cartela WHERE evento_id = %s',
+                    ['cartela_evento_grade_uniq', evento.pk]
+                )
+                coluna, indice = cursor.fetchone()
+            resultado.update(bytes_coluna=float(coluna), bytes_indice_cartela=indice / max(tamanhos))
+            transaction.set_rollback(True)
+    return benchmark.resultados
+
+
+def apuracao_sorteio(tamanhos=(100000, 1000000)):
+    # apuração em memória das 75 bolas sobre cartelas sintéticas, sem acesso ao banco
+    import numpy as np
+    from . import grades
+    from .apuracao import Apuracao
+    benchmark = Benchmark('apuracao_sorteio')
+    bolas = (np.random.default_rng(0).permutation(75) + 1).tolist()
+    for tamanho in tamanhos:
+        dados = grades.gerar_unicas(grades.gerar_semente(), range(1, tamanho + 1))
+        ids = np.arange(1, tamanho + 1)
+        benchmark.medir('carga de {} cartelas'.format(tamanho), tamanho, Apuracao, ids, dados)
+        apuracao = Apuracao(ids, dados)
+        tempos = []
+        ganhadores = dict(linha=None, cheia=None)
+        for ordem, numero in enumerate(bolas, 1):
+            inicio = time.perf_counter()
+            linha, cheia = apuracao.sortear(numero)
+            tempos.append(time.perf_counter() - inicio)
+            for tipo, cartelas in (('linha', linha), ('cheia', cheia)):
+                if cartelas and ganhadores[tipo] is None:
+                    ganhadores[tipo] = ordem
+        benchmark.registrar(
+            '{} cartelas x 75 bolas'.format(tamanho), tamanho * 75, sum(tempos),
+            ms_bola_media=round(1000 * sum(tempos) / len(tempos), 2), ms_bola_maximo=round(1000 * max(tempos), 2),
+            bola_linha=ganhadores['linha'], bola_cheia=ganhadores['cheia']
+        )
+        # retomada após um reinício: carga e reaplicação dos números já sorteados
+        benchmark.medir(
+            'retomada com {} cartelas e 75 bolas'.format(tamanho), tamanho,
+            lambda: Apuracao(ids, dados).sincronizar(bolas)
+        )
+    return benchmark.resultados
+
+
+BENCHMARKS = {
+    'geracao_cartelas': geracao_cartelas,
+    'geracao_grades': geracao_grades,
+    'intervalo_cartelas': intervalo_cartelas,
+    'classificacao_situacao': classificacao_situacao,
+    'apuracao_sorteio': apuracao_sorteio,
+    'alocacao_online': alocacao_online,
+    'distribuicao_lote': distribuicao_lote,
+    'resumo_financeiro': resumo_financeiro,
+    'exportacao': exportacao,
+    'impressao_cartelas': impressao_cartelas,
+    'carga_publica': carga_publica,
+    'gateway_assincrono': gateway_assincrono,
+}
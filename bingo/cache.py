@@ -0,0 +1,71 @@
+import os
+import time
+from threading import Lock
+from django.core.cache import cache
+
+
+_lock = Lock()
+METRICAS = {}
+
+
+class CacheVersionado:
+    # cada identificador tem uma versão própria; invalidar é só incrementar a versão,
+    # as entradas antigas deixam de ser lidas e expiram pelo TTL
+
+    def __init__(self, prefixo, variavel, ttl):
+        self.prefixo = prefixo
+        self.variavel = variavel
+        self.ttl = ttl
+        METRICAS.setdefault(prefixo, dict(acertos=0, falhas=0, invalidacoes=0))
+
+    def get_ttl(self):
+        return int(os.environ.get(self.variavel, self.ttl))
+
+    def get_chave_versao(self, identificador):
+        return '{}:versao:{}'.format(self.prefixo, identificador)
+
+    def get_versao(self, identificador):
+        chave = self.get_chave_versao(identificador)
+        versao = cache.get(chave)
+        if versao is None:
+            # versão perdida (expirada ou removida) recomeça num valor novo para não reaproveitar entradas antigas
+            cache.add(chave, time.time_ns(), timeout=None)
+            versao = cache.get(chave)
+        return versao
+
+    def get(self, identificador, nome, funcao):
+        ttl = self.get_ttl()
+        if not ttl or not identificador:
+            return funcao()
+        chave = '{}:{}:{}:{}'.format(self.prefixo, identificador, self.get_versao(identificador), nome)
+        valor = cache.get(chave)
+        if valor is None:
+            self.contar('falhas')
+            valor = funcao()
+            cache.set(chave, valor, timeout=ttl)
+        else:
+            self.contar('acertos')
+        return valor
+
+    def invalidar(self, identificador):
+        if not identificador:
+            return
+        chave = self.get_chave_versao(identificador)
+        try:
+            cache.incr(chave)
+        except ValueError:
+            cache.set(chave, time.time_ns(), timeout=None)
+        self.contar('invalidacoes')
+
+    def contar(self, nome):
+        with _lock:
+            METRICAS[self.prefixo][nome] += 1
+
+
+def get_metricas():
+    with _lock:
+        return {prefixo: dict(valores) for prefixo, valores in METRICAS.items()}
+
+
+compras = CacheVersionado('compraonline', 'CACHE_COMPRA_TTL', 60)
+compras_cpf = CacheVersionado('compraonline:cpf', 'CACHE_COMPRA_CPF_TTL', 30)
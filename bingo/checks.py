@@ -0,0 +1,52 @@
+import logging
+from collections import deque
+from django.conf import settings
+from django.core import checks
+
+
+logger = logging.getLogger('bingo.configuracao')
+
+
+def get_otimizacoes():
+    # (ativa, descrição) de cada otimização esperada no perfil de produção
+    banco = settings.DATABASES['default']
+    cache = settings.CACHES['default']['BACKEND']
+    templates = [loader for template in settings.TEMPLATES for loader in template.get('OPTIONS', {}).get('loaders', ())]
+    return [
+        (banco['ENGINE'].startswith('django.db.backends.postgresql'), 'banco de dados PostgreSQL'),
+        (bool(banco.get('CONN_MAX_AGE')), 'conexões persistentes (CONN_MAX_AGE={})'.format(banco.get('CONN_MAX_AGE', 0))),
+        (bool(banco.get('CONN_HEALTH_CHECKS')), 'verificação das conexões reaproveitadas'),
+        (bool(banco.get('DISABLE_SERVER_SIDE_CURSORS')), 'pooling pelo pgbouncer'),
+        ('redis' in cache.lower(), 'cache no Redis ({})'.format(cache)),
+        (settings.SESSION_ENGINE == 'django.contrib.sessions.backends.cache', 'sessões no cache'),
+        (any('cached.Loader' in str(loader) for loader in templates), 'templates com carregador em cache'),
+        (
+            not settings.DEBUG or not getattr(settings, 'REGISTRAR_CONSULTAS', True),
+            'consultas SQL não acumuladas em memória'
+        ),
+    ]
+
+
+# exibido por "manage.py check --deploy"
+@checks.register(deploy=True)
+def verificar_perfil(app_configs, **kwargs):
+    mensagens = []
+    for ativa, descricao in get_otimizacoes():
+        if ativa:
+            mensagens.append(checks.Info('Ativa: {}'.format(descricao), id='bingo.I001'))
+        elif getattr(settings, 'PERFIL', None) == 'producao':
+            mensagens.append(checks.Warning('Inativa no perfil de produção: {}'.format(descricao), id='bingo.W001'))
+    return mensagens
+
+
+def relatar():
+    # executado uma vez por processo na inicialização do WSGI/ASGI
+    otimizacoes = get_otimizacoes()
+    logger.info('Perfil {}: {}'.format(getattr(settings, 'PERFIL', 'desenvolvimento'), ', '.join(
+        '{} [{}]'.format(descricao, 'ativa' if ativa else 'inativa') for ativa, descricao in otimizacoes
+    )))
+
+
+def desativar_registro_consultas(sender, connection, **kwargs):
+    # com DEBUG ligado cada conexão guarda até 9000 consultas; uma fila de tamanho zero as descarta
+    connection.queries_log = deque(maxlen=0)
@@ -1,8 +1,10 @@
+import os
 from api import endpoints
 from api.components import Boxes
-from .models import Evento, Cartela, CompraOnline
+from .models import Evento, Cartela, CompraOnline, Sorteio
 from .mercadopago import MercadoPago
-from . import tasks
+from .services import CartelaBatchService
+from . import monitoramento, tasks
 
 
 class AcessoRapido(endpoints.Endpoint):
@@ -33,10 +35,15 @@ class RealizarCompraOnline(endpoints.Endpoint):
         fieldsets = {'': 'nome cpf, email, telefone numero_cartelas'}
 
     def post(self):
+        assincrono = bool(os.environ.get('CHECKOUT_ASSINCRONO'))
         compra = CompraOnline.objects.create(
             cpf=self.getdata('cpf'), nome=self.getdata('nome'), telefone=self.getdata('telefone'),
-            email=self.getdata('email'), numero_cartelas = self.getdata('numero_cartelas')
+            email=self.getdata('email'), numero_cartelas = self.getdata('numero_cartelas'),
+            status=CompraOnline.CRIANDO if assincrono else ''
         )
+        if assincrono:
+            tasks.executar(tasks.criar_checkout, compra.pk)
+            self.redirect('/api/v1/visualizar_compra_online/?uuid={}&aguardar=1'.format(compra.uuid))
         self.redirect(compra.url)
 
 
@@ -51,12 +58,20 @@ class VisualizarCompraOnline(endpoints.Endpoint):
         title = 'Visualizar Compra Online'
 
     def get(self):
-        compra = CompraOnline.objects.getdata(uuid=self.request.GET.getdata('uuid'))
-        autoreload = None if compra.is_confirmada() else 30
-        return compra.valueset(
-            'cpf', 'nome', 'data_hora', 'valor', 'get_status_atual', 'get_cartelas',
-            autoreload=autoreload
-        )
+        compra = CompraOnline.objects.get_por_uuid(self.request.GET.get('uuid'))
+        # o painel de monitoramento (ASGI) ou o autoreload recarrega a página quando a situação da compra muda
+        if compra.is_criando():
+            # página de espera enquanto o checkout é criado em segundo plano; o autoreload não depende do ASGI
+            tasks.retomar_checkouts([compra.pk])
+            return compra.valueset('nome', 'valor', 'get_status', autoreload=3)
+        if 'aguardar' in self.request.GET and compra.url and not compra.is_confirmada():
+            self.redirect(compra.url)
+        campos = 'cpf', 'nome', 'data_hora', 'valor', 'get_status_atual', 'get_cartelas'
+        if compra.is_confirmada():
+            return compra.valueset(*campos)
+        if monitoramento.is_disponivel():
+            return compra.valueset(*campos, 'get_painel_monitoramento')
+        return compra.valueset(*campos, autoreload=30)
 
     def check_permission(self):
         return True
@@ -70,7 +85,8 @@ class ConsultarCompraOnline(endpoints.Endpoint):
         title = 'Consultar Compra Online'
 
     def get(self):
-        return self.objects('bingo.compraonline').filter(cpf=self.getdata('cpf')).fields(
+        ids = CompraOnline.objects.get_ids_por_cpf(self.getdata('cpf'))
+        return self.objects('bingo.compraonline').filter(pk__in=ids).fields(
             'cpf', 'nome', 'data_hora', 'valor', 'get_numeros_cartelas', 'get_status'
         )
 
@@ -108,7 +124,19 @@ class GerarCartelas(endpoints.Endpoint):
         return self.check_roles('adm') and not self.instance.talao_set.exists()
 
 
-class Distribuir(endpoints.Endpoint):
+class OperacaoLote:
+
+    def aplicar_lote(self, transicao, **valores):
+        inicio, fim = self.getdata('numero_inicial'), self.getdata('numero_final')
+        if inicio is None and fim is None:
+            return False
+        servico = CartelaBatchService(self.instance.evento_id, fim if inicio is None else inicio, inicio if fim is None else fim)
+        resultado = servico.aplicar(transicao, **valores)
+        self.notify('{aplicadas} cartela(s) atualizada(s) e {ignoradas} ignorada(s)'.format(**resultado))
+        return True
+
+
+class Distribuir(OperacaoLote, endpoints.Endpoint):
 
     numero_inicial = endpoints.IntegerField(label='Número Inicial', required=False)
     numero_final = endpoints.IntegerField(label='Número Final', required=False)
@@ -126,20 +154,13 @@ class Distribuir(endpoints.Endpoint):
         }
 
     def post(self):
-        numeros = [str(n).rjust(5, '0') for n in range(
-            self.getdata('numero_inicial') or 0,
-            ((self.getdata('numero_final') or 0) + 1)
-        )]
-        qs = Cartela.objects.filter(talao__evento=self.instance.talao.evento).filter(numero__in=numeros)
-        qs.update(
-            responsavel=self.instance.responsavel
-        ) if numeros else super().post()
+        self.aplicar_lote('distribuir', responsavel=self.instance.responsavel) or super().post()
 
     def check_permission(self):
         return self.instance.responsavel is None and self.check_roles('adm', 'op')
 
 
-class DevolverCartela(endpoints.Endpoint):
+class DevolverCartela(OperacaoLote, endpoints.Endpoint):
     numero_inicial = endpoints.IntegerField(label='Número Inicial', required=False)
     numero_final = endpoints.IntegerField(label='Número Final', required=False)
 
@@ -160,20 +181,15 @@ class DevolverCartela(endpoints.Endpoint):
         self.instance.meio_pagamento = None
         self.instance.comissao = 0
         self.instance.save()
-        numeros = [str(n).rjust(5, '0') for n in range(
-            self.getdata('numero_inicial') or 0,
-            ((self.getdata('numero_final') or 0) + 1)
-        )]
-        qs = Cartela.objects.filter(talao__evento=self.instance.talao.evento).filter(numero__in=numeros)
-        qs.update(
-            responsavel=None, posse=None, realizou_pagamento=None, meio_pagamento=None, comissao=0
-        ) if numeros else super().post()
+        self.aplicar_lote(
+            'devolver', responsavel=None, posse=None, realizou_pagamento=None, meio_pagamento=None, comissao=0
+        ) or super().post()
 
     def check_permission(self):
         return self.instance.responsavel and not self.instance.realizou_pagamento and self.check_roles('adm', 'op')
 
 
-class InformarPosseCartela(endpoints.Endpoint):
+class InformarPosseCartela(OperacaoLote, endpoints.Endpoint):
     numero_inicial = endpoints.IntegerField(label='Número Inicial', required=False)
     numero_final = endpoints.IntegerField(label='Número Final', required=False)
 
@@ -190,20 +206,13 @@ class InformarPosseCartela(endpoints.Endpoint):
         }
 
     def post(self):
-        numeros = [str(n).rjust(5, '0') for n in range(
-            self.getdata('numero_inicial') or 0,
-            ((self.getdata('numero_final') or 0) + 1)
-        )]
-        qs = Cartela.objects.filter(talao__evento=self.instance.talao.evento).filter(numero__in=numeros)
-        qs.update(
-            posse=self.instance.posse
-        ) if numeros else super().post()
+        self.aplicar_lote('repassar', posse=self.instance.posse) or super().post()
 
     def check_permission(self):
         return self.instance.responsavel and self.instance.realizou_pagamento is None and self.check_roles('adm', 'op')
 
 
-class PrestarConta(endpoints.Endpoint):
+class PrestarConta(OperacaoLote, endpoints.Endpoint):
     numero_inicial = endpoints.IntegerField(label='Número Inicial', required=False)
     numero_final = endpoints.IntegerField(label='Número Final', required=False)
 
@@ -223,16 +232,12 @@ class PrestarConta(endpoints.Endpoint):
         if not self.getdata('realizou_pagamento'):
             self.instance.meio_pagamento = None
             self.instance.comissao = 0
-        numeros = [str(n).rjust(5, '0') for n in range(
-            self.getdata('numero_inicial') or 0,
-            ((self.getdata('numero_final') or 0) + 1)
-        )]
-        qs = Cartela.objects.filter(talao__evento=self.instance.talao.evento).filter(numero__in=numeros)
-        qs.update(
+        self.aplicar_lote(
+            'prestar_conta',
             realizou_pagamento=self.instance.realizou_pagamento,
             meio_pagamento=self.instance.meio_pagamento,
             comissao=self.instance.comissao
-        ) if numeros else super().post()
+        ) or super().post()
 
     def on_realizou_pagamento_change(self, realizou_pagamento=None, **kwargs):
         self.enable('comissao', 'meio_pagamento') if realizou_pagamento else self.disable('comissao', 'meio_pagamento')
@@ -243,8 +248,8 @@ class PrestarConta(endpoints.Endpoint):
         if self.getdata('realizou_pagamento'):
             if self.getdata('comissao') is None:
                 raise endpoints.ValidationError('Informe a comissão')
-            if self.getdata('comissao') > self.instance.talao.evento.valor_comissao_cartela:
-                raise endpoints.ValidationError('Valor não pode ser superior a {}'.format(self.instance.talao.evento.valor_comissao_cartela))
+            if self.getdata('comissao') > self.instance.evento.valor_comissao_cartela:
+                raise endpoints.ValidationError('Valor não pode ser superior a {}'.format(self.instance.evento.valor_comissao_cartela))
             return self.getdata('comissao')
         return 0
 
@@ -253,6 +258,8 @@ class PrestarConta(endpoints.Endpoint):
 
 
 class ExportarCartelas(endpoints.Endpoint):
+    formato = endpoints.ChoiceField(label='Formato', choices=[['xlsx', 'Excel'], ['csv', 'CSV']], initial='xlsx')
+
     class Meta:
         title = 'Exportar para Excel'
         modal = True
@@ -260,12 +267,27 @@ class ExportarCartelas(endpoints.Endpoint):
         target = 'queryset'
 
     def post(self):
-        self.execute(tasks.ExportarCartelasTask(self.instance))
+        self.execute(tasks.ExportarCartelasTask(self.instance, self.getdata('formato')))
 
     def check_permission(self):
         return True
 
 
+class ImprimirCartelas(endpoints.Endpoint):
+    class Meta:
+        icon = 'print'
+        title = 'Imprimir Cartelas'
+        modal = True
+        target = 'queryset'
+        help_text = 'Gera um arquivo ZIP com um PDF por talão.'
+
+    def post(self):
+        self.execute(tasks.ImprimirCartelasTask(self.instance))
+
+    def check_permission(self):
+        return self.check_roles('adm', 'op')
+
+
 class AtualizarSituacao(endpoints.Endpoint):
 
     class Meta:
@@ -290,4 +312,63 @@ class EfetuarPagamentoOnline(endpoints.Endpoint):
         self.redirect(self.instance.url)
 
     def check_permission(self):
-        return not self.instance.is_confirmada()
+        return not self.instance.is_confirmada() and bool(self.instance.url)
+
+
+class IniciarSorteio(endpoints.Endpoint):
+
+    class Meta:
+        icon = 'play'
+        title = 'Iniciar Sorteio'
+        target = 'instance'
+
+    def post(self):
+        sorteio = Sorteio.objects.create(evento=self.instance)
+        self.redirect('/api/v1/sorteio/{}/'.format(sorteio.pk))
+
+    def check_permission(self):
+        return self.check_roles('adm', 'op') and not self.instance.sorteio_set.em_andamento().exists()
+
+
+class SortearNumero(endpoints.Endpoint):
+    numero = endpoints.IntegerField(label='Número', required=False, help_text='Deixe em branco para sortear pelo sistema')
+
+    class Meta:
+        icon = 'circle'
+        title = 'Sortear Número'
+        target = 'instance'
+        modal = True
+        style = 'primary'
+
+    def post(self):
+        numero, linha, cheia = self.instance.sortear(self.getdata('numero'))
+        mensagens = ['Número {} sorteado'.format(numero)]
+        if linha:
+            mensagens.append('{} cartela(s) completaram uma linha'.format(len(linha)))
+        if cheia:
+            mensagens.append('{} cartela(s) cheia(s)'.format(len(cheia)))
+        self.notify('. '.join(mensagens))
+
+    def validate_numero(self, numero):
+        if numero is not None and (not 1 <= numero <= 75 or numero in self.instance.get_numeros()):
+            raise endpoints.ValidationError('Informe um número de 1 a 75 ainda não sorteado')
+        return numero
+
+    def check_permission(self):
+        return self.instance.fim is None and self.check_roles('adm', 'op')
+
+
+class EncerrarSorteio(endpoints.Endpoint):
+
+    class Meta:
+        icon = 'stop'
+        title = 'Encerrar Sorteio'
+        target = 'instance'
+        style = 'danger'
+
+    def post(self):
+        self.instance.encerrar()
+        self.notify('Sorteio encerrado')
+
+    def check_permission(self):
+        return self.instance.fim is None and self.check_roles('adm', 'op')
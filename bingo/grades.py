@@ -0,0 +1,110 @@
+import secrets
+from itertools import combinations
+import numpy as np
+
+
+# a grade é guardada como uma máscara de 75 bits (bit n - 1 marca o número n) em 10 bytes little-endian;
+# cada coluna B-I-N-G-O ocupa 15 bits e os números de uma coluna aparecem em ordem crescente na cartela
+COLUNAS = 5
+NUMEROS_COLUNA = 15
+TAMANHO = 10
+# quantidade de números por coluna; a coluna N tem 4 números e o espaço livre no centro
+QUANTIDADES = 5, 5, 4, 5, 5
+# todas as combinações possíveis de cada coluna como máscaras de 15 bits
+COMBINACOES = {
+    quantidade: np.array([sum(1 << i for i in c) for c in combinations(range(NUMEROS_COLUNA), quantidade)], dtype=np.uint64)
+    for quantidade in set(QUANTIDADES)
+}
+TOTAIS = np.array([len(COMBINACOES[quantidade]) for quantidade in QUANTIDADES], dtype=np.uint64)
+FORMATO = np.dtype([('baixo', '<u8'), ('alto', '<u2')])
+
+_M1 = np.uint64(0xBF58476D1CE4E5B9)
+_M2 = np.uint64(0x94D049BB133111EB)
+_OURO = np.uint64(0x9E3779B97F4A7C15)
+
+
+def gerar_semente():
+    return secrets.randbits(63)
+
+
+def misturar(x):
+    # finalizador do splitmix64: espalha entradas sequenciais em valores pseudoaleatórios independentes
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * _M1
+        x = (x ^ (x >> np.uint64(27))) * _M2
+    return x ^ (x >> np.uint64(31))
+
+
+def gerar(semente, numeros, tentativas=0):
+    # a grade de cada cartela depende só da semente do evento, do número da cartela e da tentativa,
+    # então gerar em lotes de qualquer tamanho ou em outra ordem produz as mesmas grades
+    numeros = np.asarray(numeros, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        base = misturar(misturar(np.uint64(semente) ^ (numeros * _OURO)) + np.asarray(tentativas, dtype=np.uint64) * _OURO)
+        chaves = misturar(base[:, None] ^ (np.arange(1, COLUNAS + 1, dtype=np.uint64) * _OURO))
+    indices = chaves % TOTAIS
+    colunas = [COMBINACOES[quantidade][indices[:, i]] for i, quantidade in enumerate(QUANTIDADES)]
+    grades = np.empty(len(numeros), dtype=FORMATO)
+    grades['baixo'] = (
+        colunas[0] | colunas[1] << np.uint64(15) | colunas[2] << np.uint64(30) | colunas[3] << np.uint64(45)
+        | (colunas[4] & np.uint64(0xF)) << np.uint64(60)
+    )
+    grades['alto'] = colunas[4] >> np.uint64(4)
+    return grades
+
+
+def duplicadas(grades):
+    # posições das grades que repetem uma anterior (a primeira ocorrência é mantida)
+    ordem = np.lexsort((np.arange(len(grades)), grades['baixo'], grades['alto']))
+    ordenadas = grades[ordem]
+    iguais = (ordenadas['baixo'][1:] == ordenadas['baixo'][:-1]) & (ordenadas['alto'][1:] == ordenadas['alto'][:-1])
+    return np.sort(ordem[1:][iguais])
+
+
+def gerar_unicas(semente, numeros, existentes=None):
+    # grades repetidas no lote ou já usadas no evento são geradas novamente com a tentativa seguinte;
+    # existentes recebe a lista de grades empacotadas e devolve as que já estão em uso
+    numeros = np.asarray(numeros, dtype=np.uint64)
+    tentativas = np.zeros(len(numeros), dtype=np.uint64)
+    grades = gerar(semente, numeros)
+    while True:
+        repetidas = duplicadas(grades)
+        if len(repetidas) == 0 and existentes:
+            empacotadas = empacotar(grades)
+            usadas = set(map(bytes, existentes(empacotadas)))
+            repetidas = np.array([i for i, grade in enumerate(empacotadas) if grade in usadas], dtype=np.intp)
+        if len(repetidas) == 0:
+            return grades
+        tentativas[repetidas] += 1
+        grades[repetidas] = gerar(semente, numeros[repetidas], tentativas[repetidas])
+
+
+def empacotar(grades):
+    dados = grades.tobytes()
+    return [dados[i:i + TAMANHO] for i in range(0, len(dados), TAMANHO)]
+
+
+def carregar(grades):
+    # grades empacotadas (bytes ou memoryview, como vêm do banco) para o formato estruturado
+    return np.frombuffer(b''.join(map(bytes, grades)), dtype=FORMATO)
+
+
+def mascaras(grades):
+    # máscaras de 15 bits de cada coluna, no formato (colunas, cartelas)
+    baixo = grades['baixo']
+    colunas = np.empty((COLUNAS, len(grades)), dtype=np.uint16)
+    for i in range(COLUNAS):
+        colunas[i] = (baixo >> np.uint64(i * NUMEROS_COLUNA)) & np.uint64(0x7FFF)
+    colunas[COLUNAS - 1] |= grades['alto'] << np.uint16(4)
+    return colunas
+
+
+def desempacotar(grade):
+    # linhas da cartela com os números de cada coluna em ordem crescente; o centro (espaço livre) é None
+    mascara = int.from_bytes(bytes(grade), 'little')
+    colunas = [
+        [i * NUMEROS_COLUNA + j + 1 for j in range(NUMEROS_COLUNA) if mascara >> (i * NUMEROS_COLUNA + j) & 1]
+        for i in range(COLUNAS)
+    ]
+    colunas[2].insert(2, None)
+    return [list(linha) for linha in zip(*colunas)]
@@ -0,0 +1,92 @@
+import os
+from html import escape
+from threading import Lock
+from .grades import desempacotar
+
+
+# impressão das cartelas em PDF, um arquivo por talão: cada worker monta o HTML do talão e o converte pelo serviço
+# weasyprint (WEASYPRINT_HOST ou WEASYPRINT_URL) ou, sem ele, pelo weasyprint instalado no próprio processo;
+# este módulo não depende do Django para poder ser executado nos processos do pool
+
+LETRAS = 'BINGO'
+ESTILO = '''
+@page { size: A4; margin: 8mm; }
+body { margin: 0; font-family: sans-serif; font-size: 10pt; }
+.cartela { display: inline-block; box-sizing: border-box; width: 95mm; height: 138mm; padding: 4mm; border: 0.3mm dashed #999; vertical-align: top; break-inside: avoid; }
+.cabecalho { display: flex; justify-content: space-between; font-size: 11pt; margin-bottom: 2mm; }
+table { width: 100%; border-collapse: collapse; table-layout: fixed; }
+th { font-size: 18pt; padding: 1mm 0; }
+td { height: 15mm; border: 0.4mm solid #000; text-align: center; font-size: 20pt; font-weight: bold; }
+td.livre { font-size: 9pt; font-weight: normal; }
+.rodape { display: flex; justify-content: space-between; align-items: flex-end; margin-top: 3mm; }
+.numero { font-size: 14pt; }
+.rodape svg { width: 24mm; height: 24mm; }
+'''
+
+_lock = Lock()
+_cliente = None
+
+
+def get_url():
+    url = os.environ.get('WEASYPRINT_URL')
+    if url is None and os.environ.get('WEASYPRINT_HOST'):
+        url = 'http://{}:8888'.format(os.environ['WEASYPRINT_HOST'])
+    return url
+
+
+def get_codigo(evento, numero, grade):
+    # conteúdo do QrCode: evento, número e grade da cartela (em maiúsculas, no modo alfanumérico, mais compacto)
+    return '{}-{}-{}'.format(evento, numero, bytes(grade).hex()).upper()
+
+
+def gerar_qrcode(texto):
+    import segno
+    # a máscara fixa dispensa a avaliação das oito máscaras, a parte mais cara da geração
+    return segno.make(texto, error='m', micro=False, mask=2).svg_inline(border=0, omitsize=True)
+
+
+def montar_html(evento, nome, data, talao, cartelas):
+    # cartelas: lista de (número formatado, grade empacotada)
+    partes = ['<html><head><meta charset="utf-8"><style>', ESTILO, '</style></head><body>']
+    cabecalho = '<div class="cabecalho"><strong>{}</strong><span>{}</span></div>'.format(escape(nome), data)
+    letras = '<tr>{}</tr>'.format(''.join('<th>{}</th>'.format(letra) for letra in LETRAS))
+    for numero, grade in cartelas:
+        linhas = ''.join(
+            '<tr>{}</tr>'.format(''.join('<td>{}</td>'.format(n) if n else '<td class="livre">LIVRE</td>' for n in linha))
+            for linha in desempacotar(grade)
+        )
+        partes.append(
+            '<div class="cartela">{}<table>{}{}</table><div class="rodape"><div>Talão {}<br><span class="numero">'
+            'Cartela {}</span></div>{}</div></div>'.format(
+                cabecalho, letras, linhas, escape(talao), numero, gerar_qrcode(get_codigo(evento, numero, grade))
+            )
+        )
+    partes.append('</body></html>')
+    return ''.join(partes)
+
+
+def get_cliente():
+    global _cliente
+    with _lock:
+        if _cliente is None:
+            import httpx
+            _cliente = httpx.Client(timeout=httpx.Timeout(float(os.environ.get('WEASYPRINT_TIMEOUT', 300)), connect=5))
+        return _cliente
+
+
+def renderizar_servico(url, conteudo):
+    response = get_cliente().post(url, content=conteudo.encode(), headers={'Content-Type': 'text/html; charset=utf-8'})
+    # o serviço responde 200 antes de renderizar, então uma falha só aparece no conteúdo
+    if response.status_code != 200 or not response.content.startswith(b'%PDF'):
+        raise Exception('Falha na renderização do PDF pelo serviço weasyprint ({}).'.format(response.status_code))
+    return response.content
+
+
+def renderizar_local(conteudo):
+    from weasyprint import HTML
+    return HTML(string=conteudo).write_pdf()
+
+
+def imprimir_talao(url, evento, nome, data, talao, cartelas):
+    conteudo = montar_html(evento, nome, data, talao, cartelas)
+    return renderizar_servico(url, conteudo) if url else renderizar_local(conteudo)
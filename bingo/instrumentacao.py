@@ -0,0 +1,202 @@
+import os
+import re
+import hmac
+import sys
+import json
+import time
+import random
+import logging
+from threading import Lock
+from collections import Counter
+from contextvars import ContextVar
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection, models
+from api.endpoints import Endpoint
+
+
+logger = logging.getLogger('bingo.instrumentacao')
+_lock = Lock()
+METRICAS = dict(endpoints={}, metodos={})
+
+
+# coletor da requisição em andamento, visível também nas threads do sync_to_async (cada thread tem a sua conexão)
+ATUAL = ContextVar('bingo.instrumentacao.coletor', default=None)
+
+
+def get_amostragem():
+    # fração das requisições instrumentadas: 0 desliga a instrumentação, 1 instrumenta todas
+    return float(os.environ.get('INSTRUMENTACAO_AMOSTRAGEM', 0))
+
+
+class Coletor:
+
+    PARAMETROS = re.compile(r'(%s|\?)(, (%s|\?))+')
+    MODULOS = ('bingo.', 'api.')
+
+    def __init__(self):
+        self.endpoint = None
+        self.consultas = 0
+        self.segundos = 0.0
+        self.assinaturas = Counter()
+        self.metodos = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        inicio = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.consultas += 1
+            self.segundos += time.perf_counter() - inicio
+            # listas IN de tamanhos diferentes contam como a mesma consulta
+            self.assinaturas[self.PARAMETROS.sub(r'\1, ...', sql)] += 1
+            metodo = self.atribuir()
+            if metodo:
+                self.metodos[metodo] += 1
+
+    def atribuir(self):
+        # método get_* de modelo ou queryset mais externo na pilha (o que foi exibido) e o endpoint em execução
+        metodo = None
+        frame = sys._getframe(2)
+        while frame:
+            instancia = frame.f_locals.get('self')
+            if instancia is not None and frame.f_globals.get('__name__', '').startswith(self.MODULOS):
+                if frame.f_code.co_name.startswith('get_') and isinstance(instancia, (models.Model, models.QuerySet)):
+                    metodo = '{}.{}'.format(
+                        getattr(instancia, 'model', type(instancia)).__name__, frame.f_code.co_name
+                    )
+                if self.endpoint is None and isinstance(instancia, Endpoint):
+                    self.endpoint = type(instancia).__name__
+            frame = frame.f_back
+        return metodo
+
+    def get_duplicadas(self):
+        return {sql: quantidade for sql, quantidade in self.assinaturas.items() if quantidade > 1}
+
+
+def coletar(execute, sql, params, many, context):
+    coletor = ATUAL.get()
+    if coletor is None:
+        return execute(sql, params, many, context)
+    return coletor(execute, sql, params, many, context)
+
+
+def instalar():
+    # o wrapper fica na conexão da thread e só coleta quando há um coletor no contexto
+    if coletar not in connection.execute_wrappers:
+        connection.execute_wrappers.append(coletar)
+
+
+class InstrumentacaoMiddleware:
+    # no ASGI as views assíncronas não são adaptadas; as consultas feitas nas threads do sync_to_async também
+    # são contadas, pois o coletor passa pelo contexto e o wrapper é instalado na conexão da thread da requisição
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not get_amostragem():
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.acall(request)
+        if random.random() >= get_amostragem():
+            return self.get_response(request)
+        coletor = Coletor()
+        token = ATUAL.set(coletor)
+        inicio = time.perf_counter()
+        try:
+            instalar()
+            response = self.get_response(request)
+        finally:
+            ATUAL.reset(token)
+        self.finalizar(coletor, request, response, inicio)
+        return response
+
+    async def acall(self, request):
+        if random.random() >= get_amostragem():
+            return await self.get_response(request)
+        coletor = Coletor()
+        token = ATUAL.set(coletor)
+        inicio = time.perf_counter()
+        try:
+            await sync_to_async(instalar)()
+            response = await self.get_response(request)
+        finally:
+            ATUAL.reset(token)
+        self.finalizar(coletor, request, response, inicio)
+        return response
+
+    def finalizar(self, coletor, request, response, inicio):
+        segundos = time.perf_counter() - inicio
+        if coletor.endpoint is None:
+            match = request.resolver_match
+            coletor.endpoint = match.view_name if match else request.path
+        registrar(coletor, request, response, segundos)
+
+
+def registrar(coletor, request, response, segundos):
+    duplicadas = coletor.get_duplicadas()
+    with _lock:
+        metricas = METRICAS['endpoints'].setdefault(
+            coletor.endpoint, dict(requisicoes=0, consultas=0, sql_segundos=0.0, segundos=0.0, duplicadas=0)
+        )
+        metricas['requisicoes'] += 1
+        metricas['consultas'] += coletor.consultas
+        metricas['sql_segundos'] += coletor.segundos
+        metricas['segundos'] += segundos
+        metricas['duplicadas'] += sum(duplicadas.values()) - len(duplicadas)
+        for metodo, quantidade in coletor.metodos.items():
+            METRICAS['metodos'][metodo] = METRICAS['metodos'].get(metodo, 0) + quantidade
+    logger.info(json.dumps(dict(
+        endpoint=coletor.endpoint, metodo=request.method, caminho=request.path, status=response.status_code,
+        segundos=round(segundos, 4), consultas=coletor.consultas, sql_segundos=round(coletor.segundos, 4),
+        duplicadas=duplicadas, metodos=dict(coletor.metodos)
+    )))
+
+
+def autorizar(request):
+    # /metrics expõe a carga de cada rota: só o superusuário ou o coletor com o token de METRICAS_TOKEN
+    # (cabeçalho "Authorization: Bearer <token>") têm acesso
+    token = os.environ.get('METRICAS_TOKEN')
+    cabecalho = request.headers.get('Authorization', '')
+    if token and hmac.compare_digest(cabecalho.encode(), 'Bearer {}'.format(token).encode()):
+        return True
+    return request.user.is_authenticated and request.user.is_superuser
+
+
+def exportar():
+    # formato texto do Prometheus; os valores são do processo que atende a requisição
+    from . import cache, mercadopago
+    linhas = []
+
+    def metrica(nome, tipo, valores):
+        linhas.append('# TYPE {} {}'.format(nome, tipo))
+        for rotulos, valor in valores:
+            rotulos = ','.join('{}="{}"'.format(chave, str(texto).replace('"', '\\"')) for chave, texto in rotulos.items())
+            linhas.append('{}{} {}'.format(nome, '{{{}}}'.format(rotulos) if rotulos else '', valor))
+
+    with _lock:
+        endpoints = {nome: dict(valores) for nome, valores in METRICAS['endpoints'].items()}
+        metodos = dict(METRICAS['metodos'])
+    for chave, nome in (
+        ('requisicoes', 'bingo_requisicoes_total'), ('segundos', 'bingo_requisicao_segundos_total'),
+        ('consultas', 'bingo_sql_consultas_total'), ('sql_segundos', 'bingo_sql_segundos_total'),
+        ('duplicadas', 'bingo_sql_duplicadas_total')
+    ):
+        metrica(nome, 'counter', [(dict(endpoint=endpoint), valores[chave]) for endpoint, valores in endpoints.items()])
+    metrica('bingo_metodo_sql_consultas_total', 'counter', [(dict(metodo=metodo), quantidade) for metodo, quantidade in metodos.items()])
+    metrica('bingo_cache_total', 'counter', [
+        (dict(cache=prefixo, resultado=resultado), quantidade)
+        for prefixo, valores in cache.get_metricas().items() for resultado, quantidade in valores.items()
+    ])
+    if mercadopago._cliente is not None:
+        valores = mercadopago._cliente.get_metricas()
+        metrica('bingo_mercado_pago_total', 'counter', [
+            (dict(resultado=chave), valores[chave]) for chave in ('requisicoes', 'erros', 'tentativas', 'rejeitadas')
+        ])
+        metrica('bingo_mercado_pago_circuito_aberto', 'gauge', [({}, int(valores['circuito_aberto']))])
+    return '\n'.join(linhas) + '\n'
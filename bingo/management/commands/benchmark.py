@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from bingo.benchmarks import BENCHMARKS, salvar
+
+
+class Command(BaseCommand):
+    help = 'Executa os benchmarks do bingo'
+
+    PADRAO = 'benchmark', 'descricao', 'linhas', 'segundos', 'linhas_segundo', 'plano'
+
+    def add_arguments(self, parser):
+        parser.add_argument('nomes', nargs='*', type=str, help='Benchmarks: {}'.format(', '.join(BENCHMARKS)))
+        parser.add_argument('--tamanhos', nargs='*', type=int, help='Quantidades de cartelas')
+        parser.add_argument('--json', type=str, help='Arquivo onde os resultados serão salvos')
+
+    def handle(self, *args, **options):
+        resultados = []
+        for nome in options['nomes'] or BENCHMARKS:
+            kwargs = dict(tamanhos=options['tamanhos']) if options['tamanhos'] else {}
+            for resultado in BENCHMARKS[nome](**kwargs):
+                resultados.append(resultado)
+                self.stdout.write(self.formatar(resultado))
+                if options['verbosity'] > 1 and 'plano' in resultado:
+                    self.stdout.write(resultado['plano'])
+        if options['json']:
+            salvar(resultados, options['json'])
+
+    def formatar(self, resultado):
+        # as métricas ausentes são omitidas e as próprias de cada benchmark são listadas ao final
+        linha = '{}: {}'.format(resultado['benchmark'], resultado['descricao'])
+        if 'segundos' in resultado:
+            linha = '{} em {}s'.format(linha, resultado['segundos'])
+        if 'linhas_segundo' in resultado:
+            linha = '{} ({} linhas/s)'.format(linha, resultado['linhas_segundo'])
+        extras = ', '.join('{}={}'.format(chave, valor) for chave, valor in resultado.items() if chave not in self.PADRAO)
+        return '{} [{}]'.format(linha, extras) if extras else linha
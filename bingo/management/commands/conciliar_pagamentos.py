@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from bingo.services import ConciliacaoPagamentos
+from bingo.tasks import retomar_checkouts
+
+
+class Command(BaseCommand):
+    help = 'Concilia as compras online pendentes com os pagamentos do Mercado Pago'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horas', type=int, default=48, help='Janela de tempo das compras verificadas')
+        parser.add_argument('--requisicoes', type=int, default=50, help='Número máximo de requisições à API')
+        parser.add_argument('--intervalo', type=float, default=0.5, help='Intervalo mínimo em segundos entre requisições')
+
+    def handle(self, *args, **options):
+        reenviadas, expiradas = retomar_checkouts()
+        self.stdout.write('{} checkout(s) reenviado(s), {} expirado(s)'.format(reenviadas, expiradas))
+        conciliacao = ConciliacaoPagamentos(options['horas'], options['requisicoes'], options['intervalo'])
+        resumo = conciliacao.executar()
+        self.stdout.write(
+            '{verificadas} compra(s) verificada(s), {atualizadas} atualizada(s), {aprovadas} aprovada(s), '
+            '{erros} erro(s) em {requisicoes} requisição(ões)'.format(**resumo)
+        )
+        if resumo['incompleta']:
+            self.stdout.write('Orçamento de requisições esgotado antes do fim da busca.')
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from bingo.benchmarks import popular
+
+
+class Command(BaseCommand):
+    help = 'Cria um evento sintético para testes de carga'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--taloes', type=int, default=200, help='Quantidade de talões')
+        parser.add_argument('--cartelas-talao', type=int, default=50, help='Quantidade de cartelas por talão')
+        parser.add_argument('--pessoas', type=int, default=100, help='Quantidade de pessoas')
+        parser.add_argument('--compras', type=int, default=1000, help='Quantidade de compras online')
+        parser.add_argument('--distribuicao', type=float, default=0.8, help='Fração dos talões distribuídos')
+        parser.add_argument('--pagamento', type=float, default=0.7, help='Fração das cartelas distribuídas e das compras pagas')
+        parser.add_argument('--nome', type=str, default='Benchmark', help='Nome do evento')
+
+    def handle(self, *args, **options):
+        evento = popular(
+            options['taloes'], options['cartelas_talao'], options['pessoas'], options['compras'],
+            options['distribuicao'], options['pagamento'], options['nome']
+        )
+        resumo = evento.get_resumo()
+        self.stdout.write('{} ({}): {} cartelas, {} distribuídas, {} pagas'.format(
+            evento, evento.pk, resumo['total'], resumo['distribuidas'], resumo['pagas']
+        ))
@@ -0,0 +1,22 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from bingo.tasks import retomar_checkouts
+
+
+class Command(BaseCommand):
+    help = 'Retoma periodicamente os checkouts das compras online que ficaram em "creating", fora dos processos web'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--intervalo', type=float, default=30, help='Intervalo em segundos entre as verificações')
+        parser.add_argument('--uma-vez', action='store_true', help='Executa uma única verificação')
+
+    def handle(self, *args, **options):
+        while True:
+            reenviadas, expiradas = retomar_checkouts(sincrono=True)
+            if reenviadas or expiradas or options['uma_vez']:
+                self.stdout.write('{} checkout(s) reenviado(s), {} expirado(s)'.format(reenviadas, expiradas))
+            if options['uma_vez']:
+                break
+            time.sleep(options['intervalo'])
+            close_old_connections()
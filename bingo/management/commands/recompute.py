@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from bingo.models import Evento, EventoResumo
+
+
+class Command(BaseCommand):
+    help = 'Recalcula os contadores de EventoResumo a partir das cartelas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('eventos', nargs='*', type=int, help='Identificadores dos eventos (padrão: todos)')
+
+    def handle(self, *args, **options):
+        qs = Evento.objects.all()
+        if options['eventos']:
+            qs = qs.filter(pk__in=options['eventos'])
+        for evento in qs.order_by('id'):
+            anterior = EventoResumo.objects.filter(evento=evento).values(*EventoResumo.CONTADORES).first()
+            resumo = EventoResumo.objects.recalcular(evento)
+            divergencias = [
+                '{}: {} -> {}'.format(campo, anterior[campo], getattr(resumo, campo))
+                for campo in EventoResumo.CONTADORES if anterior and anterior[campo] != getattr(resumo, campo)
+            ]
+            self.stdout.write('{}: {}'.format(evento, ', '.join(divergencias) if divergencias else 'sem divergências'))
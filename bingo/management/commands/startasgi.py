@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from api.management.commands.startserver import StandaloneApplication
+
+
+class Command(BaseCommand):
+    help = 'Inicia o servidor ASGI (gunicorn com workers uvicorn), usado pelas views assíncronas'
+
+    def handle(self, *args, **options):
+        call_command('sync')
+        call_command('collectstatic', verbosity=0, interactive=False)
+        options = settings.GUNICORN_ASGI
+        print('Starting gunicorn with options {}'.format(options))
+        StandaloneApplication('bingo.asgi:application', options).run()
@@ -1,15 +1,227 @@
 import os
+import hmac
+import time
+import asyncio
+import weakref
+import hashlib
+import random
+import threading
+import requests
 import mercadopago
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from mercadopago.http import HttpClient
 from django.core.cache import cache
 from django.conf import settings
+from django.utils import timezone
+
+
+URL_API = 'https://api.mercadopago.com'
+
+
+class MercadoPagoIndisponivel(Exception):
+    pass
+
+
+def formatar_data(data_hora):
+    # a API exige o deslocamento UTC; com USE_TZ=False as datas do Django são locais (TIME_ZONE) e sem fuso
+    if timezone.is_naive(data_hora):
+        data_hora = timezone.make_aware(data_hora)
+    return data_hora.isoformat(timespec='milliseconds')
+
+
+class ClienteBase:
+    # configuração, métricas e circuit breaker comuns aos clientes síncrono e assíncrono
+
+    STATUS_REPETIR = 429, 500, 502, 503, 504
+
+    def __init__(self):
+        self.url = os.environ.get('MERCADO_PAGO_URL', URL_API).rstrip('/')
+        self.timeout = (
+            float(os.environ.get('MERCADO_PAGO_CONNECT_TIMEOUT', 3.05)),
+            float(os.environ.get('MERCADO_PAGO_READ_TIMEOUT', 10))
+        )
+        self.tentativas = int(os.environ.get('MERCADO_PAGO_TENTATIVAS', 3))
+        self.espera = float(os.environ.get('MERCADO_PAGO_ESPERA', 0.2))
+        self.limite_falhas = int(os.environ.get('MERCADO_PAGO_LIMITE_FALHAS', 5))
+        self.intervalo_circuito = float(os.environ.get('MERCADO_PAGO_INTERVALO_CIRCUITO', 30))
+        self.conexoes = int(os.environ.get('MERCADO_PAGO_CONEXOES', 20))
+        self.lock = threading.Lock()
+        self.falhas = 0
+        self.aberto_ate = 0
+        # prazo da requisição de teste do circuito meio-aberto; vencido, outra requisição pode testar
+        self.sonda_ate = 0
+        self.metricas = dict(requisicoes=0, erros=0, tentativas=0, rejeitadas=0, segundos=0.0)
+
+    def get_metricas(self):
+        with self.lock:
+            metricas = dict(self.metricas)
+            metricas['circuito_aberto'] = self.aberto_ate > time.monotonic()
+        metricas['latencia_media'] = metricas['segundos'] / metricas['requisicoes'] if metricas['requisicoes'] else 0
+        return metricas
+
+    def registrar(self, segundos, erro):
+        with self.lock:
+            self.metricas['requisicoes'] += 1
+            self.metricas['segundos'] += segundos
+            if erro:
+                self.metricas['erros'] += 1
+                self.falhas += 1
+                # a falha da requisição de teste reabre o circuito por mais um intervalo
+                if self.falhas >= self.limite_falhas or self.sonda_ate:
+                    self.aberto_ate = time.monotonic() + self.intervalo_circuito
+            else:
+                self.falhas = 0
+                self.aberto_ate = 0
+            self.sonda_ate = 0
+
+    def verificar_circuito(self):
+        with self.lock:
+            if not self.aberto_ate:
+                return
+            agora = time.monotonic()
+            # após o intervalo, uma única requisição de teste é liberada (meio-aberto); as demais são rejeitadas até
+            # que o resultado dela feche ou reabra o circuito
+            if self.aberto_ate <= agora and self.sonda_ate <= agora:
+                self.sonda_ate = agora + self.intervalo_circuito
+                return
+            self.metricas['rejeitadas'] += 1
+            raise MercadoPagoIndisponivel('Mercado Pago temporariamente indisponível')
+
+    def get_espera(self, tentativa):
+        with self.lock:
+            self.metricas['tentativas'] += 1
+        return random.uniform(0, self.espera * 2 ** (tentativa - 1))
+
+    @staticmethod
+    def converter(response):
+        if response is None:
+            raise MercadoPagoIndisponivel('Falha de comunicação com o Mercado Pago')
+        try:
+            return dict(status=response.status_code, response=response.json() if response.content else None)
+        except ValueError:
+            return dict(status=response.status_code, response=None)
+
+
+class ClienteHttp(ClienteBase, HttpClient):
+    # cliente HTTP compartilhado pelo processo, usado como http_client do SDK do Mercado Pago
+
+    def __init__(self):
+        super().__init__()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.conexoes, pool_maxsize=self.conexoes, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        url = url.replace(URL_API, self.url, 1)
+        for tentativa in range(1, self.tentativas + 1):
+            self.verificar_circuito()
+            inicio = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                erro = response.status_code in self.STATUS_REPETIR
+            except requests.ConnectionError:
+                # a requisição não chegou ao servidor, então pode ser repetida mesmo em um POST
+                response, erro = None, True
+            except requests.Timeout:
+                if method != 'GET':
+                    self.registrar(time.monotonic() - inicio, True)
+                    raise
+                response, erro = None, True
+            self.registrar(time.monotonic() - inicio, erro)
+            if not erro or tentativa == self.tentativas or (response is not None and method != 'GET'):
+                break
+            time.sleep(self.get_espera(tentativa))
+        return self.converter(response)
+
+    # timeout, maxretries e demais opções enviadas pelo SDK são ignoradas em favor da configuração do cliente
+    def get(self, url, headers=None, params=None, **kwargs):
+        return self.request('GET', url, headers=headers, params=params)
+
+    def post(self, url, headers=None, data=None, params=None, **kwargs):
+        return self.request('POST', url, data=data, headers=headers, params=params)
+
+    def put(self, url, headers=None, data=None, params=None, **kwargs):
+        return self.request('PUT', url, data=data, headers=headers, params=params)
+
+    def delete(self, url, headers=None, params=None, **kwargs):
+        return self.request('DELETE', url, headers=headers, params=params)
+
+
+class ClienteHttpAssincrono(ClienteBase):
+    # mesmo comportamento do ClienteHttp, com um pool httpx por event loop; a chamada aguarda sem ocupar uma thread
+
+    def __init__(self):
+        import httpx
+        super().__init__()
+        self.httpx = httpx
+        self.client = httpx.AsyncClient(
+            base_url=self.url, timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+            limits=httpx.Limits(max_connections=self.conexoes, max_keepalive_connections=self.conexoes)
+        )
+
+    async def request(self, method, uri, **kwargs):
+        for tentativa in range(1, self.tentativas + 1):
+            self.verificar_circuito()
+            inicio = time.monotonic()
+            try:
+                response = await self.client.request(method, uri, **kwargs)
+                erro = response.status_code in self.STATUS_REPETIR
+            except (self.httpx.ConnectError, self.httpx.ConnectTimeout):
+                response, erro = None, True
+            except self.httpx.TimeoutException:
+                if method != 'GET':
+                    self.registrar(time.monotonic() - inicio, True)
+                    raise
+                response, erro = None, True
+            self.registrar(time.monotonic() - inicio, erro)
+            if not erro or tentativa == self.tentativas or (response is not None and method != 'GET'):
+                break
+            await asyncio.sleep(self.get_espera(tentativa))
+        return self.converter(response)
+
+
+_cliente = None
+_sdks = {}
+_clientes_assincronos = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def get_cliente():
+    global _cliente
+    with _lock:
+        if _cliente is None:
+            _cliente = ClienteHttp()
+        return _cliente
+
+
+def get_cliente_assincrono():
+    loop = asyncio.get_running_loop()
+    with _lock:
+        if loop not in _clientes_assincronos:
+            _clientes_assincronos[loop] = ClienteHttpAssincrono()
+        return _clientes_assincronos[loop]
+
+
+def get_sdk(token):
+    cliente = get_cliente()
+    with _lock:
+        if token not in _sdks:
+            _sdks[token] = mercadopago.SDK(token, http_client=cliente)
+        return _sdks[token]
 
 
 class MercadoPago():
     def __init__(self):
-        self.mock = False
+        # MERCADO_PAGO_MOCK=1 simula as respostas da API, usado nos testes de carga
+        self.mock = os.environ.get('MERCADO_PAGO_MOCK') == '1'
         self.token = os.environ.get('TOKEN_MERCADO_PAGO')
 
+    @property
+    def sdk(self):
+        return get_sdk(self.token)
+
     def realizar_cobranca_pix(self, nome, cpf, descricao, valor, email):
         data = {
             "transaction_amount": 1.0 if self.mock else float(valor),
@@ -35,8 +247,7 @@ class MercadoPago():
 
             return data
         else:
-            sdk = mercadopago.SDK(self.token)
-            api = sdk.payment()
+            api = self.sdk.payment()
             response = api.create(data)
             status = response["status"]
             identifier = response["response"]["id"]
@@ -49,8 +260,7 @@ class MercadoPago():
         if self.mock:
             return 'approved' if datetime.now().minute > data_hora.minute else 'pending'
         else:
-            sdk = mercadopago.SDK(self.token)
-            api = sdk.payment()
+            api = self.sdk.payment()
             status = api.get(identificador)['response']['status']
             return status
 
@@ -58,16 +268,83 @@ class MercadoPago():
         if self.mock:
             return 'approved' if datetime.now().minute > data_hora.minute else 'pending'
         else:
-            sdk = mercadopago.SDK(self.token)
-            api = sdk.payment()
-            filters = dict(sort='date_created', criteria='desc', external_reference=referencia, range='date_created', begin_date='NOW-2DAYS', end_date='NOW')
-            dados = api.search(filters=filters)
+            api = self.sdk.payment()
+            dados = api.search(filters=self.get_filtros_consulta(referencia))
             for resultado in dados['response']['results']:
                 return resultado['status']
 
-    def realizar_checkout_pro(self, nome, cpf, descricao, valor, email, ref, callback):
+    async def aconsultar_pagamento(self, referencia, data_hora):
+        if self.mock:
+            return 'approved' if datetime.now().minute > data_hora.minute else 'pending'
+        dados = await get_cliente_assincrono().request(
+            'GET', '/v1/payments/search', params=self.get_filtros_consulta(referencia), headers=self.get_cabecalhos()
+        )
+        if dados['status'] != 200:
+            raise MercadoPagoIndisponivel('Falha na consulta do pagamento ({})'.format(dados['status']))
+        for resultado in dados['response']['results']:
+            return resultado['status']
+
+    @staticmethod
+    def get_filtros_consulta(referencia):
+        return dict(sort='date_created', criteria='desc', external_reference=referencia, range='date_created', begin_date='NOW-2DAYS', end_date='NOW')
+
+    def get_cabecalhos(self):
+        return {'Authorization': 'Bearer {}'.format(self.token), 'Content-Type': 'application/json'}
+
+    def buscar_pagamentos(self, inicio, fim, offset=0, limite=100):
+        # busca por intervalo de datas, usada na conciliação em lote; retorna os resultados e o total disponível
+        filters = dict(
+            sort='date_created', criteria='desc', range='date_created', offset=offset, limit=limite,
+            begin_date=formatar_data(inicio), end_date=formatar_data(fim)
+        )
+        dados = self.sdk.payment().search(filters=filters)
+        if dados['status'] != 200:
+            raise MercadoPagoIndisponivel('Falha na busca de pagamentos ({})'.format(dados['status']))
+        resultados = dados['response'].get('results', [])
+        return resultados, dados['response'].get('paging', {}).get('total', len(resultados))
+
+    def consultar_pagamento_id(self, identificador):
+        if self.mock:
+            return None
+        dados = self.sdk.payment().get(identificador)
+        if dados['status'] == 200:
+            return dict(status=dados['response']['status'], referencia=dados['response'].get('external_reference'))
+
+    @staticmethod
+    def verificar_assinatura(assinatura, requisicao, identificador):
+        # valida o cabeçalho x-signature das notificações (webhooks); sem a chave secreta configurada as notificações
+        # são recusadas, a menos que MERCADO_PAGO_WEBHOOK_INSEGURO=1 (desenvolvimento), pois cada uma gera uma consulta à API
+        segredo = os.environ.get('MERCADO_PAGO_SEGREDO_WEBHOOK')
+        if not segredo:
+            return os.environ.get('MERCADO_PAGO_WEBHOOK_INSEGURO') == '1'
+        partes = dict(parte.strip().split('=', 1) for parte in (assinatura or '').split(',') if '=' in parte)
+        if 'ts' not in partes or 'v1' not in partes:
+            return False
+        manifesto = 'id:{};request-id:{};ts:{};'.format(str(identificador).lower(), requisicao or '', partes['ts'])
+        esperado = hmac.new(segredo.encode(), manifesto.encode(), hashlib.sha256).hexdigest()
+        return hmac.compare_digest(esperado, partes['v1'])
+
+    def realizar_checkout_pro(self, nome, cpf, descricao, valor, email, ref, callback, notificacao=None):
+        if self.mock:
+            return dict(ref=ref, url='https://mercadopago.com.br')
+        preference_data = self.get_dados_checkout(nome, cpf, descricao, valor, email, ref, callback, notificacao)
+        preference_response = self.sdk.preference().create(preference_data)
+        preference = preference_response["response"]
+        return dict(ref=ref, url=preference['init_point'])
+
+    async def arealizar_checkout_pro(self, nome, cpf, descricao, valor, email, ref, callback, notificacao=None):
         if self.mock:
             return dict(ref=ref, url='https://mercadopago.com.br')
+        dados = await get_cliente_assincrono().request(
+            'POST', '/checkout/preferences', headers=self.get_cabecalhos(),
+            json=self.get_dados_checkout(nome, cpf, descricao, valor, email, ref, callback, notificacao)
+        )
+        if dados['status'] not in (200, 201):
+            raise MercadoPagoIndisponivel('Falha na criação do checkout ({})'.format(dados['status']))
+        return dict(ref=ref, url=dados['response']['init_point'])
+
+    @staticmethod
+    def get_dados_checkout(nome, cpf, descricao, valor, email, ref, callback, notificacao=None):
         preference_data = {
             "items": [
                 {
@@ -83,7 +360,7 @@ class MercadoPago():
                 "email": email,
                 "identification": {
                     "type": "CPF",
-                    "number": cpf.replace('.', '').replace('-', '')
+                    "number": cpf
                 }
             },
             "back_urls": {
@@ -95,8 +372,6 @@ class MercadoPago():
             "statement_descriptor": "Pagamento Online",
             "external_reference": ref,
         }
-
-        sdk = mercadopago.SDK(self.token)
-        preference_response = sdk.preference().create(preference_data)
-        preference = preference_response["response"]
-        return dict(ref=ref, url=preference['init_point'])
+        if notificacao:
+            preference_data["notification_url"] = notificacao
+        return preference_data
@@ -0,0 +1,77 @@
+# Generated by Django 4.2.4 on 2026-10-18 09:00
+
+import api
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+import django.db.models.deletion
+
+
+def calcular_resumos(apps, schema_editor):
+    Evento = apps.get_model('bingo', 'Evento')
+    Cartela = apps.get_model('bingo', 'Cartela')
+    EventoResumo = apps.get_model('bingo', 'EventoResumo')
+    ResumoMeioPagamento = apps.get_model('bingo', 'ResumoMeioPagamento')
+    for evento in Evento.objects.all():
+        cartelas = Cartela.objects.filter(talao__evento=evento)
+        distribuida = Q(responsavel__isnull=False)
+        paga = distribuida & Q(realizou_pagamento=True)
+        valores = cartelas.aggregate(
+            total=Count('id'),
+            distribuidas=Count('id', filter=distribuida),
+            pagas=Count('id', filter=paga),
+            nao_pagas=Count('id', filter=distribuida & Q(realizou_pagamento=False)),
+            pendentes_pagamento=Count('id', filter=distribuida & Q(realizou_pagamento__isnull=True)),
+            comissao=Sum('comissao', filter=paga),
+        )
+        valores['comissao'] = valores['comissao'] or 0
+        resumo = EventoResumo.objects.create(evento=evento, **valores)
+        for meio in cartelas.filter(paga, meio_pagamento__isnull=False).values('meio_pagamento').annotate(
+                quantidade=Count('id'), comissao=Sum('comissao')).order_by():
+            ResumoMeioPagamento.objects.create(
+                resumo=resumo, meio_pagamento_id=meio['meio_pagamento'], quantidade=meio['quantidade'], comissao=meio['comissao']
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo', '0007_alter_compraonline_url'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventoResumo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total', models.IntegerField(default=0, verbose_name='Total de Cartelas')),
+                ('distribuidas', models.IntegerField(default=0, verbose_name='Cartelas Distribuídas')),
+                ('pagas', models.IntegerField(default=0, verbose_name='Cartelas Pagas')),
+                ('nao_pagas', models.IntegerField(default=0, verbose_name='Cartelas não Pagas')),
+                ('pendentes_pagamento', models.IntegerField(default=0, verbose_name='Cartelas Pendentes de Pagamento')),
+                ('comissao', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Total de Comissão')),
+                ('evento', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='resumo', to='bingo.evento', verbose_name='Evento')),
+            ],
+            options={
+                'verbose_name': 'Resumo do Evento',
+                'verbose_name_plural': 'Resumos dos Eventos',
+            },
+            bases=(models.Model, api.ModelMixin),
+        ),
+        migrations.CreateModel(
+            name='ResumoMeioPagamento',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantidade', models.IntegerField(default=0, verbose_name='Quantidade')),
+                ('comissao', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Comissão')),
+                ('meio_pagamento', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bingo.meiopagamento', verbose_name='Meio de Pagamento')),
+                ('resumo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bingo.eventoresumo', verbose_name='Resumo')),
+            ],
+            options={
+                'verbose_name': 'Resumo por Meio de Pagamento',
+                'verbose_name_plural': 'Resumos por Meio de Pagamento',
+                'unique_together': {('resumo', 'meio_pagamento')},
+            },
+            bases=(models.Model, api.ModelMixin),
+        ),
+        migrations.RunPython(calcular_resumos, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.4 on 2026-10-18 10:00
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def preencher_evento(apps, schema_editor):
+    Cartela = apps.get_model('bingo', 'Cartela')
+    Talao = apps.get_model('bingo', 'Talao')
+    Cartela.objects.update(evento=Subquery(Talao.objects.filter(pk=OuterRef('talao')).values('evento')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo', '0008_eventoresumo_resumomeiopagamento'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cartela',
+            name='evento',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='bingo.evento', verbose_name='Evento'),
+        ),
+        migrations.RunPython(preencher_evento, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='cartela',
+            name='evento',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bingo.evento', verbose_name='Evento'),
+        ),
+        # os números com zeros à esquerda ('00042') são convertidos para inteiro (42) na alteração do tipo da coluna
+        migrations.AlterField(
+            model_name='cartela',
+            name='numero',
+            field=models.IntegerField(verbose_name='Número'),
+        ),
+        migrations.AddIndex(
+            model_name='cartela',
+            index=models.Index(fields=['evento', 'numero'], name='cartela_evento_numero_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cartela',
+            index=models.Index(fields=['evento', 'responsavel'], name='cartela_evento_resp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cartela',
+            index=models.Index(fields=['evento', 'realizou_pagamento'], name='cartela_evento_pgto_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.4 on 2026-10-18 11:00
+
+import api
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo', '0009_cartela_evento_alter_cartela_numero_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificacaoPagamento',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pagamento', models.CharField(max_length=50, verbose_name='Pagamento')),
+                ('status', models.CharField(max_length=25, verbose_name='Status')),
+                ('referencia', models.CharField(blank=True, max_length=100, null=True, verbose_name='Referência')),
+                ('data_hora', models.DateTimeField(auto_now_add=True, verbose_name='Data/Hora')),
+            ],
+            options={
+                'verbose_name': 'Notificação de Pagamento',
+                'verbose_name_plural': 'Notificações de Pagamento',
+                'unique_together': {('pagamento', 'status')},
+            },
+            bases=(models.Model, api.ModelMixin),
+        ),
+    ]
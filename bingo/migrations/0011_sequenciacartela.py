@@ -0,0 +1,29 @@
+# Generated by Django 4.2.4 on 2026-10-18 12:00
+
+import api
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo', '0010_notificacaopagamento'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SequenciaCartela',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ultimo', models.IntegerField(default=0, verbose_name='Último Número')),
+                ('evento', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='bingo.evento', verbose_name='Evento')),
+                ('talao', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bingo.talao', verbose_name='Talão')),
+            ],
+            options={
+                'verbose_name': 'Sequência de Cartelas',
+                'verbose_name_plural': 'Sequências de Cartelas',
+            },
+            bases=(models.Model, api.ModelMixin),
+        ),
+    ]
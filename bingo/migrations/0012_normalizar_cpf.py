@@ -0,0 +1,51 @@
+# Generated by Django 4.2.4 on 2026-10-18 12:00
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def normalizar_cpf(apps, schema_editor):
+    Pessoa = apps.get_model('bingo', 'Pessoa')
+    CompraOnline = apps.get_model('bingo', 'CompraOnline')
+    User = apps.get_model('auth', 'User')
+    Role = apps.get_model('api', 'Role')
+    usernames = {}
+    for modelo in (Pessoa, CompraOnline):
+        alterados = []
+        for objeto in modelo.objects.filter(cpf__isnull=False).exclude(cpf__regex=r'^[0-9]*$').only('pk', 'cpf').iterator():
+            cpf = ''.join(caractere for caractere in objeto.cpf if caractere.isdigit())
+            if modelo is Pessoa:
+                usernames[objeto.cpf] = cpf
+            objeto.cpf = cpf
+            alterados.append(objeto)
+        modelo.objects.bulk_update(alterados, ['cpf'], batch_size=1000)
+    # os papéis usam o CPF da pessoa como username (pessoa__cpf, operadores__cpf)
+    for antigo, novo in usernames.items():
+        if not User.objects.filter(username=novo).exists():
+            User.objects.filter(username=antigo).update(username=novo)
+        Role.objects.filter(username=antigo).update(username=novo)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0004_role_delete_scope'),
+        ('bingo', '0011_sequenciacartela'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalizar_cpf, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='pessoa',
+            index=models.Index(fields=['cpf'], name='pessoa_cpf_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='compraonline',
+            index=models.Index(fields=['cpf'], name='compraonline_cpf_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='compraonline',
+            index=models.Index(fields=['uuid'], name='compraonline_uuid_idx'),
+        ),
+    ]
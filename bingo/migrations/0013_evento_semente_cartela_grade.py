@@ -0,0 +1,43 @@
+# Generated by Django 4.2.4 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import bingo.grades
+
+
+def gerar_grades(apps, schema_editor):
+    Evento = apps.get_model('bingo', 'Evento')
+    Cartela = apps.get_model('bingo', 'Cartela')
+    for evento in Evento.objects.all():
+        # cada evento existente recebe a própria semente (o default do campo é avaliado uma só vez)
+        evento.semente = bingo.grades.gerar_semente()
+        evento.save(update_fields=['semente'])
+        cartelas = list(Cartela.objects.filter(evento=evento).order_by('numero').only('pk', 'numero'))
+        grades = bingo.grades.empacotar(bingo.grades.gerar_unicas(evento.semente, [cartela.numero for cartela in cartelas]))
+        for cartela, grade in zip(cartelas, grades):
+            cartela.grade = grade
+        Cartela.objects.bulk_update(cartelas, ['grade'], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo', '0012_normalizar_cpf'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='evento',
+            name='semente',
+            field=models.BigIntegerField(default=bingo.grades.gerar_semente, editable=False, verbose_name='Semente'),
+        ),
+        migrations.AddField(
+            model_name='cartela',
+            name='grade',
+            field=models.BinaryField(editable=False, max_length=10, null=True, verbose_name='Grade'),
+        ),
+        migrations.RunPython(gerar_grades, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartela',
+            constraint=models.UniqueConstraint(fields=('evento', 'grade'), name='cartela_evento_grade_uniq'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.4 on 2026-10-18 12:00
+
+import api
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo', '0013_evento_semente_cartela_grade'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Sorteio',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('inicio', models.DateTimeField(auto_now_add=True, verbose_name='Início')),
+                ('fim', models.DateTimeField(blank=True, null=True, verbose_name='Fim')),
+                ('numeros', models.CharField(blank=True, default='', max_length=225, verbose_name='Números Sorteados')),
+                ('evento', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bingo.evento', verbose_name='Evento')),
+            ],
+            options={
+                'verbose_name': 'Sorteio',
+                'verbose_name_plural': 'Sorteios',
+            },
+            bases=(models.Model, api.ModelMixin),
+        ),
+        migrations.CreateModel(
+            name='Ganhador',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.CharField(choices=[('linha', 'Linha'), ('cheia', 'Cartela Cheia')], max_length=10, verbose_name='Tipo')),
+                ('numero', models.IntegerField(verbose_name='Número Sorteado')),
+                ('ordem', models.IntegerField(verbose_name='Ordem da Bola')),
+                ('cartela', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bingo.cartela', verbose_name='Cartela')),
+                ('sorteio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bingo.sorteio', verbose_name='Sorteio')),
+            ],
+            options={
+                'verbose_name': 'Ganhador',
+                'verbose_name_plural': 'Ganhadores',
+            },
+            bases=(models.Model, api.ModelMixin),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bingo', '0014_sorteio_ganhador'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='eventoresumo',
+            name='versao_pagas',
+            field=models.IntegerField(default=0, verbose_name='Versão das Cartelas Pagas'),
+        ),
+    ]
@@ -1,7 +1,20 @@
 import os
-from django.db import models
+import secrets
+from decimal import Decimal
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Case, Count, ExpressionWrapper, F, Max, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from api.components import Progress, Status, QrCode, Link, Map, Steps
 from .mercadopago import MercadoPago
+from .cache import compras, compras_cpf
+from .grades import gerar_semente, gerar_unicas, empacotar, desempacotar, carregar
+from .apuracao import apurar, descartar
+from . import monitoramento
 from uuid import uuid1
 
 
@@ -25,6 +38,11 @@ class MeioPagamento(models.Model):
         return user.is_superuser or user.roles.contains('adm')
 
 
+def normalizar_cpf(cpf):
+    # o CPF é gravado só com os dígitos, o que permite buscas indexadas com qualquer pontuação na entrada
+    return ''.join(caractere for caractere in cpf if caractere.isdigit()) if cpf else cpf
+
+
 class PessoaManager(models.QuerySet):
     pass
 
@@ -40,13 +58,20 @@ class Pessoa(models.Model):
     class Meta:
         verbose_name = 'Pessoa'
         verbose_name_plural = 'Pessoas'
+        indexes = [
+            models.Index(fields=['cpf'], name='pessoa_cpf_idx'),
+        ]
 
     def __str__(self):
         return '{} ({})'.format(self.nome, self.cpf) if self.cpf else self.nome
 
+    def save(self, *args, **kwargs):
+        # o CPF também é o username dos papéis (pessoa__cpf, operadores__cpf)
+        self.cpf = normalizar_cpf(self.cpf)
+        super().save(*args, **kwargs)
+
     def get_cartelas(self):
-        qs = Cartela.objects
-        return qs.filter(responsavel=self) | qs.filter(posse=self)
+        return Cartela.objects.envolvendo(self).com_situacao().com_relacionados()
 
     def get_mapa(self):
         return Map(-5.8496847,-35.2038551)
@@ -91,6 +116,7 @@ class Evento(models.Model):
     qtd_cartela_talao = models.IntegerField('Quantidade de Cartela por Talão')
     valor_venda_cartela = models.DecimalField('Valor de Venda da Cartela', decimal_places=2, max_digits=9)
     valor_comissao_cartela = models.DecimalField('Valor Máximo da Comissão por Cartela', decimal_places=2, max_digits=9)
+    semente = models.BigIntegerField('Semente', default=gerar_semente, editable=False)
 
     objects = EventoManager()
 
@@ -101,59 +127,280 @@ class Evento(models.Model):
     def __str__(self):
         return self.nome
 
+    def refresh_from_db(self, *args, **kwargs):
+        self._resumo = None
+        super().refresh_from_db(*args, **kwargs)
 
     def get_valor_liquido_cartela(self):
         return self.valor_venda_cartela - self.valor_comissao_cartela
 
     def get_cartelas(self):
-        return Cartela.objects.filter(talao__evento=self)
+        return Cartela.objects.filter(evento=self).com_situacao()
 
     def get_cartelas_distribuidas(self):
-        return self.get_cartelas().filter(responsavel__isnull=False)
+        return Cartela.objects.filter(evento=self, responsavel__isnull=False)
+
+    def get_sorteios(self):
+        return self.sorteio_set.order_by('-inicio')
+
+    def calcular_resumo(self):
+        # todos os contadores e somas do evento numa única consulta
+        distribuida = Q(responsavel__isnull=False)
+        paga = distribuida & Q(realizou_pagamento=True)
+        # a reserva de cartelas online ainda não vendidas fica fora do total
+        talao_reserva = Coalesce(Subquery(SequenciaCartela.objects.filter(evento=self).values('talao')[:1]), 0)
+        resumo = Cartela.objects.filter(evento=self).aggregate(
+            total=Count('id', filter=~Q(responsavel__isnull=True, talao=talao_reserva)),
+            distribuidas=Count('id', filter=distribuida),
+            pagas=Count('id', filter=paga),
+            nao_pagas=Count('id', filter=distribuida & Q(realizou_pagamento=False)),
+            pendentes_pagamento=Count('id', filter=distribuida & Q(realizou_pagamento__isnull=True)),
+            comissao=Sum('comissao', filter=paga),
+        )
+        resumo['comissao'] = resumo['comissao'] or Decimal(0)
+        return resumo
+
+    def get_resumo(self):
+        # lê os contadores mantidos em EventoResumo, memorizados na instância
+        if getattr(self, '_resumo', None) is None:
+            resumo = EventoResumo.objects.filter(evento=self).first() or EventoResumo.objects.recalcular(self)
+            self._resumo = {campo: getattr(resumo, campo) for campo in EventoResumo.CONTADORES}
+        return self._resumo
+
+    def get_resumo_meio_pagamento(self):
+        return ResumoMeioPagamento.objects.filter(resumo__evento=self).select_related('meio_pagamento', 'resumo__evento').order_by('meio_pagamento__nome')
 
     def get_total_taloes(self):
         return self.get_total_cartelas() // self.qtd_cartela_talao
 
     def get_percentual_cartela_distribuida(self):
-        return Progress(100 * self.get_cartelas_distribuidas().count() / self.get_total_cartelas())
+        total = self.get_total_cartelas()
+        return Progress(100 * self.get_resumo()['distribuidas'] / total if total else 0)
 
     def get_percentual_cartela_paga(self):
-        return Progress(100 * self.get_cartelas_distribuidas().filter(realizou_pagamento=True).count() / self.get_total_cartelas())
+        total = self.get_total_cartelas()
+        return Progress(100 * self.get_resumo()['pagas'] / total if total else 0)
 
     def get_total_cartelas_distribuidas(self):
-        return self.get_cartelas_distribuidas().count()
+        return self.get_resumo()['distribuidas']
 
     def get_receita_esperada(self):
-        return self.get_cartelas_distribuidas().count() * self.get_valor_liquido_cartela()
+        return self.get_resumo()['distribuidas'] * self.get_valor_liquido_cartela()
 
     def get_valor_recebido_venda(self):
-        return self.get_cartelas_distribuidas().filter(realizou_pagamento=True).count() * self.get_valor_liquido_cartela()
+        return self.get_resumo()['pagas'] * self.get_valor_liquido_cartela()
 
     def get_valor_recebido_doacao(self):
-        qs = self.get_cartelas_distribuidas().filter(realizou_pagamento=True)
-        return qs.count() * self.valor_comissao_cartela - qs.sum('comissao')
+        resumo = self.get_resumo()
+        return resumo['pagas'] * self.valor_comissao_cartela - resumo['comissao']
 
     def get_valor_receber(self):
         return self.get_receita_esperada() - self.get_valor_recebido_venda()
 
     def get_valor_perdido(self):
-        return self.get_cartelas().filter(responsavel__isnull=False, realizou_pagamento=False).count() * self.get_valor_liquido_cartela()
+        return self.get_resumo()['nao_pagas'] * self.get_valor_liquido_cartela()
 
     def get_receita_final(self):
         return self.get_valor_recebido_venda() + self.get_valor_recebido_doacao()
 
     def get_total_cartelas(self):
-        return self.get_cartelas().count()
-
-    def gerar_cartelas_online(self, numero_cartelas):
-        cartelas = []
-        talao = Talao.objects.get_or_create(numero='000', evento=self)[0]
-        total = talao.cartela_set.count()
-        for numero_cartela in range(total, total+numero_cartelas):
-            cartelas.append(Cartela.objects.create(numero=f'{numero_cartela+1}'.rjust(5, '0'), talao=talao))
+        return self.get_resumo()['total']
+
+    def get_monitoramento(self):
+        # estado inicial dos painéis abertos, que depois recebem só as variações (ver EventoResumoManager.registrar)
+        return dict(self.get_resumo(), evento=self.pk)
+
+    def get_painel_monitoramento(self):
+        # sem o ASGI o painel exibe só os percentuais atuais
+        canal = 'evento:{}'.format(self.pk)
+        url = None
+        if monitoramento.is_disponivel():
+            url = '/api/v1/assincrono/monitorar_evento/{}/?chave={}'.format(self.pk, monitoramento.assinar(canal))
+        return monitoramento.painel(
+            'bingo/monitoramento/evento.html', url, distribuida=self.get_percentual_cartela_distribuida()['value'],
+            paga=self.get_percentual_cartela_paga()['value']
+        )
+
+    def get_reserva_online(self):
+        # cartelas online já geradas e ainda não vendidas (reserva opcional, ver CARTELAS_ONLINE_RESERVA)
+        return Cartela.objects.filter(talao__sequenciacartela__evento=self, responsavel__isnull=True)
+
+    def resgatar_cartelas_online(self, quantidade, responsavel, meio_pagamento):
+        tamanho = int(os.environ.get('CARTELAS_ONLINE_RESERVA', 0))
+        if not tamanho:
+            return []
+        sequencia = SequenciaCartela.objects.filter(evento=self).first()
+        ids = []
+        if sequencia:
+            resgatar = self.resgatar_postgres if connection.vendor == 'postgresql' else self.resgatar
+            ids = resgatar(sequencia.talao_id, quantidade, responsavel, meio_pagamento)
+            # as cartelas da reserva só entram no total do evento quando são vendidas
+            EventoResumo.objects.registrar([(self.pk, True, True, meio_pagamento, len(ids), 0, 1)], total={self.pk: len(ids)})
+        minimo = int(os.environ.get('CARTELAS_ONLINE_RESERVA_MINIMA', tamanho // 4))
+        if sequencia is None or self.get_reserva_online().count() < minimo:
+            from . import tasks
+            tasks.executar(tasks.preencher_reserva_online, self.pk)
+        return ids
+
+    def resgatar_postgres(self, talao, quantidade, responsavel, meio_pagamento):
+        sql = '''
+            UPDATE {tabela} SET responsavel_id = %(responsavel)s, meio_pagamento_id = %(meio_pagamento)s,
+            realizou_pagamento = true, comissao = 0
+            WHERE id IN (
+                SELECT id FROM {tabela} WHERE talao_id = %(talao)s AND responsavel_id IS NULL
+                ORDER BY numero LIMIT %(quantidade)s FOR UPDATE SKIP LOCKED
+            ) RETURNING id
+        '''.format(tabela=connection.ops.quote_name(Cartela._meta.db_table))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, dict(responsavel=responsavel, meio_pagamento=meio_pagamento, talao=talao, quantidade=quantidade))
+            return [row[0] for row in cursor.fetchall()]
+
+    def resgatar(self, talao, quantidade, responsavel, meio_pagamento):
+        with transaction.atomic():
+            ids = list(Cartela.objects.filter(talao=talao, responsavel__isnull=True).order_by(
+                'numero').select_for_update(skip_locked=True).values_list('pk', flat=True)[:quantidade])
+            Cartela.objects.filter(pk__in=ids).update(
+                responsavel=responsavel, meio_pagamento=meio_pagamento, realizou_pagamento=True, comissao=0
+            )
+        return ids
+
+    def gerar_grades(self, numeros):
+        # as grades repetidas são comparadas com as já gravadas pelo índice único (evento, grade)
+        return empacotar(gerar_unicas(self.semente, numeros, lambda grades: Cartela.objects.filter(
+            evento=self, grade__in=grades
+        ).values_list('grade', flat=True)))
+
+    def gerar_cartelas_online(self, numero_cartelas, **valores):
+        # os números são reservados em bloco de forma atômica, então compras simultâneas não geram números repetidos
+        with transaction.atomic():
+            sequencia, numeros = SequenciaCartela.objects.reservar(self, numero_cartelas)
+            cartelas = Cartela.objects.bulk_create([
+                Cartela(numero=numero, talao_id=sequencia.talao_id, evento=self, grade=grade, **valores)
+                for numero, grade in zip(numeros, self.gerar_grades(numeros))
+            ])
+            cartela = cartelas[0] if cartelas else Cartela()
+            # as cartelas geradas para a reserva (sem responsável) ficam fora do total até serem vendidas
+            EventoResumo.objects.registrar(
+                [(self.pk, *cartela.get_estado()[:3], len(cartelas), cartela.comissao * len(cartelas), 1)],
+                total={self.pk: len(cartelas)} if cartela.responsavel_id else None
+            )
         return cartelas
 
 
+class EventoResumoManager(models.Manager):
+
+    def recalcular(self, evento):
+        with transaction.atomic():
+            self.get_or_create(evento=evento)
+            resumo = self.select_for_update().get(evento=evento)
+            for campo, valor in evento.calcular_resumo().items():
+                setattr(resumo, campo, valor)
+            resumo.versao_pagas += 1
+            resumo.save()
+            resumo.resumomeiopagamento_set.all().delete()
+            ResumoMeioPagamento.objects.bulk_create([
+                ResumoMeioPagamento(resumo=resumo, meio_pagamento_id=meio['meio_pagamento'], quantidade=meio['quantidade'], comissao=meio['comissao'])
+                for meio in Cartela.objects.filter(evento=evento).pagas().filter(meio_pagamento__isnull=False).values(
+                    'meio_pagamento').annotate(quantidade=Count('id'), comissao=Sum('comissao')).order_by()
+            ])
+        evento._resumo = None
+        return resumo
+
+    def registrar(self, estados=(), total=None):
+        # estados: (evento, distribuida, realizou_pagamento, meio_pagamento, quantidade, comissao, sinal)
+        # total: {evento: quantidade de cartelas criadas}
+        eventos = {}
+        meios = {}
+        for evento, quantidade in (total or {}).items():
+            eventos.setdefault(evento, dict.fromkeys(EventoResumo.CONTADORES, 0))['total'] += quantidade
+        for evento, distribuida, realizou_pagamento, meio_pagamento, quantidade, comissao, sinal in estados:
+            variacao = eventos.setdefault(evento, dict.fromkeys(EventoResumo.CONTADORES, 0))
+            quantidade, comissao = quantidade * sinal, (comissao or 0) * sinal
+            if distribuida:
+                variacao['distribuidas'] += quantidade
+                if realizou_pagamento is None:
+                    variacao['pendentes_pagamento'] += quantidade
+                elif realizou_pagamento:
+                    variacao['pagas'] += quantidade
+                    variacao['comissao'] += comissao
+                    if meio_pagamento:
+                        meio = meios.setdefault((evento, meio_pagamento), [0, 0])
+                        meio[0] += quantidade
+                        meio[1] += comissao
+                else:
+                    variacao['nao_pagas'] += quantidade
+        # eventos ainda sem resumo são ignorados, pois ele será calculado por completo no primeiro acesso
+        for evento, variacao in eventos.items():
+            variacao = {campo: valor for campo, valor in variacao.items() if valor}
+            if variacao:
+                # a versão avisa às apurações em andamento que o conjunto de cartelas pagas mudou
+                versao = dict(versao_pagas=F('versao_pagas') + 1) if 'pagas' in variacao else {}
+                self.filter(evento_id=evento).update(**{campo: F(campo) + valor for campo, valor in variacao.items()}, **versao)
+                # os painéis abertos somam as variações das quantidades ao estado que receberam ao conectar
+                quantidades = {campo: valor for campo, valor in variacao.items() if campo != 'comissao'}
+                if quantidades:
+                    monitoramento.agendar('evento:{}'.format(evento), dict(evento=evento, variacao=quantidades))
+        for (evento, meio_pagamento), (quantidade, comissao) in meios.items():
+            resumo = self.filter(evento_id=evento).values_list('pk', flat=True).first()
+            if resumo and (quantidade or comissao):
+                if not ResumoMeioPagamento.objects.filter(resumo_id=resumo, meio_pagamento_id=meio_pagamento).update(
+                        quantidade=F('quantidade') + quantidade, comissao=F('comissao') + comissao):
+                    ResumoMeioPagamento.objects.create(resumo_id=resumo, meio_pagamento_id=meio_pagamento, quantidade=quantidade, comissao=comissao)
+
+
+    def descontar(self, cartelas):
+        # retira dos contadores as cartelas que serão excluídas, já que a exclusão não passa por Cartela.save
+        reserva = Q(responsavel__isnull=True, talao__sequenciacartela__isnull=False)
+        estados, total = [], {}
+        for grupo in cartelas.agrupar_estado().annotate(contadas=Count('id', filter=~reserva)):
+            estados.append((
+                grupo['evento'], grupo['distribuida'], grupo['realizou_pagamento'], grupo['meio_pagamento'],
+                grupo['quantidade'], grupo['soma_comissao'], -1
+            ))
+            total[grupo['evento']] = total.get(grupo['evento'], 0) - grupo['contadas']
+        self.registrar(estados, total)
+
+
+class EventoResumo(models.Model):
+    evento = models.OneToOneField(Evento, verbose_name='Evento', related_name='resumo', on_delete=models.CASCADE)
+    total = models.IntegerField('Total de Cartelas', default=0)
+    distribuidas = models.IntegerField('Cartelas Distribuídas', default=0)
+    pagas = models.IntegerField('Cartelas Pagas', default=0)
+    nao_pagas = models.IntegerField('Cartelas não Pagas', default=0)
+    pendentes_pagamento = models.IntegerField('Cartelas Pendentes de Pagamento', default=0)
+    comissao = models.DecimalField('Total de Comissão', default=0, decimal_places=2, max_digits=12)
+    versao_pagas = models.IntegerField('Versão das Cartelas Pagas', default=0)
+
+    CONTADORES = 'total', 'distribuidas', 'pagas', 'nao_pagas', 'pendentes_pagamento', 'comissao'
+
+    objects = EventoResumoManager()
+
+    class Meta:
+        verbose_name = 'Resumo do Evento'
+        verbose_name_plural = 'Resumos dos Eventos'
+
+    def __str__(self):
+        return 'Resumo {}'.format(self.evento)
+
+
+class ResumoMeioPagamento(models.Model):
+    resumo = models.ForeignKey(EventoResumo, verbose_name='Resumo', on_delete=models.CASCADE)
+    meio_pagamento = models.ForeignKey(MeioPagamento, verbose_name='Meio de Pagamento', on_delete=models.CASCADE)
+    quantidade = models.IntegerField('Quantidade', default=0)
+    comissao = models.DecimalField('Comissão', default=0, decimal_places=2, max_digits=12)
+
+    class Meta:
+        verbose_name = 'Resumo por Meio de Pagamento'
+        verbose_name_plural = 'Resumos por Meio de Pagamento'
+        unique_together = ('resumo', 'meio_pagamento'),
+
+    def __str__(self):
+        return '{} - {}'.format(self.resumo, self.meio_pagamento)
+
+    def get_valor(self):
+        return self.quantidade * self.resumo.evento.get_valor_liquido_cartela()
+
+
 class TalaoManager(models.Manager):
     pass
 
@@ -174,6 +421,42 @@ class Talao(models.Model):
         return user.is_superuser or user.roles.contains('adm')
 
 
+class SequenciaCartelaManager(models.Manager):
+
+    def reservar(self, evento, quantidade):
+        with transaction.atomic():
+            # o UPDATE trava a linha do evento até o fim da transação, serializando as reservas
+            if not self.filter(evento=evento).update(ultimo=F('ultimo') + quantidade):
+                self.criar(evento)
+                self.filter(evento=evento).update(ultimo=F('ultimo') + quantidade)
+            sequencia = self.get(evento=evento)
+        return sequencia, range(sequencia.ultimo - quantidade + 1, sequencia.ultimo + 1)
+
+    def criar(self, evento):
+        try:
+            with transaction.atomic():
+                talao = Talao.objects.filter(numero='000', evento=evento).first() or Talao.objects.create(numero='000', evento=evento)
+                ultimo = Cartela.objects.filter(talao=talao).aggregate(ultimo=Max('numero'))['ultimo'] or 0
+                return self.create(evento=evento, talao=talao, ultimo=ultimo)
+        except IntegrityError:
+            return self.get(evento=evento)
+
+
+class SequenciaCartela(models.Model):
+    evento = models.OneToOneField(Evento, verbose_name='Evento', on_delete=models.CASCADE)
+    talao = models.ForeignKey(Talao, verbose_name='Talão', on_delete=models.CASCADE)
+    ultimo = models.IntegerField('Último Número', default=0)
+
+    objects = SequenciaCartelaManager()
+
+    class Meta:
+        verbose_name = 'Sequência de Cartelas'
+        verbose_name_plural = 'Sequências de Cartelas'
+
+    def __str__(self):
+        return '{} ({})'.format(self.evento, self.ultimo)
+
+
 class CartelaManager(models.QuerySet):
     def pendentes_distribuicao(self):
         return self.filter(responsavel__isnull=True)
@@ -187,28 +470,98 @@ class CartelaManager(models.QuerySet):
     def nao_pagas(self):
         return self.filter(responsavel__isnull=False, realizou_pagamento=False)
 
+    def com_situacao(self):
+        # mesma classificação de Cartela.classificar_situacao, calculada pelo banco de dados
+        return self.annotate(situacao=Case(
+            When(responsavel__isnull=True, then=Value('aguardando_distribuicao')),
+            When(realizou_pagamento__isnull=True, then=Value('aguardando_prestacao')),
+            When(realizou_pagamento=True, comissao__gt=0, then=Value('vendida_com_comissao')),
+            When(realizou_pagamento=True, then=Value('vendida_sem_comissao')),
+            default=Value('nao_paga'), output_field=models.CharField()
+        ))
+
+    def envolvendo(self, pessoa):
+        # UNION de duas buscas indexadas no lugar do OR entre responsavel e posse, que obriga a varrer a tabela
+        ids = Cartela.objects.filter(responsavel=pessoa).values('pk').union(
+            Cartela.objects.filter(posse=pessoa).values('pk')
+        )
+        return self.filter(pk__in=ids)
+
+    def com_relacionados(self):
+        return self.select_related('talao', 'responsavel', 'posse', 'meio_pagamento')
+
     def pagas_com_comissao(self):
         return self.pagas().filter(comissao__gt=0)
 
     def pagas_sem_comissao(self):
-        return self.pagas().filter(recebeu=0)
-
-    def get_valor_liquido_cartela(self):
-        return self.first().talao.evento.get_valor_liquido_cartela() if self.exists() else 0
+        return self.pagas().filter(comissao=0)
+
+    def agrupar_estado(self):
+        return self.annotate(
+            distribuida=ExpressionWrapper(Q(responsavel__isnull=False), output_field=models.BooleanField())
+        ).values('evento', 'distribuida', 'realizou_pagamento', 'meio_pagamento').annotate(
+            quantidade=Count('id'), soma_comissao=Sum('comissao')
+        ).order_by()
+
+    def delete(self):
+        with transaction.atomic():
+            EventoResumo.objects.descontar(self)
+            return super().delete()
+
+    def atualizar(self, **valores):
+        # update em lote que mantém os contadores de EventoResumo; aceita apenas valores constantes
+        with transaction.atomic():
+            antes = list(self.agrupar_estado())
+            quantidade = self.update(**valores)
+            estados = []
+            for grupo in antes:
+                depois = dict(grupo)
+                if 'responsavel' in valores:
+                    depois['distribuida'] = valores['responsavel'] is not None
+                if 'realizou_pagamento' in valores:
+                    depois['realizou_pagamento'] = valores['realizou_pagamento']
+                if 'meio_pagamento' in valores:
+                    depois['meio_pagamento'] = getattr(valores['meio_pagamento'], 'pk', valores['meio_pagamento'])
+                if 'comissao' in valores:
+                    depois['soma_comissao'] = grupo['quantidade'] * (valores['comissao'] or 0)
+                for estado, sinal in ((grupo, -1), (depois, 1)):
+                    estados.append((
+                        estado['evento'], estado['distribuida'], estado['realizou_pagamento'],
+                        estado['meio_pagamento'], estado['quantidade'], estado['soma_comissao'], sinal
+                    ))
+            EventoResumo.objects.registrar(estados)
+        return quantidade
+
+    def resumo(self):
+        # quantidades e valores das agregações da listagem numa única consulta, guardados no próprio queryset
+        if getattr(self, '_resumo', None) is None:
+            valor = F('evento__valor_venda_cartela') - F('evento__valor_comissao_cartela')
+            situacoes = dict(
+                pago=('pagas', Q(responsavel__isnull=False, realizou_pagamento=True)),
+                pendente_pagamento=('pendentes_pagamento', Q(responsavel__isnull=False, realizou_pagamento__isnull=True)),
+                nao_pago=('nao_pagas', Q(responsavel__isnull=False, realizou_pagamento=False)),
+            )
+            agregacoes = dict(total=Count('id'))
+            for nome, (quantidade, filtro) in situacoes.items():
+                agregacoes[quantidade] = Count('id', filter=filtro)
+                agregacoes['valor_{}'.format(nome)] = Sum(valor, filter=filtro, output_field=models.DecimalField())
+            self._resumo = {nome: valor or 0 for nome, valor in self.order_by().aggregate(**agregacoes).items()}
+        return self._resumo
 
     def get_valor_pago(self):
-        return self.pagas().count() * self.get_valor_liquido_cartela()
+        return self.resumo()['valor_pago']
 
     def get_valor_pendente_pagamento(self):
-        return self.pendentes_pagamento().count() * self.get_valor_liquido_cartela()
+        return self.resumo()['valor_pendente_pagamento']
 
     def get_valor_nao_pago(self):
-        return self.nao_pagas().count() * self.get_valor_liquido_cartela()
+        return self.resumo()['valor_nao_pago']
 
 
 class Cartela(models.Model):
-    numero = models.CharField('Número', max_length=255)
+    numero = models.IntegerField('Número')
     talao = models.ForeignKey(Talao, verbose_name='Talão', on_delete=models.CASCADE)
+    evento = models.ForeignKey(Evento, verbose_name='Evento', on_delete=models.CASCADE)
 
     responsavel = models.ForeignKey(Pessoa, verbose_name='Responsável', null=True, on_delete=models.CASCADE)
     realizou_pagamento = models.BooleanField('Realizou Pagamento', null=True)
@@ -216,35 +569,250 @@ class Cartela(models.Model):
     comissao = models.DecimalField('Comissão', default=0, decimal_places=2, max_digits=9)
 
     posse = models.ForeignKey(Pessoa, verbose_name='Posse', null=True, related_name='possecartela_set', blank=True, on_delete=models.CASCADE)
+    # máscara de 75 bits com os números da cartela (ver bingo.grades)
+    grade = models.BinaryField('Grade', max_length=10, null=True, editable=False)
 
     objects = CartelaManager()
 
     class Meta:
         verbose_name = 'Cartega'
         verbose_name_plural = 'Cartelas'
+        indexes = [
+            models.Index(fields=['evento', 'numero'], name='cartela_evento_numero_idx'),
+            models.Index(fields=['evento', 'responsavel'], name='cartela_evento_resp_idx'),
+            models.Index(fields=['evento', 'realizou_pagamento'], name='cartela_evento_pgto_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['evento', 'grade'], name='cartela_evento_grade_uniq'),
+        ]
 
     def __str__(self):
-        return self.numero
+        return self.formatar_numero(self.numero)
+
+    @staticmethod
+    def formatar_numero(numero):
+        return str(numero).rjust(5, '0')
+
+    def get_grade(self):
+        return desempacotar(self.grade) if self.grade else None
+
+    CAMPOS_ESTADO = 'responsavel_id', 'realizou_pagamento', 'meio_pagamento_id', 'comissao'
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        deferidos = instance.get_deferred_fields()
+        instance._estado = None if deferidos.intersection(cls.CAMPOS_ESTADO) else instance.get_estado()
+        return instance
+
+    def get_estado(self):
+        return self.responsavel_id is not None, self.realizou_pagamento, self.meio_pagamento_id, self.comissao
+
+    def save(self, *args, **kwargs):
+        antes = getattr(self, '_estado', None)
+        if antes is None and self.pk:
+            antes = Cartela.objects.filter(pk=self.pk).values_list(*self.CAMPOS_ESTADO).first()
+            antes = (antes[0] is not None, *antes[1:]) if antes else None
+        criacao = self._state.adding
+        if self.evento_id is None:
+            self.evento_id = self.talao.evento_id
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            depois = self.get_estado()
+            if criacao or antes != depois:
+                evento = self.evento_id
+                estados = [(evento, *depois[:3], 1, depois[3], 1)]
+                if antes and not criacao:
+                    estados.append((evento, *antes[:3], 1, antes[3], -1))
+                EventoResumo.objects.registrar(estados, total={evento: 1} if criacao else None)
+        self._estado = depois
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            EventoResumo.objects.descontar(Cartela.objects.filter(pk=self.pk))
+            return super().delete(*args, **kwargs)
 
     def get_evento(self):
-        return self.talao.evento
+        return self.evento
+
+    SITUACOES = {
+        'aguardando_distribuicao': ('primary', 'Aguarando Distribuição'),
+        'aguardando_prestacao': ('warning', 'Aguarando Prestação de Contas'),
+        'vendida_com_comissao': ('success', 'Vendida com Comissão'),
+        'vendida_sem_comissao': ('success', 'Vendida sem Comissão'),
+        'nao_paga': ('danger', 'Pagamento não Realizado'),
+    }
+
+    @staticmethod
+    def classificar_situacao(responsavel_id, realizou_pagamento, comissao):
+        if responsavel_id is None:
+            return 'aguardando_distribuicao'
+        elif realizou_pagamento is None:
+            return 'aguardando_prestacao'
+        elif realizou_pagamento:
+            return 'vendida_com_comissao' if comissao > 0 else 'vendida_sem_comissao'
+        else:
+            return 'nao_paga'
 
     def get_situacao(self):
-        if self.responsavel_id is None:
-            return Status('primary', 'Aguarando Distribuição')
-        elif self.realizou_pagamento is None:
-            return Status('warning', 'Aguarando Prestação de Contas')
-        elif self.realizou_pagamento:
-            if self.comissao > 0:
-                return Status('success', 'Vendida com Comissão')
-            else:
-                return Status('success', 'Vendida sem Comissão')
-        else:
-            return Status('danger', 'Pagamento não Realizado')
+        situacao = getattr(self, 'situacao', None)
+        if situacao is None:
+            situacao = self.classificar_situacao(self.responsavel_id, self.realizou_pagamento, self.comissao)
+        return Status(*self.SITUACOES[situacao])
+
+
+class SorteioManager(models.Manager):
+
+    def em_andamento(self):
+        return self.filter(fim__isnull=True)
+
+
+class Sorteio(models.Model):
+    evento = models.ForeignKey(Evento, verbose_name='Evento', on_delete=models.CASCADE)
+    inicio = models.DateTimeField('Início', auto_now_add=True)
+    fim = models.DateTimeField('Fim', null=True, blank=True)
+    # números na ordem em que foram sorteados, separados por vírgula
+    numeros = models.CharField('Números Sorteados', max_length=225, default='', blank=True)
+
+    objects = SorteioManager()
+
+    class Meta:
+        verbose_name = 'Sorteio'
+        verbose_name_plural = 'Sorteios'
+
+    def __str__(self):
+        return 'Sorteio {} de {}'.format(self.pk, self.evento)
+
+    def get_numeros(self):
+        return [int(numero) for numero in self.numeros.split(',')] if self.numeros else []
+
+    def get_numeros_sorteados(self):
+        return ', '.join(str(numero) for numero in self.get_numeros())
+
+    def get_ultimo_numero(self):
+        numeros = self.get_numeros()
+        return numeros[-1] if numeros else None
+
+    def get_ganhadores(self):
+        return self.ganhador_set.select_related('cartela').order_by('ordem', 'cartela__numero')
+
+    def get_versao_cartelas(self):
+        versao = EventoResumo.objects.filter(evento=self.evento_id).values_list('versao_pagas', flat=True).first()
+        return EventoResumo.objects.recalcular(self.evento).versao_pagas if versao is None else versao
+
+    def carregar_cartelas(self, conhecidas=None):
+        # participam da apuração as cartelas pagas do evento que têm grade; com os identificadores das cartelas já
+        # apuradas, devolve só as que passaram a participar e as que deixaram de participar do sorteio
+        cartelas = Cartela.objects.filter(evento=self.evento_id, grade__isnull=False).pagas().order_by('id')
+        removidas = ()
+        if conhecidas is not None:
+            ids = np.fromiter(cartelas.values_list('id', flat=True).iterator(10000), dtype=np.int64)
+            removidas = np.setdiff1d(conhecidas, ids)
+            cartelas = cartelas.filter(pk__in=np.setdiff1d(ids, conhecidas).tolist())
+        ids, grades = list(zip(*cartelas.values_list('id', 'grade').iterator(10000))) or ((), ())
+        return ids, carregar(grades), removidas
+
+    def sortear(self, numero=None):
+        # a linha do sorteio fica travada até o fim da transação, então as bolas são apuradas uma de cada vez;
+        # a apuração em memória é reconstruída a partir dos números gravados após um reinício ou em outro processo
+        with transaction.atomic():
+            sorteio = Sorteio.objects.select_for_update().get(pk=self.pk)
+            numeros = sorteio.get_numeros()
+            if sorteio.fim:
+                raise ValidationError('O sorteio já foi encerrado')
+            if numero is None:
+                numero = secrets.choice([numero for numero in range(1, 76) if numero not in numeros])
+            elif numero in numeros or not 1 <= numero <= 75:
+                raise ValidationError('Número inválido ou já sorteado')
+            numeros.append(numero)
+            sorteio.numeros = ','.join(str(numero) for numero in numeros)
+            try:
+                linha, cheia = apurar(self.pk, self.carregar_cartelas, numeros, self.get_versao_cartelas())[-1]
+                # cada prêmio é dos ganhadores da primeira bola que completou a linha ou a cartela
+                premios = [(Ganhador.LINHA, linha), (Ganhador.CHEIA, cheia)]
+                premiados = set(sorteio.ganhador_set.values_list('tipo', flat=True).distinct())
+                Ganhador.objects.bulk_create([
+                    Ganhador(sorteio=sorteio, cartela_id=cartela, tipo=tipo, numero=numero, ordem=len(numeros))
+                    for tipo, cartelas in premios if tipo not in premiados for cartela in cartelas
+                ])
+                if cheia:
+                    sorteio.fim = timezone.now()
+                sorteio.save(update_fields=['numeros', 'fim'])
+            except Exception:
+                descartar(self.pk)
+                raise
+        self.numeros, self.fim = sorteio.numeros, sorteio.fim
+        if self.fim:
+            descartar(self.pk)
+        return numero, linha, cheia
+
+    def encerrar(self):
+        self.fim = timezone.now()
+        self.save(update_fields=['fim'])
+        descartar(self.pk)
+
+
+class Ganhador(models.Model):
+    LINHA = 'linha'
+    CHEIA = 'cheia'
+    TIPOS = (LINHA, 'Linha'), (CHEIA, 'Cartela Cheia')
+
+    sorteio = models.ForeignKey(Sorteio, verbose_name='Sorteio', on_delete=models.CASCADE)
+    cartela = models.ForeignKey(Cartela, verbose_name='Cartela', on_delete=models.CASCADE)
+    tipo = models.CharField('Tipo', max_length=10, choices=TIPOS)
+    numero = models.IntegerField('Número Sorteado')
+    ordem = models.IntegerField('Ordem da Bola')
+
+    class Meta:
+        verbose_name = 'Ganhador'
+        verbose_name_plural = 'Ganhadores'
+
+    def __str__(self):
+        return '{} ({})'.format(self.cartela, self.get_tipo_display())
+
+
+SENTINELAS = {}
+
+
+class NotificacaoPagamento(models.Model):
+    pagamento = models.CharField('Pagamento', max_length=50)
+    status = models.CharField('Status', max_length=25)
+    referencia = models.CharField('Referência', null=True, blank=True, max_length=100)
+    data_hora = models.DateTimeField(verbose_name='Data/Hora', auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Notificação de Pagamento'
+        verbose_name_plural = 'Notificações de Pagamento'
+        unique_together = ('pagamento', 'status'),
+
+    def __str__(self):
+        return 'Pagamento {} ({})'.format(self.pagamento, self.status)
 
 
 class CompraOnlineManager(models.Manager):
-    pass
+
+    def processar_notificacao(self, pagamento):
+        # a notificação só informa o identificador do pagamento; a situação é sempre consultada na API e os reenvios
+        # de uma mesma situação são descartados pela unicidade de (pagamento, status) em NotificacaoPagamento
+        dados = MercadoPago().consultar_pagamento_id(pagamento)
+        if dados is None:
+            return None
+        with transaction.atomic():
+            criada = NotificacaoPagamento.objects.get_or_create(
+                pagamento=str(pagamento), status=dados['status'], defaults=dict(referencia=dados['referencia'])
+            )[1]
+            compra = self.filter(uuid=dados['referencia']).first() if dados['referencia'] else None
+            if compra and criada:
+                compra.registrar_status(dados['status'])
+        return compra
+
+    def get_por_uuid(self, uuid):
+        # páginas públicas: a compra é lida do cache até que a situação ou as cartelas mudem
+        return compras.get(uuid, 'compra', lambda: self.get(uuid=uuid))
+
+    def get_ids_por_cpf(self, cpf):
+        cpf = normalizar_cpf(cpf)
+        return compras_cpf.get(cpf, 'ids', lambda: list(self.filter(cpf=cpf).values_list('pk', flat=True)))
 
 
 class CompraOnline(models.Model):
@@ -267,23 +835,79 @@ class CompraOnline(models.Model):
     class Meta:
         verbose_name = 'Compra Online'
         verbose_name_plural = 'Compras Online'
+        indexes = [
+            models.Index(fields=['cpf'], name='compraonline_cpf_idx'),
+            models.Index(fields=['uuid'], name='compraonline_uuid_idx'),
+        ]
+
+    CRIANDO = 'creating'
+    FALHA = 'failed'
 
     def save(self, *args, **kwargs):
         pk = self.pk
+        self.cpf = normalizar_cpf(self.cpf)
         if pk is None:
             self.evento = Evento.objects.order_by('id').last()
             self.uuid = uuid1().hex
-            descricao = 'Compra de cartelas ({})'.format(self.numero_cartelas)
             self.valor = self.numero_cartelas * self.evento.valor_venda_cartela
-            callback = '{}/api/v1/visualizar_compra_online/?uuid={}'.format(
-                os.environ.get('SITE_URL', 'http://localhost:8000'), self.uuid
-            )
-            dados = MercadoPago().realizar_checkout_pro(
-                self.nome, self.cpf, descricao, self.valor, self.email, self.uuid, callback
-            )
-            self.uuid = dados['ref']
-            self.url = dados['url']
+            if self.status != CompraOnline.CRIANDO:
+                self.criar_checkout()
         super().save(*args, **kwargs)
+        self.invalidar_cache(pk is None)
+
+    def invalidar_cache(self, cpf=False):
+        # só depois do commit, para que uma leitura concorrente não guarde o estado anterior na versão nova
+        uuid = self.uuid
+        transaction.on_commit(lambda: compras.invalidar(uuid))
+        if cpf:
+            transaction.on_commit(lambda: compras_cpf.invalidar(self.cpf))
+        # a nova situação é enviada às páginas da compra abertas, que são recarregadas
+        monitoramento.agendar('compraonline:{}'.format(uuid), self.get_situacao_monitoramento())
+
+    def get_parametros_checkout(self):
+        descricao = 'Compra de cartelas ({})'.format(self.numero_cartelas)
+        site = os.environ.get('SITE_URL', 'http://localhost:8000')
+        callback = '{}/api/v1/visualizar_compra_online/?uuid={}'.format(site, self.uuid)
+        notificacao = '{}/api/v1/notificacao_mercado_pago/'.format(site) if os.environ.get('SITE_URL') else None
+        return self.nome, self.cpf, descricao, self.valor, self.email, self.uuid, callback, notificacao
+
+    def criar_checkout(self):
+        dados = MercadoPago().realizar_checkout_pro(*self.get_parametros_checkout())
+        self.uuid = dados['ref']
+        self.url = dados['url']
+
+    async def acriar_checkout(self):
+        dados = await MercadoPago().arealizar_checkout_pro(*self.get_parametros_checkout())
+        self.uuid = dados['ref']
+        self.url = dados['url']
+
+    def concluir_checkout(self):
+        # executado em segundo plano para as compras registradas com a situação "creating"
+        try:
+            self.criar_checkout()
+            self.status = ''
+        except Exception:
+            self.status = CompraOnline.FALHA
+            raise
+        finally:
+            self.registrar_checkout()
+
+    async def aconcluir_checkout(self):
+        try:
+            await self.acriar_checkout()
+            self.status = ''
+        except Exception:
+            self.status = CompraOnline.FALHA
+            raise
+        finally:
+            await sync_to_async(self.registrar_checkout)()
+
+    def registrar_checkout(self):
+        CompraOnline.objects.filter(pk=self.pk, status=CompraOnline.CRIANDO).update(url=self.url, status=self.status)
+        self.invalidar_cache()
+
+    def is_criando(self):
+        return self.status == CompraOnline.CRIANDO
 
     def is_confirmada(self):
         return self.status == 'approved'
@@ -291,30 +915,93 @@ class CompraOnline(models.Model):
     def get_link_pagamento(self):
         return Link(self.url)
 
+    def get_situacao_monitoramento(self):
+        return dict(uuid=self.uuid, status=self.status, confirmada=self.is_confirmada())
+
+    def get_painel_monitoramento(self):
+        # sem o ASGI a página da compra é atualizada pelo autoreload (ver VisualizarCompraOnline)
+        if not self.is_confirmada() and monitoramento.is_disponivel():
+            return monitoramento.painel(
+                'bingo/monitoramento/compra.html',
+                '/api/v1/assincrono/monitorar_compra_online/?uuid={}'.format(self.uuid), status=self.status
+            )
+
     def get_status(self):
         if self.is_confirmada():
             return Status('success', 'Confirmada')
+        elif self.is_criando():
+            return Status('info', 'Gerando Pagamento')
+        elif self.status == CompraOnline.FALHA:
+            return Status('danger', 'Falha ao Gerar Pagamento')
         else:
             return Status('warning', 'Pendente')
 
     def atualizar_situacao(self):
+        if self.is_criando() or self.status == CompraOnline.FALHA:
+            return
         if not self.is_confirmada():
-            self.status = MercadoPago().consultar_pagamento(self.uuid, self.data_hora)
+            self.status = MercadoPago().consultar_pagamento(self.uuid, self.data_hora) or self.status
+            self.save()
+        self.alocar_cartelas()
+
+    async def aatualizar_situacao(self):
+        # a consulta ao Mercado Pago é aguardada sem ocupar uma thread; só o acesso ao banco passa por sync_to_async
+        if self.is_criando() or self.status == CompraOnline.FALHA:
+            return
+        status = None if self.is_confirmada() else await MercadoPago().aconsultar_pagamento(self.uuid, self.data_hora)
+        await sync_to_async(self.registrar_status)(status)
+
+    def registrar_status(self, status):
+        if not self.is_confirmada() and status and status != self.status:
+            self.status = status
             self.save()
-        if self.is_confirmada() and not self.cartelas.exists():
+        self.alocar_cartelas()
+
+    def alocar_cartelas(self):
+        if not self.is_confirmada():
+            return
+        with transaction.atomic():
+            # o UPDATE trava a compra e impede que a notificação e a consulta aloquem cartelas em dobro
+            if not CompraOnline.objects.filter(pk=self.pk).update(status=self.status) or self.cartelas.exists():
+                return
             evento = Evento.objects.order_by('data').last()
-            self.cartelas.set(evento.gerar_cartelas_online(self.numero_cartelas))
-            pessoa = Pessoa.objects.get_or_create(cpf='000.000.000-00', nome='Compra Online')[0]
-            meio_pagamento = MeioPagamento.objects.get_or_create(nome='Mercado Pago')[0]
-            self.cartelas.update(responsavel=pessoa, meio_pagamento=meio_pagamento, realizou_pagamento=True, comissao=0)
+            pessoa, meio_pagamento = CompraOnline.get_sentinelas()
+            cartelas = evento.resgatar_cartelas_online(self.numero_cartelas, pessoa, meio_pagamento)
+            if len(cartelas) < self.numero_cartelas:
+                cartelas.extend(cartela.pk for cartela in evento.gerar_cartelas_online(
+                    self.numero_cartelas - len(cartelas), responsavel_id=pessoa, meio_pagamento_id=meio_pagamento,
+                    realizou_pagamento=True, comissao=0
+                ))
+            CompraOnline.cartelas.through.objects.bulk_create([
+                CompraOnline.cartelas.through(compraonline_id=self.pk, cartela_id=cartela) for cartela in cartelas
+            ])
+            self.invalidar_cache()
+
+    @staticmethod
+    def get_sentinelas():
+        # identificadores da pessoa e do meio de pagamento das compras online, guardados por processo
+        if not SENTINELAS:
+            SENTINELAS['pessoa'] = Pessoa.objects.get_or_create(cpf='00000000000', nome='Compra Online')[0].pk
+            SENTINELAS['meio_pagamento'] = MeioPagamento.objects.get_or_create(nome='Mercado Pago')[0].pk
+        return SENTINELAS['pessoa'], SENTINELAS['meio_pagamento']
 
     def get_status_atual(self):
-        if not self.is_confirmada():
+        # a situação chega pelas notificações do Mercado Pago; a consulta à API é só um fallback com intervalo mínimo
+        intervalo = int(os.environ.get('MERCADO_PAGO_INTERVALO_CONSULTA', 300))
+        if not self.is_confirmada() and cache.add('compraonline:{}:consulta'.format(self.pk), 1, timeout=intervalo):
             self.atualizar_situacao()
         return self.get_status()
 
+    async def aget_status_atual(self):
+        intervalo = int(os.environ.get('MERCADO_PAGO_INTERVALO_CONSULTA', 300))
+        if not self.is_confirmada() and await cache.aadd('compraonline:{}:consulta'.format(self.pk), 1, timeout=intervalo):
+            await self.aatualizar_situacao()
+        return self.get_status()
+
     def get_numeros_cartelas(self):
-        return ', '.join(self.cartelas.values_list('numero', flat=True))
+        return compras.get(self.uuid, 'numeros', lambda: ', '.join(
+            Cartela.formatar_numero(numero) for numero in self.cartelas.values_list('numero', flat=True)
+        ))
 
     def get_cartelas(self):
         return self.cartelas.fields('id', 'numero', 'meio_pagamento')
@@ -323,3 +1010,24 @@ class CompraOnline(models.Model):
         return 'Compra {}'.format(self.uuid)
 
 
+# campos pelos quais a exclusão de cada modelo apaga cartelas em cascata
+EXCLUSAO_CARTELAS = {Pessoa: ('responsavel', 'posse'), MeioPagamento: ('meio_pagamento',), Talao: ('talao',)}
+
+
+def descontar_exclusao(sender, instance, origin=None, **kwargs):
+    # pre_delete dos modelos de EXCLUSAO_CARTELAS: as cartelas apagadas em cascata são descontadas do resumo
+    modelo = origin.model if isinstance(origin, models.QuerySet) else type(origin)
+    if modelo is Evento:
+        # o resumo é excluído junto com o evento
+        return
+    alvos = [instance]
+    if modelo is sender and isinstance(origin, models.QuerySet):
+        # exclusão em lote: todas as cartelas são descontadas no primeiro sinal, sem contar duas vezes as compartilhadas
+        if getattr(origin, '_resumo_descontado', False):
+            return
+        origin._resumo_descontado = True
+        alvos = origin
+    filtro = Q()
+    for campo in EXCLUSAO_CARTELAS[sender]:
+        filtro |= Q(**{'{}__in'.format(campo): alvos})
+    EventoResumo.objects.descontar(Cartela.objects.filter(filtro))
@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from threading import Lock
+from weakref import WeakKeyDictionary
+from django.conf import settings
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.template.loader import render_to_string
+from api.components import TemplateContent
+
+
+# canais de monitoramento enviados por server-sent events (SSE) pelo ASGI: os dados de cada canal são publicados
+# uma vez por transação, depois do commit, e repassados às conexões abertas; com REDIS_HOST a publicação passa
+# pelo pub/sub do Redis e chega a todos os workers, sem ele fica restrita ao processo. As páginas recebem os
+# dados por um painel (ver painel()) que mantém a conexão aberta no lugar do autoreload. Sob o WSGI a resposta seria
+# acumulada e cada página aberta ocuparia um worker síncrono, então o painel só é exibido quando as URLs
+# /api/v1/assincrono/ são servidas pelo ASGI (ver is_disponivel()); do contrário as páginas usam o autoreload
+
+logger = logging.getLogger('bingo.monitoramento')
+PREFIXO = 'bingo:monitoramento:'
+SALT = 'bingo.monitoramento'
+# validade da chave de acesso ao canal exibida na página
+VALIDADE_CHAVE = 12 * 60 * 60
+_lock = Lock()
+_distribuidores = WeakKeyDictionary()
+_cliente = None
+
+
+def get_parametros_redis():
+    host = getattr(settings, 'REDIS_HOST', None)
+    if host:
+        return dict(host=host, port=int(settings.REDIS_PORT), password=settings.REDIS_PASSWORD, socket_connect_timeout=2)
+    return None
+
+
+def get_cliente():
+    global _cliente
+    parametros = get_parametros_redis()
+    if parametros and _cliente is None:
+        import redis
+        _cliente = redis.Redis(socket_timeout=2, **parametros)
+    return _cliente if parametros else None
+
+
+def publicar(canal, dados):
+    mensagem = json.dumps(dados, cls=DjangoJSONEncoder)
+    cliente = get_cliente()
+    if cliente is not None:
+        cliente.publish(PREFIXO + canal, mensagem)
+    else:
+        with _lock:
+            distribuidores = list(_distribuidores.items())
+        for loop, distribuidor in distribuidores:
+            # sem assinantes no processo nada é enviado
+            if canal in distribuidor.filas and not loop.is_closed():
+                loop.call_soon_threadsafe(distribuidor.entregar, canal, mensagem)
+
+
+def combinar(anterior, dados):
+    # variações acumulam (as conexões somam ao estado inicial); qualquer outra mensagem substitui a anterior
+    if anterior and 'variacao' in anterior and 'variacao' in dados:
+        variacao = dict(anterior['variacao'])
+        for campo, valor in dados['variacao'].items():
+            variacao[campo] = variacao.get(campo, 0) + valor
+        return dict(dados, variacao=variacao)
+    return dados
+
+
+def agendar(canal, dados):
+    # dados já calculados por quem alterou o canal, sem nova consulta; as mensagens de um canal numa transação
+    # são combinadas numa só publicação, feita depois do commit
+    conexao = transaction.get_connection()
+    for _, funcao, *_ in conexao.run_on_commit:
+        if getattr(funcao, 'canal', None) == canal:
+            funcao.dados = combinar(funcao.dados, dados)
+            return
+
+    def publicar_dados():
+        try:
+            publicar(canal, publicar_dados.dados)
+        except Exception:
+            # o monitoramento nunca interrompe a operação que o originou
+            logger.exception('Falha ao publicar no canal %s', canal)
+    publicar_dados.canal = canal
+    publicar_dados.dados = dados
+    transaction.on_commit(publicar_dados)
+
+
+def assinar(canal):
+    # chave de acesso de leitura ao canal, exibida apenas nas páginas que já exigem permissão para vê-lo
+    return signing.dumps(canal, salt=SALT)
+
+
+def verificar(chave, canal):
+    try:
+        return signing.loads(chave or '', salt=SALT, max_age=VALIDADE_CHAVE) == canal
+    except signing.BadSignature:
+        return False
+
+
+def is_disponivel():
+    # ligado pelo ponto de entrada ASGI (bingo.asgi) ou, com as páginas no WSGI, quando o proxy encaminha as URLs
+    # /api/v1/assincrono/ ao servidor ASGI (MONITORAMENTO_SSE=1)
+    return os.environ.get('MONITORAMENTO_SSE') == '1'
+
+
+def is_asgi(request):
+    return isinstance(request, ASGIRequest)
+
+
+def painel(template, url, **contexto):
+    # o painel é um iframe: o HTML dos componentes é inserido sem executar scripts, o documento do iframe os executa
+    documento = render_to_string(template, dict(contexto, url=url))
+    return TemplateContent('bingo/monitoramento/painel.html', dict(documento=documento))
+
+
+class Distribuidor:
+    # uma única assinatura do Redis por processo (e laço de eventos), repassada às filas das conexões abertas
+
+    def __init__(self):
+        self.filas = {}
+        self.tarefa = None
+        self.pronto = asyncio.Event()
+
+    def assinar(self, canal):
+        # cada conexão guarda no máximo uma mensagem não lida, combinada com as que chegarem antes da leitura
+        fila = asyncio.Queue(maxsize=1)
+        self.filas.setdefault(canal, set()).add(fila)
+        if self.tarefa is None and get_parametros_redis():
+            self.tarefa = asyncio.ensure_future(self.escutar())
+        return fila
+
+    def cancelar(self, canal, fila):
+        filas = self.filas.get(canal, set())
+        filas.discard(fila)
+        if not filas:
+            self.filas.pop(canal, None)
+
+    def entregar(self, canal, mensagem):
+        filas = self.filas.get(canal, ())
+        dados = json.loads(mensagem) if filas else None
+        for fila in filas:
+            fila.put_nowait(combinar(fila.get_nowait(), dados) if fila.full() else dados)
+
+    async def escutar(self):
+        import redis.asyncio
+        while True:
+            try:
+                async with redis.asyncio.Redis(**get_parametros_redis()).pubsub() as pubsub:
+                    await pubsub.psubscribe(PREFIXO + '*')
+                    self.pronto.set()
+                    async for mensagem in pubsub.listen():
+                        if mensagem['type'] == 'pmessage':
+                            self.entregar(mensagem['channel'].decode()[len(PREFIXO):], mensagem['data'].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Falha na assinatura do Redis')
+            self.pronto.clear()
+            await asyncio.sleep(1)
+
+    async def aguardar(self):
+        if self.tarefa is not None:
+            try:
+                await asyncio.wait_for(self.pronto.wait(), timeout=2)
+            except asyncio.TimeoutError:
+                pass
+
+
+def get_distribuidor():
+    loop = asyncio.get_running_loop()
+    with _lock:
+        if loop not in _distribuidores:
+            _distribuidores[loop] = Distribuidor()
+        return _distribuidores[loop]
+
+
+async def transmitir(canal, carregar, encerrar=None):
+    # a assinatura vem antes da leitura inicial para não perder uma alteração feita entre as duas;
+    # a conexão é encerrada após MONITORAMENTO_DURACAO segundos e o navegador reconecta sozinho
+    distribuidor = get_distribuidor()
+    fila = distribuidor.assinar(canal)
+    intervalo = int(os.environ.get('MONITORAMENTO_INTERVALO', 20))
+    limite = time.monotonic() + int(os.environ.get('MONITORAMENTO_DURACAO', 600))
+    try:
+        await distribuidor.aguardar()
+        dados = await carregar()
+        yield 'retry: 3000\ndata: {}\n\n'.format(json.dumps(dados, cls=DjangoJSONEncoder))
+        while not (encerrar and encerrar(dados)) and time.monotonic() < limite:
+            try:
+                dados = await asyncio.wait_for(fila.get(), timeout=intervalo)
+            except asyncio.TimeoutError:
+                # comentário SSE que mantém a conexão aberta nos proxies
+                yield ': ping\n\n'
+                continue
+            yield 'data: {}\n\n'.format(json.dumps(dados, cls=DjangoJSONEncoder))
+    finally:
+        distribuidor.cancelar(canal, fila)
+
+
+def responder(canal, carregar, encerrar=None):
+    response = StreamingHttpResponse(transmitir(canal, carregar, encerrar), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
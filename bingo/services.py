@@ -0,0 +1,111 @@
+import time
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .mercadopago import MercadoPago, MercadoPagoIndisponivel
+from .models import Cartela, CompraOnline
+
+
+class CartelaBatchService:
+
+    TAMANHO_LOTE = 1000
+
+    # mesmas pré-condições verificadas no check_permission de cada endpoint
+    TRANSICOES = {
+        'distribuir': Q(responsavel__isnull=True),
+        'devolver': Q(responsavel__isnull=False) & (Q(realizou_pagamento__isnull=True) | Q(realizou_pagamento=False)),
+        'repassar': Q(responsavel__isnull=False, realizou_pagamento__isnull=True),
+        'prestar_conta': Q(responsavel__isnull=False),
+    }
+
+    def __init__(self, evento, inicio, fim, tamanho_lote=None):
+        self.evento = evento
+        self.inicio = min(inicio, fim)
+        self.fim = max(inicio, fim)
+        self.tamanho_lote = tamanho_lote or self.TAMANHO_LOTE
+
+    def get_cartelas(self):
+        # as cartelas online (talão '000') têm numeração própria e ficam fora das operações em lote
+        return Cartela.objects.filter(evento=self.evento, numero__range=(self.inicio, self.fim)).exclude(
+            talao__sequenciacartela__isnull=False
+        )
+
+    def aplicar(self, transicao, **valores):
+        total = self.get_cartelas().count()
+        aplicadas = 0
+        numero = self.inicio
+        qs = self.get_cartelas().filter(self.TRANSICOES[transicao])
+        while True:
+            # cada lote é travado e atualizado na sua própria transação; cartelas travadas por outra operação são ignoradas
+            with transaction.atomic():
+                lote = list(qs.filter(numero__gte=numero).order_by('numero').select_for_update(
+                    skip_locked=True).values_list('pk', 'numero')[:self.tamanho_lote])
+                if not lote:
+                    break
+                aplicadas += Cartela.objects.filter(pk__in=[pk for pk, _ in lote]).atualizar(**valores)
+            numero = lote[-1][1] + 1
+        return dict(aplicadas=aplicadas, ignoradas=total - aplicadas)
+
+
+class ConciliacaoPagamentos:
+
+    def __init__(self, horas=48, requisicoes=50, intervalo=0.5, limite=100):
+        self.fim = timezone.now()
+        self.inicio = self.fim - timedelta(hours=horas)
+        self.requisicoes = requisicoes
+        self.intervalo = intervalo
+        self.limite = limite
+
+    def get_compras(self):
+        return CompraOnline.objects.filter(data_hora__gte=self.inicio).exclude(
+            status__in=('approved', CompraOnline.CRIANDO, CompraOnline.FALHA)
+        )
+
+    def buscar(self, referencias):
+        # percorre as páginas da busca por data em vez de uma consulta por compra, respeitando o orçamento de requisições
+        situacoes = {}
+        offset, total, requisicoes = 0, None, 0
+        api = MercadoPago()
+        while (total is None or offset < total) and requisicoes < self.requisicoes:
+            if requisicoes:
+                time.sleep(self.intervalo)
+            resultados, total = api.buscar_pagamentos(self.inicio, self.fim, offset, self.limite)
+            requisicoes += 1
+            offset += self.limite
+            for resultado in resultados:
+                referencia = resultado.get('external_reference')
+                # os resultados vêm do mais recente para o mais antigo; um pagamento aprovado prevalece
+                if referencia in referencias and situacoes.get(referencia) != 'approved':
+                    if referencia not in situacoes or resultado['status'] == 'approved':
+                        situacoes[referencia] = resultado['status']
+            if not resultados:
+                break
+        return situacoes, requisicoes, total is not None and offset < total
+
+    def executar(self):
+        compras = {compra.uuid: compra for compra in self.get_compras()}
+        resumo = dict(verificadas=len(compras), atualizadas=0, aprovadas=0, erros=0, requisicoes=0, incompleta=False)
+        if not compras:
+            return resumo
+        try:
+            situacoes, resumo['requisicoes'], resumo['incompleta'] = self.buscar(set(compras))
+        except MercadoPagoIndisponivel:
+            resumo['erros'] += 1
+            return resumo
+        grupos = {}
+        for referencia, status in situacoes.items():
+            if status != compras[referencia].status:
+                grupos.setdefault(status, []).append(compras[referencia].pk)
+        for status, pks in grupos.items():
+            resumo['atualizadas'] += CompraOnline.objects.filter(pk__in=pks).exclude(status='approved').update(status=status)
+        for referencia, status in situacoes.items():
+            if status != compras[referencia].status:
+                compras[referencia].invalidar_cache()
+        for compra in CompraOnline.objects.filter(pk__in=grupos.get('approved', [])):
+            try:
+                compra.alocar_cartelas()
+                resumo['aprovadas'] += 1
+            except Exception:
+                resumo['erros'] += 1
+        return resumo
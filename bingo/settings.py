@@ -41,6 +41,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'bingo.instrumentacao.InstrumentacaoMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -52,6 +53,9 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'bingo.urls'
 
+# usernames are CPF digits; logins with a formatted CPF are normalized
+AUTHENTICATION_BACKENDS = ['bingo.autenticacao.CpfBackend']
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -70,6 +74,12 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'bingo.wsgi.application'
 
+# ASGI server started by "manage.py startasgi"; each uvicorn worker serves many requests waiting on Mercado Pago
+GUNICORN_ASGI = dict(
+    bind='0.0.0.0:8000', workers=int(os.environ.get('ASGI_WORKERS', 2)), timeout=300, keepalive=5,
+    worker_class='uvicorn_worker.UvicornWorker'
+)
+
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
@@ -82,6 +92,22 @@ DATABASES = {
 }
 
 
+# Instrumentation (enabled by INSTRUMENTACAO_AMOSTRAGEM, see bingo/instrumentacao.py)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'bingo.instrumentacao': {'level': 'INFO', 'handlers': ['console'], 'propagate': False},
+        'bingo.configuracao': {'level': 'INFO', 'handlers': ['console'], 'propagate': False},
+        'bingo.monitoramento': {'level': 'WARNING', 'handlers': ['console'], 'propagate': False},
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -126,4 +152,43 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 from api.conf import *
 
 
+# Perfil do ambiente: "desenvolvimento" mantém o SQLite e o tratamento padrão das conexões; "producao" (ativado com
+# BINGO_PERFIL=producao) ajusta os serviços Postgres/Redis configurados por api.conf. As otimizações ativas são
+# relatadas por bingo.checks.
+
+PERFIL = os.environ.get('BINGO_PERFIL', 'desenvolvimento')
+
+if PERFIL == 'producao':
+    # o DEBUG fica desligado (BINGO_DEBUG=1 o liga para diagnóstico); /static/ e /media/ passam a ser servidos por
+    # bingo.urls, já que api.urls só os registra com o DEBUG ligado
+    DEBUG = os.environ.get('BINGO_DEBUG') == '1'
+    # mesmo com o DEBUG ligado para diagnóstico, as consultas SQL não são acumuladas em cada conexão
+    # (ver bingo.checks.desativar_registro_consultas)
+    REGISTRAR_CONSULTAS = False
+    if DATABASES['default']['ENGINE'].startswith('django.db.backends.postgresql'):
+        DATABASES['default'].update(
+            CONN_MAX_AGE=int(os.environ.get('DATABASE_CONN_MAX_AGE', 60)),
+            CONN_HEALTH_CHECKS=True,
+            OPTIONS={'connect_timeout': int(os.environ.get('DATABASE_CONNECT_TIMEOUT', 5)), 'application_name': 'bingo'},
+        )
+        if os.environ.get('PGBOUNCER_HOST'):
+            # pgbouncer no modo de transação: os cursores no servidor não sobrevivem entre transações
+            DATABASES['default'].update(
+                HOST=os.environ['PGBOUNCER_HOST'], PORT=os.environ.get('PGBOUNCER_PORT', '6432'),
+                DISABLE_SERVER_SIDE_CURSORS=True,
+            )
+    if os.environ.get('REDIS_HOST'):
+        CACHES['default']['OPTIONS'].update(
+            CONNECTION_POOL_KWARGS={'max_connections': int(os.environ.get('REDIS_CONEXOES', 50))},
+            SOCKET_CONNECT_TIMEOUT=2, SOCKET_TIMEOUT=2,
+        )
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
+
 DEFAULT_PASSWORD = lambda user: '123'
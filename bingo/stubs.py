@@ -0,0 +1,206 @@
+import json
+import hmac
+import time
+import hashlib
+import threading
+import requests
+from uuid import uuid1
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class ServidorHttp(ThreadingHTTPServer):
+    # fila de conexões maior que a padrão (5) para suportar as rajadas dos benchmarks de concorrência
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class Servidor:
+    # servidor HTTP local executado numa thread, usado nos testes e benchmarks
+
+    def __init__(self, handler):
+        self.httpd = ServidorHttp(('127.0.0.1', 0), handler)
+        self.httpd.stub = self
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def responder(self, status, dados=None):
+        corpo = json.dumps(dados).encode() if dados is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def ler(self):
+        tamanho = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(tamanho) or b'{}')
+
+
+class MercadoPagoHandler(Handler):
+
+    def processar(self, metodo):
+        stub = self.server.stub
+        url = urlparse(self.path)
+        parametros = {chave: valores[0] for chave, valores in parse_qs(url.query).items()}
+        with stub.lock:
+            stub.requisicoes.append((metodo, url.path, parametros))
+            falhar = stub.falhas > 0
+            stub.falhas -= 1 if falhar else 0
+        if stub.latencia:
+            time.sleep(stub.latencia)
+        if falhar:
+            return self.responder(503, dict(message='indisponível'))
+        if metodo == 'POST' and url.path == '/checkout/preferences':
+            dados = self.ler()
+            identificador = uuid1().hex
+            stub.preferencias[identificador] = dados
+            return self.responder(201, dict(id=identificador, init_point='{}/checkout/{}'.format(stub.url, identificador)))
+        if metodo == 'GET' and url.path == '/v1/payments/search':
+            try:
+                resultados = stub.buscar(parametros)
+            except ValueError as e:
+                return self.responder(400, dict(message=str(e)))
+            offset, limite = int(parametros.get('offset', 0)), int(parametros.get('limit', 30))
+            paging = dict(total=len(resultados), offset=offset, limit=limite)
+            return self.responder(200, dict(results=resultados[offset:offset + limite], paging=paging))
+        if metodo == 'GET' and url.path.startswith('/v1/payments/'):
+            pagamento = stub.pagamentos.get(url.path.split('/')[-1])
+            return self.responder(200, pagamento) if pagamento else self.responder(404, dict(message='not found'))
+        self.responder(404, dict(message='not found'))
+
+    def do_GET(self):
+        self.processar('GET')
+
+    def do_POST(self):
+        self.processar('POST')
+
+
+class MercadoPagoStub(Servidor):
+    # simula a API do Mercado Pago: preferências do checkout pro, consulta e busca de pagamentos
+
+    def __init__(self, latencia=0):
+        super().__init__(MercadoPagoHandler)
+        self.lock = threading.Lock()
+        self.latencia = latencia
+        self.falhas = 0
+        self.requisicoes = []
+        self.preferencias = {}
+        self.pagamentos = {}
+
+    def pagar(self, referencia, status='approved', identificador=None, data_hora=None):
+        identificador = str(identificador or len(self.pagamentos) + 1)
+        data_hora = (data_hora or datetime.now()).astimezone()
+        self.pagamentos[identificador] = dict(
+            id=int(identificador), status=status, external_reference=referencia,
+            date_created=data_hora.isoformat(timespec='milliseconds')
+        )
+        return self.pagamentos[identificador]
+
+    @staticmethod
+    def ler_data(valor):
+        # as datas absolutas da busca precisam do deslocamento UTC (os valores relativos, como NOW-2DAYS, não são filtrados)
+        if not valor or valor.startswith('NOW'):
+            return None
+        data_hora = datetime.fromisoformat(valor)
+        if data_hora.tzinfo is None:
+            raise ValueError('Data sem deslocamento UTC: {}'.format(valor))
+        return data_hora
+
+    def buscar(self, parametros):
+        referencia = parametros.get('external_reference')
+        inicio, fim = self.ler_data(parametros.get('begin_date')), self.ler_data(parametros.get('end_date'))
+        resultados = [
+            pagamento for pagamento in self.pagamentos.values() if referencia in (None, pagamento['external_reference'])
+            and (inicio is None or datetime.fromisoformat(pagamento['date_created']) >= inicio)
+            and (fim is None or datetime.fromisoformat(pagamento['date_created']) <= fim)
+        ]
+        return sorted(resultados, key=lambda pagamento: pagamento['id'], reverse=True)
+
+
+class NotificadorMercadoPago:
+    # envia notificações assinadas como o Mercado Pago faz para a notification_url
+
+    def __init__(self, url, segredo=None, post=None):
+        self.url = url
+        self.segredo = segredo
+        self.post = post or (lambda url, corpo, cabecalhos: requests.post(url, data=corpo, headers=cabecalhos, timeout=10))
+
+    def notificar(self, pagamento, requisicao=None, assinatura=None):
+        requisicao = requisicao or uuid1().hex
+        cabecalhos = {'Content-Type': 'application/json', 'x-request-id': requisicao}
+        if self.segredo or assinatura:
+            ts = str(int(time.time()))
+            manifesto = 'id:{};request-id:{};ts:{};'.format(pagamento, requisicao, ts)
+            assinatura = assinatura or hmac.new(self.segredo.encode(), manifesto.encode(), hashlib.sha256).hexdigest()
+            cabecalhos['x-signature'] = 'ts={},v1={}'.format(ts, assinatura)
+        corpo = json.dumps(dict(action='payment.updated', type='payment', data=dict(id=str(pagamento))))
+        return self.post('{}?data.id={}&type=payment'.format(self.url, pagamento), corpo, cabecalhos)
+
+
+def gerar_pdf(paginas):
+    # PDF mínimo e válido com páginas em branco no tamanho A4
+    objetos = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [{}] /Count {} >>'.format(' '.join('{} 0 R'.format(i + 3) for i in range(paginas)), paginas)
+    ] + ['<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] >>'] * paginas
+    conteudo = b'%PDF-1.4\n'
+    posicoes = []
+    for i, objeto in enumerate(objetos, 1):
+        posicoes.append(len(conteudo))
+        conteudo += '{} 0 obj\n{}\nendobj\n'.format(i, objeto).encode()
+    xref = len(conteudo)
+    conteudo += 'xref\n0 {}\n0000000000 65535 f \n'.format(len(objetos) + 1).encode()
+    conteudo += ''.join('{:010d} 00000 n \n'.format(posicao) for posicao in posicoes).encode()
+    conteudo += 'trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n'.format(len(objetos) + 1, xref).encode()
+    return conteudo
+
+
+class WeasyprintHandler(Handler):
+
+    def do_POST(self):
+        stub = self.server.stub
+        html = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+        with stub.lock:
+            stub.requisicoes.append(html)
+        if stub.latencia:
+            time.sleep(stub.latencia)
+        # uma página a cada quatro cartelas, como no leiaute de impressão
+        corpo = gerar_pdf(max(1, -(-html.count('class="cartela"') // 4)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+
+class WeasyprintStub(Servidor):
+    # substitui o serviço weasyprint (POST do HTML, resposta com o PDF) com latência configurável por documento
+
+    def __init__(self, latencia=0):
+        super().__init__(WeasyprintHandler)
+        self.lock = threading.Lock()
+        self.latencia = latencia
+        self.requisicoes = []
@@ -1,36 +1,250 @@
+import os
+import csv
+import zipfile
+import traceback
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import timedelta
+from itertools import groupby, islice
+from tempfile import mkstemp
 from api import tasks
-from .models import Talao, Cartela
-import time
+from django.core.cache import cache
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+from .models import Evento, Talao, Cartela, EventoResumo, CompraOnline
+from .grades import gerar_unicas, empacotar
+from . import impressao
+
+
+# pool de cada processo (o total é BINGO_WORKERS vezes o número de workers do gunicorn); as tarefas enfileiradas
+# se perdem quando o worker reinicia, então os checkouts também são retomados pelo comando processar_checkouts
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get('BINGO_WORKERS', 2)), thread_name_prefix='bingo')
+
+
+def executar(funcao, *args):
+    # executa a função numa thread do pool após o commit da transação corrente
+    def run():
+        close_old_connections()
+        try:
+            funcao(*args)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            close_old_connections()
+    transaction.on_commit(lambda: executor.submit(run))
+
+
+def preencher_reserva_online(pk):
+    evento = Evento.objects.get(pk=pk)
+    # evita que várias threads preencham a reserva do mesmo evento ao mesmo tempo
+    if cache.add('evento:{}:reserva_online'.format(pk), 1, timeout=300):
+        try:
+            PreencherReservaOnline(evento).run()
+        finally:
+            cache.delete('evento:{}:reserva_online'.format(pk))
+
+
+def criar_checkout(pk):
+    compra = CompraOnline.objects.filter(pk=pk, status=CompraOnline.CRIANDO).first()
+    if compra:
+        compra.concluir_checkout()
+
+
+def retomar_checkouts(pks=None, sincrono=False):
+    # checkouts perdidos num reinício deixam a compra em "creating": passado o prazo ela é reenviada ao pool (ou,
+    # com sincrono, criada no próprio processo) e, passada a expiração, marcada como falha
+    agora = timezone.now()
+    prazo = int(os.environ.get('CHECKOUT_PRAZO', 120))
+    expiracao = agora - timedelta(seconds=int(os.environ.get('CHECKOUT_EXPIRACAO', 900)))
+    qs = CompraOnline.objects.filter(status=CompraOnline.CRIANDO, data_hora__lt=agora - timedelta(seconds=prazo))
+    if pks is not None:
+        qs = qs.filter(pk__in=pks)
+    expiradas = list(qs.filter(data_hora__lt=expiracao))
+    CompraOnline.objects.filter(pk__in=[compra.pk for compra in expiradas], status=CompraOnline.CRIANDO).update(
+        status=CompraOnline.FALHA
+    )
+    for compra in expiradas:
+        compra.status = CompraOnline.FALHA
+        compra.invalidar_cache()
+    reenviadas = 0
+    for pk in qs.filter(data_hora__gte=expiracao).values_list('pk', flat=True):
+        # uma nova tentativa por prazo, para não repetir o checkout que ainda está em andamento
+        if cache.add('compraonline:{}:checkout'.format(pk), 1, timeout=prazo):
+            if sincrono:
+                try:
+                    criar_checkout(pk)
+                except Exception:
+                    traceback.print_exc()
+            else:
+                executar(criar_checkout, pk)
+            reenviadas += 1
+    return reenviadas, len(expiradas)
 
 
 class ExportarCartelasTask(tasks.Task):
 
-    def __init__(self, qs):
+    CABECALHO = 'Nº da Cartela', 'Talão', 'Responsável', 'Posse', 'Valor da Cartela', 'Valor da Comissão', 'Situação'
+    TAMANHO_LOTE = 2000
+
+    def __init__(self, qs, formato='csv'):
         self.qs = qs
+        self.formato = formato
         super().__init__()
 
+    def linhas(self):
+        # lê as cartelas em lotes de um cursor no servidor, sem instanciar modelos nem componentes
+        valores = {}
+        qs = self.qs.com_situacao().order_by('numero').values_list(
+            'numero', 'talao__numero', 'responsavel__nome', 'posse__nome', 'comissao', 'situacao', 'evento_id'
+        )
+        for numero, talao, responsavel, posse, comissao, situacao, evento in qs.iterator(self.TAMANHO_LOTE):
+            if evento not in valores:
+                valores[evento] = Evento.objects.get(pk=evento).get_valor_liquido_cartela()
+            yield (
+                Cartela.formatar_numero(numero), talao, responsavel or '', posse or '', valores[evento],
+                comissao or '0', Cartela.SITUACOES[situacao][1]
+            )
+
+    def lotes(self):
+        # as linhas são lidas até o fim do cursor; a contagem prévia serve apenas para estimar o progresso
+        self.total = max(1, -(-self.qs.count() // self.TAMANHO_LOTE))
+        linhas = self.linhas()
+        while True:
+            lote = list(islice(linhas, self.TAMANHO_LOTE))
+            if not lote:
+                break
+            yield lote
+            if self.partial < self.total:
+                self.next()
+
     def run(self):
-        rows = []
-        valor = None
-        rows.append(('Nº da Cartela', 'Talão', 'Responsável', 'Posse', 'Valor da Cartela', 'Valor da Comissão', 'Situação'))
-        for obj in self.iterate(self.qs.order_by('numero')):
-            if valor is None:
-                valor = obj.talao.evento.get_valor_liquido_cartela()
-            rows.append((obj.numero, obj.talao.numero, obj.responsavel.nome if obj.responsavel else '',
-                         obj.posse.nome if obj.posse else '', valor, obj.comissao or '0', obj.get_situacao()['label']))
-        return self.to_csv_file(rows)
+        return self.to_xlsx_stream() if self.formato == 'xlsx' else self.to_csv_stream()
 
+    def to_csv_stream(self):
+        descriptor, file_path = mkstemp(suffix='.csv')
+        with os.fdopen(descriptor, 'w', encoding='iso8859-1', errors='replace', newline='') as output:
+            writer = csv.writer(output)
+            writer.writerow(self.CABECALHO)
+            for lote in self.lotes():
+                writer.writerows(lote)
+        return file_path
 
-class GerarCartelas(tasks.Task):
+    def to_xlsx_stream(self):
+        import openpyxl
+        descriptor, file_path = mkstemp(suffix='.xlsx')
+        os.close(descriptor)
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet('Cartelas')
+        sheet.append(self.CABECALHO)
+        for lote in self.lotes():
+            for row in lote:
+                sheet.append(row)
+        workbook.save(file_path)
+        return file_path
+
+
+class ImprimirCartelasTask(tasks.Task):
+
+    TAMANHO_LOTE = 2000
+
+    def __init__(self, qs, workers=None):
+        self.qs = qs.filter(grade__isnull=False)
+        self.workers = workers or int(os.environ.get('IMPRESSAO_WORKERS', 4))
+        self.url = impressao.get_url()
+        super().__init__()
+
+    def taloes(self):
+        # cartelas agrupadas por talão, lidas de um cursor no servidor
+        qs = self.qs.order_by('evento', 'talao__numero', 'talao', 'numero').values_list(
+            'evento', 'evento__nome', 'evento__data', 'talao__numero', 'talao', 'numero', 'grade'
+        )
+        for (evento, nome, data, talao, _), cartelas in groupby(qs.iterator(self.TAMANHO_LOTE), key=lambda c: c[:5]):
+            cartelas = [(Cartela.formatar_numero(c[5]), bytes(c[6])) for c in cartelas]
+            yield 'evento-{}/talao-{}.pdf'.format(evento, talao), (evento, nome, data.strftime('%d/%m/%Y'), talao, cartelas)
+
+    def run(self):
+        taloes = self.taloes()
+        pendentes = deque()
+        descriptor, file_path = mkstemp(suffix='.zip')
+        os.close(descriptor)
+        # a montagem do HTML e dos QrCodes usa a CPU, então os workers são processos (que também aguardam o serviço)
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        # os PDFs já são comprimidos e vão para o ZIP sem nova compressão, na ordem dos talões
+        # os talões são lidos até o fim do cursor; a contagem prévia serve apenas para estimar o progresso
+        self.total = self.qs.values('talao').distinct().count()
+        with executor, zipfile.ZipFile(file_path, 'w', zipfile.ZIP_STORED) as arquivo:
+            while True:
+                # no máximo dois talões por worker ficam em memória
+                for nome, argumentos in islice(taloes, 2 * self.workers - len(pendentes)):
+                    pendentes.append((nome, executor.submit(impressao.imprimir_talao, self.url, *argumentos)))
+                if not pendentes:
+                    break
+                nome, futuro = pendentes.popleft()
+                arquivo.writestr(nome, futuro.result())
+                if self.partial < self.total:
+                    self.next()
+        return file_path
+
+
+class PreencherReservaOnline(tasks.Task):
 
     def __init__(self, evento):
         self.evento = evento
         super().__init__()
 
     def run(self):
-        numero = 1
-        for i in self.iterate(range(1, self.evento.qtd_taloes+1)):
-            talao = Talao.objects.create(numero=f'{i}'.rjust(3, '0'), evento=self.evento)
-            for j in range(1, self.evento.qtd_cartela_talao + 1):
-                Cartela.objects.create(numero=f'{numero}'.rjust(5, '0'), talao=talao)
+        tamanho = int(os.environ.get('CARTELAS_ONLINE_RESERVA', 0))
+        faltantes = tamanho - self.evento.get_reserva_online().count()
+        lote = 100
+        for inicio in self.iterate(range(0, max(faltantes, 0), lote)):
+            self.evento.gerar_cartelas_online(min(lote, faltantes - inicio))
+
+
+class GerarCartelas(tasks.Task):
+
+    # quantidade aproximada de cartelas inseridas por comando
+    TAMANHO_LOTE = 10000
+
+    def __init__(self, evento, tamanho_lote=None):
+        self.evento = evento
+        self.tamanho_lote = tamanho_lote or self.TAMANHO_LOTE
+        super().__init__()
+
+    def run(self):
+        qtd = self.evento.qtd_cartela_talao
+        with transaction.atomic():
+            Talao.objects.bulk_create(
+                [Talao(numero=f'{i}'.rjust(3, '0'), evento=self.evento) for i in range(1, self.evento.qtd_taloes + 1)],
+                batch_size=self.tamanho_lote
+            )
+            taloes = list(Talao.objects.filter(evento=self.evento).order_by('id').values_list('id', flat=True))
+            taloes_por_lote = max(1, self.tamanho_lote // qtd)
+            lotes = [(i, taloes[i:i + taloes_por_lote]) for i in range(0, len(taloes), taloes_por_lote)]
+            # grades de todo o evento geradas de uma vez, o que garante a unicidade entre os lotes
+            grades = gerar_unicas(self.evento.semente, range(1, len(taloes) * qtd + 1))
+            inserir = self.inserir_postgres if connection.vendor == 'postgresql' else self.inserir
+            for inicio, ids in self.iterate(lotes):
+                inserir(ids, inicio * qtd + 1, qtd, empacotar(grades[inicio * qtd:(inicio + len(ids)) * qtd]))
+            EventoResumo.objects.registrar(total={self.evento.pk: len(taloes) * qtd})
+
+    def inserir(self, taloes, numero, qtd, grades):
+        cartelas = []
+        for talao in taloes:
+            for j in range(qtd):
+                cartelas.append(Cartela(numero=numero, talao_id=talao, evento=self.evento, grade=grades[len(cartelas)]))
                 numero += 1
+        Cartela.objects.bulk_create(cartelas, batch_size=self.tamanho_lote)
+
+    def inserir_postgres(self, taloes, numero, qtd, grades):
+        # gera todas as cartelas do lote no próprio servidor com um único INSERT ... SELECT
+        sql = '''
+            INSERT INTO {} (numero, talao_id, evento_id, comissao, grade)
+            SELECT (t.ordem - 1) * %(qtd)s + s.n + %(numero)s - 1, t.id, %(evento)s, 0, g.grade
+            FROM UNNEST(%(taloes)s::bigint[]) WITH ORDINALITY AS t(id, ordem)
+            CROSS JOIN GENERATE_SERIES(1, %(qtd)s) AS s(n)
+            JOIN UNNEST(%(grades)s::bytea[]) WITH ORDINALITY AS g(grade, ordem) ON g.ordem = (t.ordem - 1) * %(qtd)s + s.n
+            ORDER BY t.ordem, s.n
+        '''.format(connection.ops.quote_name(Cartela._meta.db_table))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, dict(taloes=list(taloes), numero=numero, qtd=qtd, evento=self.evento.pk, grades=grades))
@@ -1,4 +1,39 @@
+import os
+import json
+import time
+import html
+import runpy
+import asyncio
+import zipfile
+import numpy as np
+from io import StringIO
+from tempfile import mkstemp
+from datetime import date, datetime, timedelta, timezone as tz
+from unittest import mock, skipUnless
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.contrib.auth import authenticate
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.client import AsyncClient, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.views.static import serve
 from api.test import SeleniumTestCase
+from . import benchmarks, checks, instrumentacao, mercadopago, monitoramento, tasks
+from .models import SENTINELAS, normalizar_cpf, Pessoa, MeioPagamento, Evento, Talao, EventoResumo, ResumoMeioPagamento, Cartela, CompraOnline, NotificacaoPagamento, Sorteio, Ganhador
+from .tasks import GerarCartelas, ExportarCartelasTask, ImprimirCartelasTask, retomar_checkouts
+from .endpoints import VisualizarCompraOnline
+from .services import CartelaBatchService, ConciliacaoPagamentos
+from .grades import gerar, gerar_semente, gerar_unicas, empacotar, carregar
+from .apuracao import Apuracao, descartar
+from .analise import classificar_situacoes
+from .stubs import MercadoPagoStub, NotificadorMercadoPago, WeasyprintStub
 
 """
 Tu run the tests, execute:
@@ -22,3 +57,995 @@ class TesteIntegracao(SeleniumTestCase):
             self.login('admin', '123')
             self.logout()
 
+
+
+class MercadoPagoTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.stub = MercadoPagoStub().start()
+        self.ambiente = mock.patch.dict(os.environ, TOKEN_MERCADO_PAGO='TESTE', MERCADO_PAGO_URL=self.stub.url, MERCADO_PAGO_ESPERA='0')
+        self.ambiente.start()
+        mercadopago._cliente = None
+        mercadopago._sdks.clear()
+
+    def tearDown(self):
+        self.ambiente.stop()
+        self.stub.stop()
+        mercadopago._cliente = None
+        mercadopago._sdks.clear()
+
+    def test_checkout_e_consulta(self):
+        api = mercadopago.MercadoPago()
+        dados = api.realizar_checkout_pro('Maria Silva', '123.456.789-00', 'Compra', 10, 'maria@mail.com', 'ref', 'http://localhost')
+        self.assertTrue(dados['url'].startswith(self.stub.url))
+        self.stub.pagar('ref')
+        self.assertEqual(api.consultar_pagamento('ref', None), 'approved')
+        self.assertIs(api.sdk, mercadopago.MercadoPago().sdk)
+
+    def test_repeticao(self):
+        self.stub.falhas = 2
+        self.stub.pagar('ref')
+        self.assertEqual(mercadopago.MercadoPago().consultar_pagamento('ref', None), 'approved')
+        metricas = mercadopago.get_cliente().get_metricas()
+        self.assertEqual(metricas['tentativas'], 2)
+        self.assertEqual(metricas['erros'], 2)
+
+    def test_assincrono(self):
+        async def executar():
+            api = mercadopago.MercadoPago()
+            dados = await api.arealizar_checkout_pro('Maria Silva', '123.456.789-00', 'Compra', 10, 'maria@mail.com', 'ref', 'http://localhost')
+            self.stub.falhas = 1
+            self.stub.pagar('ref')
+            return dados, await api.aconsultar_pagamento('ref', None), mercadopago.get_cliente_assincrono().get_metricas()
+        dados, status, metricas = asyncio.run(executar())
+        self.assertTrue(dados['url'].startswith(self.stub.url))
+        self.assertEqual(status, 'approved')
+        self.assertEqual(metricas['tentativas'], 1)
+
+    def test_circuito(self):
+        cliente = mercadopago.get_cliente()
+        cliente.tentativas = 1
+        cliente.limite_falhas = 2
+        self.stub.falhas = 10
+        for i in range(2):
+            self.assertEqual(cliente.get('{}/v1/payments/1'.format(mercadopago.URL_API))['status'], 503)
+        with self.assertRaises(mercadopago.MercadoPagoIndisponivel):
+            cliente.get('{}/v1/payments/1'.format(mercadopago.URL_API))
+        self.assertEqual(len(self.stub.requisicoes), 2)
+
+    def test_circuito_meio_aberto(self):
+        cliente = mercadopago.get_cliente()
+        cliente.tentativas = 1
+        cliente.limite_falhas = 1
+        url = '{}/v1/payments/1'.format(mercadopago.URL_API)
+        self.stub.falhas = 1
+        self.assertEqual(cliente.get(url)['status'], 503)
+        # passado o intervalo, só uma requisição testa o serviço enquanto as concorrentes são rejeitadas
+        cliente.aberto_ate = time.monotonic()
+        cliente.verificar_circuito()
+        for i in range(3):
+            with self.assertRaises(mercadopago.MercadoPagoIndisponivel):
+                cliente.verificar_circuito()
+        # a falha da requisição de teste reabre o circuito e o sucesso o fecha
+        cliente.registrar(0, True)
+        self.assertTrue(cliente.get_metricas()['circuito_aberto'])
+        cliente.aberto_ate = time.monotonic()
+        self.assertEqual(cliente.get(url)['status'], 404)
+        self.assertEqual((cliente.aberto_ate, cliente.sonda_ate, cliente.metricas['rejeitadas']), (0, 0, 3))
+
+
+class NotificacaoTestCase(TestCase):
+
+    def setUp(self):
+        self.stub = MercadoPagoStub().start()
+        self.ambiente = mock.patch.dict(
+            os.environ, TOKEN_MERCADO_PAGO='TESTE', MERCADO_PAGO_URL=self.stub.url, MERCADO_PAGO_SEGREDO_WEBHOOK='segredo'
+        )
+        self.ambiente.start()
+        mercadopago._cliente = None
+        mercadopago._sdks.clear()
+        SENTINELAS.clear()
+        cache.clear()
+        Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=1, qtd_cartela_talao=10, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        self.notificador = NotificadorMercadoPago(
+            '/api/v1/notificacao_mercado_pago/', 'segredo',
+            lambda url, corpo, cabecalhos: self.client.post(url, corpo, content_type='application/json', headers=cabecalhos)
+        )
+
+    def tearDown(self):
+        self.ambiente.stop()
+        self.stub.stop()
+        mercadopago._cliente = None
+        mercadopago._sdks.clear()
+
+    def test(self):
+        compra = CompraOnline.objects.create(nome='Maria Silva', cpf='123.456.789-00', email='maria@mail.com', numero_cartelas=2)
+        pagamento = self.stub.pagar(compra.uuid)
+        for i in range(2):
+            self.assertEqual(self.notificador.notificar(pagamento['id']).status_code, 200)
+        compra.refresh_from_db()
+        self.assertTrue(compra.is_confirmada())
+        self.assertEqual(compra.cartelas.count(), 2)
+        self.assertEqual(NotificacaoPagamento.objects.count(), 1)
+        self.assertEqual(self.notificador.notificar(pagamento['id'], assinatura='invalida').status_code, 401)
+
+    def test_transicao(self):
+        compra = CompraOnline.objects.create(nome='Maria Silva', cpf='123.456.789-00', email='maria@mail.com', numero_cartelas=2)
+        pagamento = self.stub.pagar(compra.uuid, status='pending')
+        self.assertEqual(self.notificador.notificar(pagamento['id']).status_code, 200)
+        # a aprovação logo após a notificação de pendência não é descartada
+        pagamento['status'] = 'approved'
+        self.assertEqual(self.notificador.notificar(pagamento['id']).status_code, 200)
+        compra.refresh_from_db()
+        self.assertTrue(compra.is_confirmada())
+        self.assertEqual(list(NotificacaoPagamento.objects.order_by('id').values_list('status', flat=True)), ['pending', 'approved'])
+
+    def test_sem_segredo(self):
+        compra = CompraOnline.objects.create(nome='Maria Silva', cpf='123.456.789-00', numero_cartelas=1)
+        pagamento = self.stub.pagar(compra.uuid)
+        notificador = NotificadorMercadoPago(self.notificador.url, post=self.notificador.post)
+        with mock.patch.dict(os.environ, MERCADO_PAGO_SEGREDO_WEBHOOK=''):
+            # sem a chave secreta as notificações são recusadas sem consultar a API
+            self.assertEqual(notificador.notificar(pagamento['id']).status_code, 401)
+            self.assertFalse([r for r in self.stub.requisicoes if r[1].startswith('/v1/payments/')])
+            with mock.patch.dict(os.environ, MERCADO_PAGO_WEBHOOK_INSEGURO='1'):
+                self.assertEqual(notificador.notificar(pagamento['id']).status_code, 200)
+        compra.refresh_from_db()
+        self.assertTrue(compra.is_confirmada())
+
+    def test_cache(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            compra = CompraOnline.objects.create(nome='Maria Silva', cpf='123.456.789-00', numero_cartelas=2)
+        self.assertEqual(compra.cpf, '12345678900')
+        self.assertEqual(CompraOnline.objects.get_ids_por_cpf('123.456.789-00'), [compra.pk])
+        self.assertFalse(CompraOnline.objects.get_por_uuid(compra.uuid).is_confirmada())
+        self.assertEqual(CompraOnline.objects.get_por_uuid(compra.uuid).get_numeros_cartelas(), '')
+        with self.assertNumQueries(0):
+            CompraOnline.objects.get_ids_por_cpf(compra.cpf)
+            CompraOnline.objects.get_por_uuid(compra.uuid).get_numeros_cartelas()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.notificador.notificar(self.stub.pagar(compra.uuid)['id'])
+        compra = CompraOnline.objects.get_por_uuid(compra.uuid)
+        self.assertTrue(compra.is_confirmada())
+        self.assertEqual(len(compra.get_numeros_cartelas().split(', ')), 2)
+
+
+class CartelasPessoaTestCase(TestCase):
+
+    def test(self):
+        GerarCartelas(Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=2, qtd_cartela_talao=5, valor_venda_cartela=10, valor_comissao_cartela=2
+        )).run()
+        maria, joao = Pessoa.objects.create(nome='Maria'), Pessoa.objects.create(nome='João')
+        pix = MeioPagamento.objects.create(nome='PIX')
+        Cartela.objects.filter(numero__lte=4).atualizar(responsavel=maria)
+        Cartela.objects.filter(numero__in=(3, 4, 5)).atualizar(responsavel=joao, posse=maria)
+        Cartela.objects.filter(numero=1).atualizar(realizou_pagamento=True, meio_pagamento=pix)
+        cartelas = maria.get_cartelas()
+        with self.assertNumQueries(1):
+            linhas = [
+                (cartela.numero, str(cartela.talao), str(cartela.responsavel), str(cartela.posse), str(cartela.meio_pagamento))
+                for cartela in cartelas
+            ]
+        self.assertEqual([linha[0] for linha in linhas], [1, 2, 3, 4, 5])
+        with self.assertNumQueries(1):
+            self.assertEqual(cartelas.get_valor_pago(), 8)
+            self.assertEqual(cartelas.get_valor_pendente_pagamento(), 32)
+            self.assertEqual(cartelas.get_valor_nao_pago(), 0)
+        self.assertEqual(
+            cartelas.filter(responsavel=joao).resumo(),
+            dict(total=3, pagas=0, pendentes_pagamento=3, nao_pagas=0, valor_pago=0, valor_pendente_pagamento=24, valor_nao_pago=0)
+        )
+
+
+class ResumoTestCase(TestCase):
+
+    def setUp(self):
+        self.evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=2, qtd_cartela_talao=5, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        EventoResumo.objects.recalcular(self.evento)
+        GerarCartelas(self.evento).run()
+        self.maria, self.joao = Pessoa.objects.create(nome='Maria'), Pessoa.objects.create(nome='João')
+        self.pix, self.dinheiro = MeioPagamento.objects.create(nome='PIX'), MeioPagamento.objects.create(nome='Dinheiro')
+        Cartela.objects.filter(numero__lte=4).atualizar(responsavel=self.maria)
+        Cartela.objects.filter(numero__in=(5, 6, 7)).atualizar(responsavel=self.joao, posse=self.maria)
+        Cartela.objects.filter(numero__in=(1, 2)).atualizar(realizou_pagamento=True, meio_pagamento=self.pix, comissao=1)
+        Cartela.objects.filter(numero=3).atualizar(realizou_pagamento=False)
+        cartela = Cartela.objects.get(numero=5)
+        cartela.realizou_pagamento, cartela.meio_pagamento, cartela.comissao = True, self.dinheiro, 2
+        cartela.save()
+
+    def get_resumo(self):
+        return EventoResumo.objects.filter(evento=self.evento).values(*EventoResumo.CONTADORES).first()
+
+    def verificar(self):
+        # os contadores mantidos pelas variações F() coincidem com os calculados a partir das cartelas
+        self.assertEqual(self.get_resumo(), self.evento.calcular_resumo())
+        meios = {
+            meio.meio_pagamento_id: (meio.quantidade, meio.comissao)
+            for meio in ResumoMeioPagamento.objects.filter(resumo__evento=self.evento) if meio.quantidade
+        }
+        self.assertEqual(meios, {
+            grupo['meio_pagamento']: (grupo['quantidade'], grupo['soma_comissao'])
+            for grupo in Cartela.objects.filter(evento=self.evento, meio_pagamento__isnull=False).pagas().agrupar_estado()
+        })
+
+    def test(self):
+        self.assertEqual(self.get_resumo(), dict(total=10, distribuidas=7, pagas=3, nao_pagas=1, pendentes_pagamento=3, comissao=4))
+        self.verificar()
+        self.assertEqual(
+            [(str(meio.meio_pagamento), meio.quantidade, meio.get_valor(), meio.comissao) for meio in self.evento.get_resumo_meio_pagamento()],
+            [('Dinheiro', 1, 8, 2), ('PIX', 2, 16, 2)]
+        )
+        # devolução e troca de meio de pagamento
+        Cartela.objects.filter(numero=2).atualizar(responsavel=None, realizou_pagamento=None, meio_pagamento=None, comissao=0)
+        cartela = Cartela.objects.get(numero=1)
+        cartela.meio_pagamento = self.dinheiro
+        cartela.save()
+        self.verificar()
+        self.assertEqual(self.get_resumo(), dict(total=10, distribuidas=6, pagas=2, nao_pagas=1, pendentes_pagamento=3, comissao=3))
+
+    def test_exclusao(self):
+        Cartela.objects.get(numero=4).delete()
+        self.verificar()
+        Cartela.objects.filter(numero__in=(1, 10)).delete()
+        self.verificar()
+        self.dinheiro.delete()
+        self.verificar()
+        # cartelas em que uma pessoa é responsável e a outra tem a posse são descontadas uma única vez
+        Pessoa.objects.filter(pk__in=(self.maria.pk, self.joao.pk)).delete()
+        self.verificar()
+        self.assertEqual(self.get_resumo()['total'], 2)
+        self.evento.talao_set.get(numero='002').delete()
+        self.verificar()
+        self.assertEqual(self.get_resumo()['total'], 0)
+        self.evento.delete()
+        self.assertFalse(EventoResumo.objects.exists())
+
+
+class ResumoFinanceiroTestCase(TestCase):
+
+    def test(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=2, qtd_cartela_talao=5, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        GerarCartelas(evento).run()
+        Cartela.objects.filter(numero__lte=6).atualizar(responsavel=Pessoa.objects.create(nome='Maria'))
+        Cartela.objects.filter(numero__in=(1, 2)).atualizar(realizou_pagamento=True, comissao=1)
+        Cartela.objects.filter(numero=3).atualizar(realizou_pagamento=True)
+        Cartela.objects.filter(numero=4).atualizar(realizou_pagamento=False)
+        with self.assertNumQueries(1):
+            resumo = evento.calcular_resumo()
+        self.assertEqual(resumo, dict(total=10, distribuidas=6, pagas=3, nao_pagas=1, pendentes_pagamento=2, comissao=2))
+        EventoResumo.objects.recalcular(evento)
+        evento = Evento.objects.get(pk=evento.pk)
+        # os valores do resumo financeiro saem de uma única leitura dos contadores, memorizada no evento
+        with self.assertNumQueries(1):
+            valores = [
+                evento.get_total_cartelas(), evento.get_total_cartelas_distribuidas(), evento.get_receita_esperada(),
+                evento.get_valor_recebido_venda(), evento.get_valor_recebido_doacao(), evento.get_valor_receber(),
+                evento.get_valor_perdido(), evento.get_receita_final(), evento.get_percentual_cartela_distribuida()['value'],
+            ]
+        self.assertEqual(valores, [10, 6, 48, 24, 4, 24, 8, 28, 60])
+
+
+class ExportacaoTestCase(TestCase):
+
+    def setUp(self):
+        self.evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=2, qtd_cartela_talao=5, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        GerarCartelas(self.evento).run()
+        maria = Pessoa.objects.create(nome='Maria')
+        Cartela.objects.filter(numero__lte=3).atualizar(responsavel=maria)
+        Cartela.objects.filter(numero=1).atualizar(realizou_pagamento=True, comissao=1)
+
+    def exportar(self, formato):
+        task = ExportarCartelasTask(self.evento.get_cartelas(), formato)
+        task.TAMANHO_LOTE = 3
+        # a contagem desatualizada não limita as linhas exportadas, só o progresso; as linhas vêm de uma só consulta
+        with mock.patch.object(type(task.qs), 'count', return_value=4), self.assertNumQueries(2):
+            caminho = task.run()
+        self.addCleanup(os.unlink, caminho)
+        self.assertEqual((task.partial, task.total), (2, 2))
+        return caminho
+
+    def test(self):
+        with open(self.exportar('csv'), encoding='iso8859-1') as arquivo:
+            linhas = arquivo.read().splitlines()
+        self.assertEqual(len(linhas), 11)
+        self.assertEqual(linhas[1], '00001,001,Maria,,8.00,1.00,Vendida com Comissão')
+        self.assertEqual(linhas[3], '00003,001,Maria,,8.00,0,Aguarando Prestação de Contas')
+        self.assertEqual(linhas[10], '00010,002,,,8.00,0,Aguarando Distribuição')
+
+    def test_xlsx(self):
+        import openpyxl
+        planilha = openpyxl.load_workbook(self.exportar('xlsx'), read_only=True)['Cartelas']
+        linhas = list(planilha.values)
+        self.assertEqual(linhas[0], ExportarCartelasTask.CABECALHO)
+        self.assertEqual(len(linhas), 11)
+        self.assertEqual(linhas[1][0], '00001')
+
+
+class SituacaoTestCase(TestCase):
+
+    def test(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=2, qtd_cartela_talao=5, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        GerarCartelas(evento).run()
+        Cartela.objects.filter(numero__lte=8).atualizar(responsavel=Pessoa.objects.create(nome='Maria'))
+        Cartela.objects.filter(numero__in=(1, 2)).atualizar(realizou_pagamento=True, comissao=1)
+        Cartela.objects.filter(numero=3).atualizar(realizou_pagamento=True)
+        Cartela.objects.filter(numero__in=(4, 5, 6)).atualizar(realizou_pagamento=False)
+        cartelas = evento.get_cartelas()
+        # cada situação corresponde a um subconjunto da listagem de cartelas
+        subconjuntos = dict(
+            aguardando_distribuicao='pendentes_distribuicao', aguardando_prestacao='pendentes_pagamento',
+            vendida_com_comissao='pagas_com_comissao', vendida_sem_comissao='pagas_sem_comissao', nao_paga='nao_pagas'
+        )
+        for situacao, subconjunto in subconjuntos.items():
+            self.assertEqual(
+                set(getattr(cartelas, subconjunto)().values_list('numero', flat=True)),
+                set(cartelas.filter(situacao=situacao).values_list('numero', flat=True)), situacao
+            )
+        self.assertEqual(
+            [cartelas.filter(situacao=situacao).count() for situacao in Cartela.SITUACOES], [2, 2, 2, 1, 3]
+        )
+        # as três classificações (banco de dados, Python e NumPy) coincidem
+        linhas = list(cartelas.order_by('numero').values_list('responsavel_id', 'realizou_pagamento', 'comissao', 'situacao'))
+        self.assertEqual([linha[3] for linha in linhas], [Cartela.classificar_situacao(*linha[:3]) for linha in linhas])
+        codigos = classificar_situacoes(*[
+            [np.nan if valor is None else valor for valor in coluna] for coluna in list(zip(*linhas))[:3]
+        ])
+        self.assertEqual([list(Cartela.SITUACOES)[codigo] for codigo in codigos], [linha[3] for linha in linhas])
+
+
+class GeracaoTestCase(TestCase):
+
+    def test(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=5, qtd_cartela_talao=4, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        EventoResumo.objects.recalcular(evento)
+        with CaptureQueriesContext(connection) as consultas:
+            GerarCartelas(evento, tamanho_lote=8).run()
+        # dois talões por comando: um INSERT de cartelas por lote, não por cartela ou por talão
+        insercoes = [consulta for consulta in consultas if consulta['sql'].strip().startswith('INSERT INTO "bingo_cartela"')]
+        self.assertEqual(len(insercoes), 3)
+        taloes = dict(evento.talao_set.values_list('numero', 'id'))
+        self.assertEqual(sorted(taloes), ['001', '002', '003', '004', '005'])
+        cartelas = list(Cartela.objects.filter(evento=evento).order_by('numero').values_list('numero', 'talao', 'grade'))
+        self.assertEqual([numero for numero, _, _ in cartelas], list(range(1, 21)))
+        self.assertEqual([talao for _, talao, _ in cartelas[16:]], [taloes['005']] * 4)
+        self.assertEqual(len({bytes(grade) for _, _, grade in cartelas}), 20)
+        self.assertEqual(EventoResumo.objects.get(evento=evento).total, 20)
+
+
+class NumeracaoTestCase(TestCase):
+
+    def test(self):
+        eventos = [Evento.objects.create(
+            nome=nome, data=date.today(), qtd_taloes=1, qtd_cartela_talao=1, valor_venda_cartela=10, valor_comissao_cartela=2
+        ) for nome in ('Evento 1', 'Evento 2')]
+        for evento in eventos:
+            talao = Talao.objects.create(numero='001', evento=evento)
+            for numero in (9, 10, 100):
+                # o evento é preenchido a partir do talão
+                Cartela.objects.create(numero=numero, talao=talao)
+        self.assertEqual(Cartela.objects.filter(evento=eventos[0]).count(), 3)
+        self.assertEqual(str(Cartela.objects.get(evento=eventos[0], numero=9)), '00009')
+        self.assertEqual(Cartela.formatar_numero(100), '00100')
+        # ordenação e intervalos numéricos, não lexicográficos
+        self.assertEqual(list(Cartela.objects.filter(evento=eventos[1]).order_by('numero').values_list('numero', flat=True)), [9, 10, 100])
+        self.assertEqual(
+            list(Cartela.objects.filter(evento=eventos[1], numero__range=(9, 10)).values_list('evento', 'numero').order_by('numero')),
+            [(eventos[1].pk, 9), (eventos[1].pk, 10)]
+        )
+
+
+class OperacaoLoteTestCase(TestCase):
+
+    def test(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=5, qtd_cartela_talao=10, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        EventoResumo.objects.recalcular(evento)
+        GerarCartelas(evento).run()
+        maria, pix = Pessoa.objects.create(nome='Maria'), MeioPagamento.objects.create(nome='PIX')
+        self.assertEqual(CartelaBatchService(evento.pk, 1, 20, tamanho_lote=7).aplicar('distribuir', responsavel=maria), dict(aplicadas=20, ignoradas=0))
+        # as cartelas já distribuídas não atendem à pré-condição e são ignoradas; o intervalo pode vir invertido
+        self.assertEqual(CartelaBatchService(evento.pk, 25, 15).aplicar('distribuir', responsavel=maria), dict(aplicadas=5, ignoradas=6))
+        self.assertEqual(
+            CartelaBatchService(evento.pk, 1, 10).aplicar('prestar_conta', realizou_pagamento=True, meio_pagamento=pix, comissao=2),
+            dict(aplicadas=10, ignoradas=0)
+        )
+        # as cartelas pagas não podem ser devolvidas
+        self.assertEqual(
+            CartelaBatchService(evento.pk, 1, 50).aplicar('devolver', responsavel=None, posse=None, realizou_pagamento=None, meio_pagamento=None, comissao=0),
+            dict(aplicadas=15, ignoradas=35)
+        )
+        self.assertEqual(Cartela.objects.filter(evento=evento, responsavel=maria).count(), 10)
+        self.assertEqual(Cartela.objects.filter(evento=evento, responsavel=maria, realizou_pagamento=True).count(), 10)
+        resumo = EventoResumo.objects.get(evento=evento)
+        self.assertEqual((resumo.total, resumo.distribuidas, resumo.pagas), (50, 10, 10))
+        self.assertEqual(Evento.objects.get(pk=evento.pk).get_resumo(), evento.calcular_resumo())
+
+
+class GradeTestCase(TestCase):
+
+    def test(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=4, qtd_cartela_talao=25, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        GerarCartelas(evento, tamanho_lote=30).run()
+        grades = dict(Cartela.objects.filter(evento=evento).values_list('numero', 'grade'))
+        self.assertEqual(len(set(map(bytes, grades.values()))), 100)
+        self.assertEqual(bytes(grades[42]), empacotar(gerar(evento.semente, [42]))[0])
+        linhas = Cartela.objects.get(evento=evento, numero=1).get_grade()
+        self.assertIsNone(linhas[2][2])
+        for i, coluna in enumerate(zip(*linhas)):
+            numeros = [numero for numero in coluna if numero]
+            self.assertEqual(numeros, sorted(numeros))
+            self.assertTrue(all(15 * i < numero <= 15 * (i + 1) for numero in numeros))
+        # as cartelas online recomeçam a numeração no talão 000, então a grade já usada é gerada novamente
+        cartela = evento.gerar_cartelas_online(1)[0]
+        self.assertEqual(cartela.numero, 1)
+        self.assertNotEqual(bytes(cartela.grade), bytes(grades[1]))
+        self.assertEqual(bytes(cartela.grade), empacotar(gerar(evento.semente, [1], 1))[0])
+        self.assertEqual(len(set(empacotar(gerar_unicas(evento.semente, [1, 1, 2])))), 3)
+
+
+class SorteioTestCase(TestCase):
+
+    def test(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=2, qtd_cartela_talao=50, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        GerarCartelas(evento).run()
+        Cartela.objects.filter(numero__lte=50).atualizar(responsavel=Pessoa.objects.create(nome='Maria'), realizou_pagamento=True)
+        paga, nao_paga = Cartela.objects.get(evento=evento, numero=7), Cartela.objects.get(evento=evento, numero=70)
+        sorteio = Sorteio.objects.create(evento=evento)
+        primeira_linha = paga.get_grade()[0]
+        for numero in primeira_linha:
+            _, linha, cheia = sorteio.sortear(numero)
+        self.assertIn(paga.pk, linha)
+        self.assertEqual(sorteio.get_numeros(), primeira_linha)
+        self.assertEqual(
+            set(sorteio.get_ganhadores().values_list('cartela', flat=True)),
+            set(Ganhador.objects.filter(sorteio=sorteio, tipo=Ganhador.LINHA).values_list('cartela', flat=True))
+        )
+        # a apuração em memória é refeita a partir dos números gravados, como após um reinício
+        descartar(sorteio.pk)
+        sorteio = Sorteio.objects.get(pk=sorteio.pk)
+        for numero in [numero for linha in paga.get_grade()[1:] for numero in linha if numero]:
+            if sorteio.fim is None and numero not in sorteio.get_numeros():
+                sorteio.sortear(numero)
+        self.assertIsNotNone(sorteio.fim)
+        cheias = sorteio.get_ganhadores().filter(tipo=Ganhador.CHEIA).values_list('cartela', flat=True)
+        self.assertIn(paga.pk, cheias)
+        self.assertNotIn(nao_paga.pk, sorteio.get_ganhadores().values_list('cartela', flat=True))
+        self.assertEqual(sorteio.get_ganhadores().filter(tipo=Ganhador.LINHA, ordem__gt=5).count(), 0)
+
+    def test_cartelas_pagas_depois(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=1, qtd_cartela_talao=50, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        GerarCartelas(evento).run()
+        maria = Pessoa.objects.create(nome='Maria')
+        Cartela.objects.filter(numero__lte=25).atualizar(responsavel=maria, realizou_pagamento=True)
+        nova, devolvida = Cartela.objects.get(evento=evento, numero=40), Cartela.objects.get(evento=evento, numero=7)
+        sorteio = Sorteio.objects.create(evento=evento)
+        numeros = [numero for linha in nova.get_grade() for numero in linha if numero]
+        for numero in numeros[:3]:
+            sorteio.sortear(numero)
+        # pagamento e estorno depois do início do sorteio
+        Cartela.objects.filter(pk=nova.pk).atualizar(responsavel=maria, realizou_pagamento=True)
+        Cartela.objects.filter(pk=devolvida.pk).atualizar(realizou_pagamento=False)
+        for numero in [numero for linha in devolvida.get_grade() for numero in linha if numero and numero not in numeros]:
+            sorteio.sortear(numero)
+        self.assertIsNone(sorteio.fim)
+        for numero in numeros[3:]:
+            _, linha, cheia = sorteio.sortear(numero)
+        self.assertEqual(cheia, [nova.pk])
+        self.assertNotIn(devolvida.pk, sorteio.get_ganhadores().values_list('cartela', flat=True))
+
+    def test_adicionar(self):
+        # cartelas adicionadas durante o sorteio ficam no mesmo estado das carregadas desde o início
+        grades = carregar(empacotar(gerar(gerar_semente(), range(1, 201))))
+        numeros = [int(numero) for numero in np.random.default_rng(1).permutation(75)[:30] + 1]
+        completa = Apuracao(range(200), grades)
+        parcial = Apuracao(range(150), grades[:150])
+        for numero in numeros[:20]:
+            completa.sortear(numero)
+            parcial.sortear(numero)
+        parcial.adicionar(range(150, 200), grades[150:])
+        for numero in numeros[20:]:
+            self.assertEqual(completa.sortear(numero), parcial.sortear(numero))
+        for atributo in 'ids', 'colunas', 'faltam_linhas', 'faltam_colunas', 'faltam_diagonais', 'faltam', 'linha':
+            self.assertTrue(np.array_equal(getattr(completa, atributo), getattr(parcial, atributo)), atributo)
+
+
+class MonitoramentoTestCase(TransactionTestCase):
+
+    @override_settings(REDIS_HOST=None)
+    def test(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=1, qtd_cartela_talao=10, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        GerarCartelas(evento).run()
+        evento.get_resumo()
+        pessoa = Pessoa.objects.create(nome='Pessoa')
+        canal = 'evento:{}'.format(evento.pk)
+        # as variações de uma transação são somadas numa só publicação, depois do commit e sem nova consulta
+        with mock.patch.object(monitoramento, 'publicar') as publicar, transaction.atomic():
+            for cartela in Cartela.objects.filter(evento=evento)[:3]:
+                cartela.responsavel = pessoa
+                cartela.save()
+            with self.assertNumQueries(0):
+                monitoramento.agendar(canal, dict(evento=evento.pk, variacao=dict(distribuidas=1)))
+        publicar.assert_called_once_with(canal, dict(evento=evento.pk, variacao=dict(distribuidas=4, pendentes_pagamento=3)))
+
+        async def receber():
+            async def carregar():
+                return dict(distribuidas=0)
+            mensagens = monitoramento.transmitir(canal, carregar, lambda dados: 'variacao' in dados)
+            recebidas = [await mensagens.__anext__()]
+            # as variações que chegam antes da leitura são combinadas
+            monitoramento.publicar('evento:0', dict(variacao=dict(distribuidas=5)))
+            monitoramento.publicar(canal, dict(variacao=dict(distribuidas=3)))
+            monitoramento.publicar(canal, dict(variacao=dict(distribuidas=1, pagas=1)))
+            return recebidas + [mensagem async for mensagem in mensagens]
+        recebidas = asyncio.run(receber())
+        self.assertEqual(len(recebidas), 2)
+        self.assertTrue(recebidas[0].startswith('retry: 3000\ndata: {"distribuidas": 0}'))
+        self.assertEqual(recebidas[1], 'data: {"variacao": {"distribuidas": 4, "pagas": 1}}\n\n')
+
+    @mock.patch.dict(os.environ, MONITORAMENTO_SSE='1')
+    def test_acesso(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=1, qtd_cartela_talao=10, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        GerarCartelas(evento).run()
+        painel = evento.get_painel_monitoramento()
+        self.assertEqual(painel['type'], 'html')
+        self.assertIn('<iframe srcdoc=', painel['content'])
+        self.assertIn('EventSource', painel['content'])
+        chave = monitoramento.assinar('evento:{}'.format(evento.pk))
+        self.assertTrue(monitoramento.verificar(chave, 'evento:{}'.format(evento.pk)))
+        self.assertFalse(monitoramento.verificar(chave, 'evento:0'))
+
+        async def requisitar(url):
+            response = await AsyncClient().get(url)
+            if response.status_code != 200:
+                return response.status_code, None
+            mensagens = response.streaming_content.__aiter__()
+            return response.status_code, (await mensagens.__anext__()).decode()
+        url = '/api/v1/assincrono/monitorar_evento/{}/'.format(evento.pk)
+        self.assertEqual(asyncio.run(requisitar(url))[0], 403)
+        self.assertEqual(asyncio.run(requisitar(url + '?chave=' + monitoramento.assinar('evento:0')))[0], 403)
+        status, mensagem = asyncio.run(requisitar(url + '?chave=' + chave))
+        self.assertEqual(status, 200)
+        self.assertIn('"total": 10', mensagem)
+        # a página da compra só mantém a conexão enquanto o pagamento não é confirmado
+        compra = CompraOnline(uuid='abc', status='pending')
+        conteudo = compra.get_painel_monitoramento()['content']
+        # o documento do iframe vai escapado no atributo srcdoc
+        self.assertEqual(conteudo.count('"'), 4)
+        self.assertIn('monitorar_compra_online/?uuid\\u003Dabc', html.unescape(conteudo))
+        compra.status = 'approved'
+        self.assertIsNone(compra.get_painel_monitoramento())
+
+    def visualizar(self, uuid):
+        request = RequestFactory().get('/api/v1/visualizar_compra_online/', dict(uuid=uuid))
+        request.user = AnonymousUser()
+        return VisualizarCompraOnline(context=dict(request=request)).get()
+
+    @mock.patch.dict(os.environ, MONITORAMENTO_SSE='')
+    def test_wsgi(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=1, qtd_cartela_talao=10, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        # sem o ASGI o painel do evento só exibe os percentuais e a página da compra volta ao autoreload
+        painel = evento.get_painel_monitoramento()
+        self.assertIn('Cartelas pagas', painel['content'])
+        self.assertNotIn('EventSource', painel['content'])
+        compra = CompraOnline.objects.create(nome='Maria', cpf='123.456.789-00', numero_cartelas=1, status=CompraOnline.CRIANDO)
+        CompraOnline.objects.filter(pk=compra.pk).update(status='pending', url='http://localhost')
+        cache.clear()
+        valores = self.visualizar(compra.uuid)
+        self.assertEqual((valores.autoreload, valores.fields), (30, ('cpf', 'nome', 'data_hora', 'valor', 'get_status_atual', 'get_cartelas')))
+        # a conexão de monitoramento não ocupa um worker síncrono
+        self.assertEqual(self.client.get('/api/v1/assincrono/monitorar_compra_online/?uuid={}'.format(compra.uuid)).status_code, 503)
+
+
+class BenchmarkTestCase(TestCase):
+
+    def setUp(self):
+        SENTINELAS.clear()
+
+    def test(self):
+        evento = benchmarks.popular(qtd_taloes=4, qtd_cartela_talao=10, qtd_pessoas=4, qtd_compras=10)
+        # 30 cartelas distribuídas em blocos de 7, 7, 7 e 9: 70% pagas e a última de cada bloco não paga
+        cartelas = Cartela.objects.filter(evento=evento, responsavel__isnull=False).exclude(responsavel__cpf='00000000000')
+        self.assertEqual(cartelas.count(), 30)
+        self.assertEqual(cartelas.filter(realizou_pagamento=True).count(), 18)
+        self.assertEqual(cartelas.filter(realizou_pagamento=False).count(), 4)
+        self.assertEqual(list(cartelas.filter(responsavel__cpf='00000000004').values_list('numero', flat=True).order_by('numero')), list(range(22, 31)))
+        # 7 compras aprovadas com 2 cartelas online cada
+        compras = CompraOnline.objects.filter(evento=evento)
+        self.assertEqual((compras.count(), compras.filter(status='approved').count()), (10, 7))
+        self.assertEqual(Cartela.objects.filter(compraonline__in=compras).count(), 14)
+        self.assertEqual(Evento.objects.get(pk=evento.pk).get_resumo(), evento.calcular_resumo())
+
+    def test_execucao(self):
+        eventos = Evento.objects.count()
+        resultados = benchmarks.distribuicao_lote(tamanhos=(100,)) + benchmarks.resumo_financeiro(tamanhos=(100,))
+        self.assertEqual([resultado['linhas'] for resultado in resultados], [100, 100, 100, 100, 100, 1])
+        self.assertTrue(all(resultado['segundos'] >= 0 for resultado in resultados))
+        # os dados gerados são descartados ao final de cada benchmark
+        self.assertEqual(Evento.objects.count(), eventos)
+
+    def test_comando(self):
+        saida = StringIO()
+        caminho = mkstemp(suffix='.json')[1]
+        self.addCleanup(os.unlink, caminho)
+        call_command('benchmark', 'apuracao_sorteio', 'classificacao_situacao', '--tamanhos', '500', '--json', caminho, stdout=saida)
+        linhas = saida.getvalue().splitlines()
+        self.assertEqual(len(linhas), 4)
+        self.assertTrue(linhas[1].startswith('apuracao_sorteio: 500 cartelas x 75 bolas em '))
+        self.assertIn('ms_bola_media=', linhas[1])
+        with open(caminho) as arquivo:
+            resultados = json.load(arquivo)['resultados']
+        self.assertEqual([resultado['benchmark'] for resultado in resultados], ['apuracao_sorteio'] * 3 + ['classificacao_situacao'])
+        self.assertTrue(all('linhas_segundo' in resultado for resultado in resultados))
+
+
+class ImpressaoTestCase(TestCase):
+
+    def test(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=3, qtd_cartela_talao=5, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        GerarCartelas(evento).run()
+        cartela = Cartela.objects.get(evento=evento, numero=7)
+        with WeasyprintStub() as stub, mock.patch.dict(os.environ, WEASYPRINT_URL=stub.url):
+            file_path = ImprimirCartelasTask(evento.get_cartelas(), workers=2).run()
+        try:
+            with zipfile.ZipFile(file_path) as arquivo:
+                nomes = arquivo.namelist()
+                self.assertEqual(nomes, ['evento-{}/talao-{:03d}.pdf'.format(evento.pk, i) for i in range(1, 4)])
+                self.assertTrue(all(arquivo.read(nome).startswith(b'%PDF') for nome in nomes))
+        finally:
+            os.unlink(file_path)
+        self.assertEqual(len(stub.requisicoes), 3)
+        documento = next(documento for documento in stub.requisicoes if 'Cartela 00007' in documento)
+        self.assertEqual(documento.count('class="cartela"'), 5)
+        self.assertIn('<svg', documento)
+        self.assertIn(''.join('<td>{}</td>'.format(numero) for numero in cartela.get_grade()[0]), documento)
+
+    def test_contagem(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=3, qtd_cartela_talao=2, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        GerarCartelas(evento).run()
+        # talões criados depois da contagem também vão para o ZIP; a contagem só estima o progresso
+        with WeasyprintStub() as stub, mock.patch.dict(os.environ, WEASYPRINT_URL=stub.url):
+            task = ImprimirCartelasTask(evento.get_cartelas(), workers=1)
+            with mock.patch.object(type(task.qs), 'count', return_value=1):
+                file_path = task.run()
+        try:
+            with zipfile.ZipFile(file_path) as arquivo:
+                self.assertEqual(len(arquivo.namelist()), 3)
+        finally:
+            os.unlink(file_path)
+        self.assertEqual((task.total, task.partial), (1, 1))
+
+
+class AlocacaoOnlineTestCase(TransactionTestCase):
+
+    def test(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=1, qtd_cartela_talao=10, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+
+        SENTINELAS.clear()
+        pessoa, meio_pagamento = CompraOnline.get_sentinelas()
+
+        def comprar(i):
+            try:
+                return [cartela.numero for cartela in evento.gerar_cartelas_online(
+                    3, responsavel_id=pessoa, meio_pagamento_id=meio_pagamento, realizou_pagamento=True, comissao=0
+                )]
+            finally:
+                connection.close()
+
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            numeros = [numero for lote in executor.map(comprar, range(100)) for numero in lote]
+        segundos = time.perf_counter() - inicio
+        self.assertEqual(sorted(numeros), list(range(1, 301)))
+        self.assertEqual(Cartela.objects.filter(evento=evento).count(), 300)
+        self.assertEqual(evento.talao_set.count(), 1)
+        self.assertEqual(evento.get_total_cartelas(), 300, '{:.0f} alocações/s'.format(100 / segundos))
+
+
+class PerfilTestCase(SimpleTestCase):
+
+    def carregar(self, **variaveis):
+        ambiente = {chave: valor for chave, valor in os.environ.items() if chave != 'BINGO_PERFIL'}
+        with mock.patch.dict(os.environ, dict(ambiente, **variaveis), clear=True):
+            return runpy.run_path(os.path.join(os.path.dirname(__file__), 'settings.py'))
+
+    def test(self):
+        # o perfil de produção só é ativado explicitamente
+        configuracao = self.carregar(POSTGRES_HOST='postgres')
+        self.assertEqual(configuracao['PERFIL'], 'desenvolvimento')
+        self.assertNotIn('REGISTRAR_CONSULTAS', configuracao)
+        configuracao = self.carregar(POSTGRES_HOST='postgres', BINGO_PERFIL='producao')
+        self.assertEqual(configuracao['PERFIL'], 'producao')
+        self.assertFalse(configuracao['DEBUG'])
+        self.assertFalse(configuracao['REGISTRAR_CONSULTAS'])
+        self.assertTrue(self.carregar(BINGO_PERFIL='producao', BINGO_DEBUG='1')['DEBUG'])
+        # sem o DEBUG, /static/ e /media/ continuam servidos
+        self.assertIs(resolve('/static/bingo/estilo.css').func, serve)
+        self.assertIs(resolve('/media/arquivo.pdf').func, serve)
+
+    def test_registro_consultas(self):
+        conexao = mock.Mock(queries_log=[])
+        checks.desativar_registro_consultas(None, conexao)
+        conexao.queries_log.append(dict(sql='SELECT 1', time='0.001'))
+        self.assertEqual(len(conexao.queries_log), 0)
+
+
+class InstrumentacaoTestCase(TestCase):
+
+    def setUp(self):
+        instrumentacao.METRICAS['endpoints'].clear()
+        instrumentacao.METRICAS['metodos'].clear()
+
+    def test(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=1, qtd_cartela_talao=10, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        GerarCartelas(evento).run()
+
+        def view(request):
+            for numero in (1, 2, 3):
+                Cartela.objects.get(evento=evento, numero=numero)
+            evento.get_cartelas().get_valor_pago()
+            return HttpResponse()
+        with mock.patch.dict(os.environ, INSTRUMENTACAO_AMOSTRAGEM='0'):
+            with self.assertRaises(MiddlewareNotUsed):
+                instrumentacao.InstrumentacaoMiddleware(view)
+        with mock.patch.dict(os.environ, INSTRUMENTACAO_AMOSTRAGEM='1'):
+            middleware = instrumentacao.InstrumentacaoMiddleware(view)
+            with self.assertLogs('bingo.instrumentacao') as registros:
+                for i in range(2):
+                    middleware(RequestFactory().get('/cartelas/'))
+        registro = json.loads(registros.records[0].getMessage())
+        self.assertEqual((registro['endpoint'], registro['consultas'], registro['status']), ('/cartelas/', 4, 200))
+        # as consultas repetidas com parâmetros diferentes são agrupadas
+        self.assertEqual(list(registro['duplicadas'].values()), [3])
+        self.assertEqual(registro['metodos'], {'Cartela.get_valor_pago': 1})
+        # as métricas só são exibidas ao coletor com o token ou ao superusuário
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with mock.patch.dict(os.environ, METRICAS_TOKEN='segredo'):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer outro').status_code, 403)
+            metricas = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer segredo').content.decode()
+        self.assertIn('bingo_requisicoes_total{endpoint="/cartelas/"} 2', metricas)
+        self.assertIn('bingo_sql_consultas_total{endpoint="/cartelas/"} 8', metricas)
+        self.assertIn('bingo_sql_duplicadas_total{endpoint="/cartelas/"} 4', metricas)
+        self.assertIn('bingo_metodo_sql_consultas_total{metodo="Cartela.get_valor_pago"} 2', metricas)
+        self.client.force_login(User.objects.create_superuser('admin', password='123'))
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_assincrono(self):
+        evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=1, qtd_cartela_talao=10, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+
+        async def view(request):
+            await sync_to_async(lambda: list(Cartela.objects.filter(evento=evento)))()
+            await Evento.objects.filter(pk=evento.pk).afirst()
+            return HttpResponse()
+        with mock.patch.dict(os.environ, INSTRUMENTACAO_AMOSTRAGEM='1'):
+            middleware = instrumentacao.InstrumentacaoMiddleware(view)
+            # a view assíncrona é chamada sem adaptação e as consultas das threads do sync_to_async são contadas
+            self.assertTrue(iscoroutinefunction(middleware))
+            with self.assertLogs('bingo.instrumentacao') as registros:
+                asyncio.run(middleware(RequestFactory().get('/assincrono/')))
+        self.assertEqual(json.loads(registros.records[0].getMessage())['consultas'], 2)
+
+
+class CpfTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test(self):
+        self.assertEqual(normalizar_cpf(' 123.456.789-00 '), '12345678900')
+        self.assertIsNone(normalizar_cpf(None))
+        self.assertEqual(Pessoa.objects.create(nome='Maria', cpf='123.456.789-00').cpf, '12345678900')
+        Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=1, qtd_cartela_talao=10, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        compras = [
+            CompraOnline.objects.create(nome='Maria', cpf=cpf, numero_cartelas=1, status=CompraOnline.CRIANDO).pk
+            for cpf in ('123.456.789-00', '12345678900', '987.654.321-00')
+        ]
+        self.assertEqual(sorted(CompraOnline.objects.get_ids_por_cpf('123 456 789 00')), compras[:2])
+        # as buscas por CPF e UUID usam os índices
+        for tabela, indices in (('bingo_pessoa', {'pessoa_cpf_idx'}), ('bingo_compraonline', {'compraonline_cpf_idx', 'compraonline_uuid_idx'})):
+            with connection.cursor() as cursor:
+                self.assertTrue(indices.issubset(connection.introspection.get_constraints(cursor, tabela)))
+
+    @override_settings(AUTHENTICATION_BACKENDS=['bingo.autenticacao.CpfBackend'])
+    def test_login(self):
+        User.objects.create_user('12345678900', password='123')
+        self.assertEqual(authenticate(username='123.456.789-00', password='123').username, '12345678900')
+        self.assertEqual(authenticate(username='12345678900', password='123').username, '12345678900')
+        self.assertIsNone(authenticate(username='123.456.789-00', password='456'))
+
+
+class ConciliacaoTestCase(TestCase):
+
+    def setUp(self):
+        self.stub = MercadoPagoStub().start()
+        self.ambiente = mock.patch.dict(os.environ, TOKEN_MERCADO_PAGO='TESTE', MERCADO_PAGO_URL=self.stub.url)
+        self.ambiente.start()
+        mercadopago._cliente = None
+        mercadopago._sdks.clear()
+        SENTINELAS.clear()
+        Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=1, qtd_cartela_talao=10, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+
+    def tearDown(self):
+        self.ambiente.stop()
+        self.stub.stop()
+        mercadopago._cliente = None
+        mercadopago._sdks.clear()
+
+    def test(self):
+        compras = [CompraOnline.objects.create(nome='Maria Silva', cpf='12345678900', numero_cartelas=2) for i in range(6)]
+        for compra in compras[:3]:
+            self.stub.pagar(compra.uuid)
+        self.stub.pagar(compras[3].uuid, 'rejected')
+        # pagamento anterior à janela de busca: não é encontrado
+        self.stub.pagar(compras[4].uuid, data_hora=datetime.now(tz.utc) - timedelta(days=3))
+        for i in range(120):
+            self.stub.pagar('outra{}'.format(i), 'pending')
+        resumo = ConciliacaoPagamentos(intervalo=0, limite=50).executar()
+        # 125 pagamentos na janela, em páginas de 50
+        self.assertEqual(resumo['requisicoes'], 3)
+        self.assertFalse(resumo['incompleta'])
+        self.assertEqual((resumo['verificadas'], resumo['atualizadas'], resumo['aprovadas']), (6, 4, 3))
+        buscas = [parametros for metodo, caminho, parametros in self.stub.requisicoes if caminho == '/v1/payments/search']
+        self.assertEqual([int(parametros['offset']) for parametros in buscas], [0, 50, 100])
+        # as datas enviadas têm o deslocamento UTC e cobrem as últimas 48 horas
+        inicio, fim = (datetime.fromisoformat(buscas[0][campo]) for campo in ('begin_date', 'end_date'))
+        self.assertIsNotNone(inicio.tzinfo)
+        self.assertEqual(fim - inicio, timedelta(hours=48))
+        self.assertLess(abs(fim - datetime.now(tz.utc)), timedelta(minutes=1))
+        situacoes = [CompraOnline.objects.get(pk=compra.pk).status for compra in compras]
+        self.assertEqual(situacoes[:4], ['approved', 'approved', 'approved', 'rejected'])
+        self.assertNotEqual(situacoes[4], 'approved')
+        self.assertEqual([compra.cartelas.count() for compra in compras[:4]], [2, 2, 2, 0])
+        # compras aprovadas não são verificadas de novo; o orçamento de requisições interrompe a busca
+        resumo = ConciliacaoPagamentos(intervalo=0, requisicoes=1, limite=50).executar()
+        self.assertEqual((resumo['verificadas'], resumo['requisicoes'], resumo['incompleta']), (3, 1, True))
+
+
+class ReservaOnlineTestCase(TestCase):
+
+    def setUp(self):
+        SENTINELAS.clear()
+        self.evento = Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=1, qtd_cartela_talao=10, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+        EventoResumo.objects.recalcular(self.evento)
+
+    def get_resumo(self):
+        resumo = EventoResumo.objects.get(evento=self.evento)
+        return dict(total=resumo.total, distribuidas=resumo.distribuidas, pagas=resumo.pagas)
+
+    def comprar(self, numero_cartelas):
+        compra = CompraOnline.objects.create(nome='Maria Silva', cpf='12345678900', numero_cartelas=numero_cartelas, status=CompraOnline.CRIANDO)
+        compra.status = 'approved'
+        compra.alocar_cartelas()
+        return sorted(compra.cartelas.values_list('numero', flat=True))
+
+    def verificar(self):
+        with mock.patch.dict(os.environ, CARTELAS_ONLINE_RESERVA='5'), mock.patch.object(tasks, 'executar') as executar:
+            tasks.PreencherReservaOnline(self.evento).run()
+            self.assertEqual(self.evento.get_reserva_online().count(), 5)
+            # as cartelas da reserva não contam no total enquanto não são vendidas
+            self.assertEqual(self.get_resumo(), dict(total=0, distribuidas=0, pagas=0))
+            self.assertEqual(self.comprar(2), [1, 2])
+            self.assertEqual(self.get_resumo(), dict(total=2, distribuidas=2, pagas=2))
+            self.assertEqual(self.evento.get_reserva_online().count(), 3)
+            executar.assert_not_called()
+            # reserva esgotada: as cartelas que faltam são geradas na hora e o preenchimento é agendado
+            self.assertEqual(self.comprar(4), [3, 4, 5, 6])
+            self.assertEqual(self.get_resumo(), dict(total=6, distribuidas=6, pagas=6))
+            self.assertFalse(self.evento.get_reserva_online().exists())
+            executar.assert_called_with(tasks.preencher_reserva_online, self.evento.pk)
+            tasks.PreencherReservaOnline(self.evento).run()
+        self.assertEqual(self.get_resumo(), dict(total=6, distribuidas=6, pagas=6))
+        resumo = EventoResumo.objects.recalcular(self.evento)
+        self.assertEqual((resumo.total, resumo.distribuidas, resumo.pagas), (6, 6, 6))
+        # a exclusão da reserva não altera o total
+        self.evento.get_reserva_online().delete()
+        self.assertEqual(self.get_resumo(), dict(total=6, distribuidas=6, pagas=6))
+
+    def test(self):
+        # o resgate sem SKIP LOCKED no UPDATE, usado fora do PostgreSQL
+        with mock.patch.object(Evento, 'resgatar_postgres', Evento.resgatar):
+            self.verificar()
+
+    @skipUnless(connection.vendor == 'postgresql', 'UPDATE ... FOR UPDATE SKIP LOCKED exige PostgreSQL')
+    def test_postgres(self):
+        self.verificar()
+
+
+class CheckoutTestCase(TestCase):
+
+    def setUp(self):
+        self.stub = MercadoPagoStub().start()
+        self.ambiente = mock.patch.dict(os.environ, TOKEN_MERCADO_PAGO='TESTE', MERCADO_PAGO_URL=self.stub.url)
+        self.ambiente.start()
+        mercadopago._cliente = None
+        mercadopago._sdks.clear()
+        cache.clear()
+        Evento.objects.create(
+            nome='Evento', data=date.today(), qtd_taloes=1, qtd_cartela_talao=10, valor_venda_cartela=10, valor_comissao_cartela=2
+        )
+
+    def tearDown(self):
+        self.ambiente.stop()
+        self.stub.stop()
+        mercadopago._cliente = None
+        mercadopago._sdks.clear()
+
+    def criar(self, minutos):
+        compra = CompraOnline.objects.create(nome='Maria Silva', cpf='12345678900', numero_cartelas=1, status=CompraOnline.CRIANDO)
+        CompraOnline.objects.filter(pk=compra.pk).update(data_hora=compra.data_hora - timedelta(minutes=minutos))
+        return compra
+
+    def test(self):
+        recente, perdida, expirada = self.criar(0), self.criar(5), self.criar(60)
+        # os checkouts reenviados são executados na hora em vez de no pool
+        with mock.patch.object(tasks, 'executar', side_effect=lambda funcao, *args: funcao(*args)) as executar:
+            self.assertEqual(retomar_checkouts(), (1, 1))
+            # a compra reenviada não é reenviada de novo dentro do prazo
+            CompraOnline.objects.filter(pk=perdida.pk).update(status=CompraOnline.CRIANDO)
+            self.assertEqual(retomar_checkouts(), (0, 0))
+        self.assertEqual(executar.call_count, 1)
+        situacoes = dict(CompraOnline.objects.values_list('pk', 'status'))
+        self.assertEqual([situacoes[compra.pk] for compra in (recente, perdida, expirada)], [CompraOnline.CRIANDO, CompraOnline.CRIANDO, CompraOnline.FALHA])
+        self.assertTrue(CompraOnline.objects.get(pk=perdida.pk).url.startswith(self.stub.url))
+
+    def test_visualizacao(self):
+        perdida = self.criar(5)
+        with mock.patch.object(tasks, 'executar') as executar:
+            response = self.client.get('/api/v1/assincrono/visualizar_compra_online/', dict(uuid=perdida.uuid))
+        self.assertEqual(response.json()['status']['label'], 'Gerando Pagamento')
+        executar.assert_called_once_with(tasks.criar_checkout, perdida.pk)
+        # a página de espera é recarregada mesmo sem o painel de monitoramento
+        request = RequestFactory().get('/api/v1/visualizar_compra_online/', dict(uuid=perdida.uuid))
+        request.user = AnonymousUser()
+        with mock.patch.object(tasks, 'executar'):
+            self.assertEqual(VisualizarCompraOnline(context=dict(request=request)).get().autoreload, 3)
+
+    def test_comando(self):
+        perdida, expirada = self.criar(5), self.criar(60)
+        saida = StringIO()
+        call_command('processar_checkouts', '--uma-vez', stdout=saida)
+        self.assertEqual(saida.getvalue().strip(), '1 checkout(s) reenviado(s), 1 expirado(s)')
+        compra = CompraOnline.objects.get(pk=perdida.pk)
+        self.assertTrue(compra.url.startswith(self.stub.url))
+        self.assertEqual(CompraOnline.objects.get(pk=expirada.pk).status, CompraOnline.FALHA)
@@ -1,5 +1,22 @@
-from django.urls import path, include
+from django.conf import settings
+from django.urls import path, re_path, include
+from django.views.static import serve
+from . import views
 
 urlpatterns = [
+    path('api/v1/notificacao_mercado_pago/', views.notificacao_mercado_pago),
+    path('metrics', views.metricas),
+    path('api/v1/assincrono/realizar_compra_online/', views.realizar_compra_online),
+    path('api/v1/assincrono/visualizar_compra_online/', views.visualizar_compra_online),
+    path('api/v1/assincrono/atualizar_situacao/<int:pk>/', views.atualizar_situacao),
+    path('api/v1/assincrono/monitorar_evento/<int:pk>/', views.monitorar_evento),
+    path('api/v1/assincrono/monitorar_compra_online/', views.monitorar_compra_online),
     path('', include('api.urls')),
 ]
+
+if not settings.DEBUG:
+    # sem o DEBUG o static() de api.urls não registra /static/ e /media/ (ver o perfil de produção em settings)
+    urlpatterns[-1:-1] = [
+        re_path(r'^static/(?P<path>.*)$', serve, dict(document_root=settings.STATIC_ROOT)),
+        re_path(r'^media/(?P<path>.*)$', serve, dict(document_root=settings.MEDIA_ROOT)),
+    ]
@@ -0,0 +1,142 @@
+import json
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from api.permissions import check_roles, check_lookups
+from .mercadopago import MercadoPago, MercadoPagoIndisponivel
+from . import instrumentacao, monitoramento, tasks
+from .models import Evento, CompraOnline
+
+
+@csrf_exempt
+@require_POST
+def notificacao_mercado_pago(request):
+    try:
+        dados = json.loads(request.body or b'{}')
+    except ValueError:
+        dados = {}
+    tipo = request.GET.get('type') or request.GET.get('topic') or dados.get('type')
+    pagamento = request.GET.get('data.id') or request.GET.get('id') or (dados.get('data') or {}).get('id')
+    if tipo != 'payment' or not pagamento:
+        return HttpResponse(status=200)
+    if not MercadoPago.verificar_assinatura(request.headers.get('x-signature'), request.headers.get('x-request-id'), pagamento):
+        return HttpResponse(status=401)
+    CompraOnline.objects.processar_notificacao(pagamento)
+    return HttpResponse(status=200)
+
+
+def metricas(request):
+    if not instrumentacao.autorizar(request):
+        return HttpResponse(status=403)
+    return HttpResponse(instrumentacao.exportar(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# variantes assíncronas dos endpoints que aguardam o Mercado Pago, servidas pelo ASGI (manage.py startasgi);
+# as respostas seguem o formato dos endpoints: {"redirect": url} ou os dados da compra
+
+def assincrona(metodo, publica=False):
+    # require_POST e csrf_exempt só passam a aceitar views assíncronas no Django 5
+    def decorador(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method != metodo:
+                return HttpResponseNotAllowed([metodo])
+            return await view(request, *args, **kwargs)
+        wrapper.csrf_exempt = publica
+        return wrapper
+    return decorador
+
+
+@assincrona('POST', publica=True)
+async def realizar_compra_online(request):
+    dados = request.POST or json.loads(request.body or b'{}')
+    erros = {campo: 'Este campo é obrigatório.' for campo in ('nome', 'cpf', 'email', 'numero_cartelas') if not dados.get(campo)}
+    if 'numero_cartelas' not in erros and not (str(dados['numero_cartelas']).isdigit() and int(dados['numero_cartelas']) > 0):
+        erros['numero_cartelas'] = 'Informe um número inteiro positivo.'
+    if erros:
+        return JsonResponse(erros, status=400)
+    compra = await CompraOnline.objects.acreate(
+        cpf=dados['cpf'], nome=dados['nome'], telefone=dados.get('telefone'), email=dados['email'],
+        numero_cartelas=int(dados['numero_cartelas']), status=CompraOnline.CRIANDO
+    )
+    try:
+        await compra.aconcluir_checkout()
+    except Exception as e:
+        return JsonResponse({'non_field_errors': 'Ocorreu um erro no servidor ({}).'.format(e)}, status=503)
+    return JsonResponse(dict(redirect=compra.url))
+
+
+@assincrona('GET')
+async def visualizar_compra_online(request):
+    try:
+        compra = await sync_to_async(CompraOnline.objects.get_por_uuid)(request.GET.get('uuid'))
+    except CompraOnline.DoesNotExist:
+        return JsonResponse({}, status=404)
+    if compra.is_criando():
+        await sync_to_async(tasks.retomar_checkouts)([compra.pk])
+    if 'aguardar' in request.GET and compra.url and not compra.is_confirmada() and not compra.is_criando():
+        return JsonResponse(dict(redirect=compra.url))
+    try:
+        status = await compra.aget_status_atual()
+    except MercadoPagoIndisponivel:
+        status = compra.get_status()
+    return JsonResponse(dict(
+        cpf=compra.cpf, nome=compra.nome, data_hora=compra.data_hora, valor=compra.valor, status=status,
+        cartelas=await sync_to_async(compra.get_numeros_cartelas)(),
+        monitoramento=None if compra.is_confirmada() else '/api/v1/assincrono/monitorar_compra_online/?uuid={}'.format(compra.uuid)
+    ))
+
+
+@assincrona('POST')
+async def atualizar_situacao(request, pk):
+    # mesmos papéis exigidos pela listagem de compras online, onde fica a ação "Atualizar Situação"
+    if not await sync_to_async(check_roles)(dict(adm=None, op=None), request.user, False):
+        return JsonResponse({}, status=403)
+    compra = await CompraOnline.objects.filter(pk=pk).afirst()
+    if compra is None or compra.is_confirmada():
+        return JsonResponse({}, status=404 if compra is None else 403)
+    try:
+        await compra.aatualizar_situacao()
+    except MercadoPagoIndisponivel as e:
+        return JsonResponse({'non_field_errors': str(e)}, status=503)
+    return JsonResponse(dict(status=compra.get_status()))
+
+
+# monitoramento por server-sent events: uma conexão ociosa por página aberta no lugar do autoreload; sob o WSGI
+# a conexão ocuparia um worker síncrono sem que nada chegasse ao navegador, então é recusada
+
+def pode_monitorar(user, evento):
+    # mesmos papéis exigidos pela visualização do evento
+    return user.is_authenticated and check_lookups(evento, dict(adm=None, op=dict(operadores__cpf='username')), user, False)
+
+
+@assincrona('GET')
+async def monitorar_evento(request, pk):
+    if not monitoramento.is_asgi(request):
+        return JsonResponse({}, status=503)
+    evento = await Evento.objects.filter(pk=pk).afirst()
+    if evento is None:
+        return JsonResponse({}, status=404)
+    canal = 'evento:{}'.format(pk)
+    # o EventSource não envia o token da API, então o painel do evento usa a chave assinada exibida na página
+    if not monitoramento.verificar(request.GET.get('chave'), canal) and not await sync_to_async(pode_monitorar)(request.user, evento):
+        return JsonResponse({}, status=403)
+    return monitoramento.responder(canal, sync_to_async(evento.get_monitoramento))
+
+
+@assincrona('GET')
+async def monitorar_compra_online(request):
+    if not monitoramento.is_asgi(request):
+        return JsonResponse({}, status=503)
+    uuid = request.GET.get('uuid')
+    try:
+        await sync_to_async(CompraOnline.objects.get_por_uuid)(uuid)
+    except CompraOnline.DoesNotExist:
+        return JsonResponse({}, status=404)
+    return monitoramento.responder(
+        'compraonline:{}'.format(uuid),
+        sync_to_async(lambda: CompraOnline.objects.get_por_uuid(uuid).get_situacao_monitoramento()),
+        lambda dados: dados['confirmada']
+    )
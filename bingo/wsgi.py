@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bingo.settings')
 
 application = get_wsgi_application()
+
+from .checks import relatar  # noqa: E402
+
+relatar()